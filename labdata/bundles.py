@@ -0,0 +1,233 @@
+from .utils import *
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+# Bundles pack the small files of a dataset in a few (tar) objects.
+# The byte range of each file is stored in BundledFile so single files can be read with S3 range requests.
+# Bundles are plain tar files, they can also be extracted with standard tools.
+
+__all__ = ['DEFAULT_BUNDLE_SIZE',
+           'get_bundle_settings',
+           'select_files_to_bundle',
+           'create_file_bundles',
+           'read_bundled_file',
+           'get_bundled_files',
+           'is_bundle',
+           'get_bundle_members']
+
+DEFAULT_BUNDLE_SIZE = 1024**3       # max size of each bundle (1GB)
+DEFAULT_BUNDLE_MAX_FILE_SIZE = None # files smaller than this are bundled (None disables bundling)
+DEFAULT_BUNDLE_MIN_FILES = 100      # only bundle datasets with many small files
+BUNDLE_PREFIX = 'labdata_bundle_'
+MAX_RANGE_GAP = 1024*1024           # ranges closer than this are fetched in the same request
+
+def get_bundle_settings():
+    '''
+    Returns the bundle settings from the preferences (prefs['bundles']).
+      - max_file_size: files smaller than this (bytes) are bundled; None disables bundling
+      - max_bundle_size: max size of each bundle (bytes)
+      - min_files: minimum number of small files for a dataset to be bundled
+    '''
+    settings = dict(max_file_size = DEFAULT_BUNDLE_MAX_FILE_SIZE,
+                    max_bundle_size = DEFAULT_BUNDLE_SIZE,
+                    min_files = DEFAULT_BUNDLE_MIN_FILES)
+    if 'bundles' in prefs.keys():
+        if not prefs['bundles'] is None:
+            settings.update(prefs['bundles'])
+    return settings
+
+def select_files_to_bundle(file_paths, file_sizes, max_file_size = None, min_files = None):
+    '''
+    Returns a boolean array with the files that should be bundled;
+    all False if bundling is disabled or there are less than min_files small files.
+    '''
+    settings = get_bundle_settings()
+    if max_file_size is None:
+        max_file_size = settings['max_file_size']
+    if min_files is None:
+        min_files = settings['min_files']
+    selection = np.zeros(len(file_paths), dtype = bool)
+    if max_file_size is None:
+        return selection
+    selection = np.array(file_sizes) < max_file_size
+    # bundles are never bundled again
+    selection &= np.array([not Path(f).name.startswith(BUNDLE_PREFIX) for f in file_paths], dtype = bool)
+    if np.sum(selection) < min_files:
+        selection[:] = False
+    return selection
+
+def create_file_bundles(file_paths, local_path, bundle_folder = None, max_bundle_size = None):
+    '''
+    Packs files in tar bundles written to local_path/bundle_folder.
+
+    bundles = create_file_bundles(file_paths, local_path)
+
+    file_paths are relative to local_path; the bundle folder is the common folder of the files
+    (i.e. the dataset folder) if not specified. Existing bundles with the same name are overwritten.
+
+    Returns a list of dictionaries (one per bundle) with:
+       bundle_path: path of the bundle (relative to local_path)
+       members: list of dict(file_path, member_offset, member_size)
+
+    Joao Couto - labdata 2024
+    '''
+    if max_bundle_size is None:
+        max_bundle_size = get_bundle_settings()['max_bundle_size']
+    file_paths = [str(f) for f in file_paths]
+    if bundle_folder is None:
+        bundle_folder = os.path.commonpath([str(Path(f).parent) for f in file_paths])
+    local_path = Path(local_path)
+    # bundles are filled in order so files of the same folder stay together
+    file_paths = np.sort(file_paths)
+    groups, group, group_size = [], [], 0
+    for f in file_paths:
+        size = (local_path/f).stat().st_size
+        if len(group) and group_size + size > max_bundle_size:
+            groups.append(group)
+            group, group_size = [], 0
+        group.append(f)
+        group_size += size
+    if len(group):
+        groups.append(group)
+
+    bundles = []
+    for igroup, group in enumerate(groups):
+        bundle_path = str(Path(bundle_folder)/f'{BUNDLE_PREFIX}{igroup:04d}.tar')
+        members = []
+        with tarfile.open(local_path/bundle_path, 'w', format = tarfile.PAX_FORMAT) as tar:
+            for f in group:
+                # the name in the tar is relative to the bundle folder
+                info = tar.gettarinfo(str(local_path/f), arcname = os.path.relpath(f, bundle_folder))
+                with open(local_path/f,'rb') as fd:
+                    tar.addfile(info, fd)
+                # the data are right before the current offset (padded to the tar block size)
+                nblocks = int(np.ceil(info.size/tarfile.BLOCKSIZE))
+                members.append(dict(file_path = f,
+                                    member_offset = tar.offset - nblocks*tarfile.BLOCKSIZE,
+                                    member_size = info.size))
+        bundles.append(dict(bundle_path = bundle_path,
+                            members = members))
+    return bundles
+
+def is_bundle(file_path):
+    '''
+    True if the path is a bundle created by create_file_bundles.
+    '''
+    return Path(str(file_path)).name.startswith(BUNDLE_PREFIX)
+
+def get_bundle_members(file_paths, storages):
+    '''
+    Returns the files packed in the bundles of a list of files (e.g. Dataset.DataFiles).
+
+    members = get_bundle_members(file_paths, storages)
+
+    Returns a dictionary {(bundle_path, bundle_storage): [BundledFile rows]}, files that are not bundles are skipped.
+    '''
+    from .schema import BundledFile
+    keys = [dict(bundle_path = str(f), bundle_storage = str(s))
+            for f,s in zip(file_paths, storages) if is_bundle(f)]
+    members = dict()
+    if not len(keys):
+        return members
+    for m in (BundledFile() & keys).fetch(as_dict = True):
+        members.setdefault((m['bundle_path'], m['bundle_storage']), []).append(m)
+    return members
+
+def _get_storage(storage_name):
+    from .s3 import validate_storage
+    return validate_storage(prefs['storage'][storage_name])
+
+def read_bundled_file(file_path, storage = None, local_paths = None, verify = True):
+    '''
+    Reads a file that was uploaded in a bundle.
+    The file is read from the local paths if it exists there, otherwise
+    only the byte range of the file is requested from S3.
+
+    data = read_bundled_file('subject/session/dataset/file.txt')
+
+    Returns bytes.
+
+    Joao Couto - labdata 2024
+    '''
+    from .schema import BundledFile
+    from .s3 import s3_get_object_range
+    key = dict(file_path = str(file_path))
+    if not storage is None:
+        key['storage'] = storage
+    member = (BundledFile() & key).fetch(as_dict = True)
+    if not len(member):
+        raise ValueError(f'{file_path} is not in a bundle.')
+    member = member[0]
+    localfile = find_local_filepath(member['file_path'], local_paths = local_paths)
+    if not localfile is None:
+        with open(localfile,'rb') as fd:
+            return fd.read()
+    data = s3_get_object_range(member['bundle_path'],
+                               storage = _get_storage(member['bundle_storage']),
+                               offset = int(member['member_offset']),
+                               length = int(member['file_size']))
+    if verify and not member['file_md5'] is None:
+        if not hashlib.md5(data).hexdigest() == member['file_md5']:
+            raise OSError(f'Checksum of {file_path} does not match {member["file_md5"]}.')
+    return data
+
+def get_bundled_files(file_paths, local_path = None, storage = None, n_jobs = DEFAULT_N_JOBS, overwrite = False):
+    '''
+    Downloads files that were uploaded in bundles to local_path (default prefs['local_paths'][0]).
+    Members of the same bundle that are close together are fetched in one range request.
+
+    paths = get_bundled_files(file_paths)
+
+    Returns the local paths.
+
+    Joao Couto - labdata 2024
+    '''
+    from .schema import BundledFile
+    from .s3 import s3_get_object_range
+    if local_path is None:
+        local_path = prefs['local_paths'][0]
+    local_path = Path(local_path)
+    query = BundledFile() & [dict(file_path = str(f)) for f in file_paths]
+    if not storage is None:
+        query = query & dict(storage = storage)
+    members = pd.DataFrame(query.fetch())
+    if not len(members):
+        return []
+    if not overwrite:
+        exists = np.array([(local_path/f).exists() for f in members.file_path.values], dtype = bool)
+        members = members[~exists]
+    # merge the byte ranges of each bundle
+    requests = []
+    for (bundle_path, bundle_storage), bundle in members.groupby(['bundle_path','bundle_storage']):
+        bundle = bundle.sort_values('member_offset')
+        rng = None
+        for i,m in bundle.iterrows():
+            start, stop = int(m.member_offset), int(m.member_offset + m.file_size)
+            if not rng is None and start - rng['stop'] <= MAX_RANGE_GAP:
+                rng['stop'] = max(rng['stop'], stop)
+                rng['members'].append(m)
+                continue
+            rng = dict(bundle_path = bundle_path,
+                       bundle_storage = bundle_storage,
+                       start = start,
+                       stop = stop,
+                       members = [m])
+            requests.append(rng)
+
+    def _fetch(rng):
+        data = s3_get_object_range(rng['bundle_path'],
+                                   storage = _get_storage(rng['bundle_storage']),
+                                   offset = rng['start'],
+                                   length = rng['stop'] - rng['start'])
+        for m in rng['members']:
+            start = int(m.member_offset) - rng['start']
+            member = data[start:start + int(m.file_size)]
+            if not m.file_md5 is None and not hashlib.md5(member).hexdigest() == m.file_md5:
+                raise OSError(f'Checksum of {m.file_path} does not match {m.file_md5}.')
+            filename = local_path/m.file_path
+            filename.parent.mkdir(parents = True, exist_ok = True)
+            with open(filename,'wb') as fd:
+                fd.write(member)
+            os.utime(filename, (m.file_datetime.timestamp(), m.file_datetime.timestamp()))
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        list(pool.map(_fetch, requests))
+    return [local_path/f for f in file_paths]
@@ -0,0 +1,489 @@
+from .utils import *
+from contextlib import contextmanager
+# Checksums to verify file integrity when copying, uploading and downloading.
+# md5 is used in all tables for backward compatibility,
+# other (faster) algorithms can be stored in FileChecksum.
+
+__all__ = ['DEFAULT_CHECKSUM_CHUNK_SIZE',
+           'checksum_algorithms',
+           'register_checksum_algorithm',
+           'get_hasher',
+           'get_secondary_checksum_algorithms',
+           'compute_checksums',
+           'compute_file_checksum',
+           'compute_checksums_for_files',
+           'benchmark_checksums',
+           'compute_chunked_checksums',
+           'verify_chunked_checksums',
+           'combine_part_checksums',
+           'ChecksumCache',
+           'get_checksum_cache']
+
+DEFAULT_CHECKSUM_CHUNK_SIZE = 16*1024*1024  # 16 MB reads (4096 bytes caps the hashing speed)
+CHECKSUM_CACHE_FILE = LABDATA_FILE.parent/'checksum_cache.sqlite'
+DEFAULT_CHECKSUM_CACHE_SIZE = 200000        # max number of entries in the cache
+DEFAULT_MANIFEST_PART_SIZE = 64*1024*1024   # part size for chunked checksums (manifests)
+
+checksum_algorithms = dict()  # name: function that returns a new hash object
+
+def register_checksum_algorithm(name, factory):
+    '''
+    Adds a checksum algorithm to the registry.
+
+    factory is a function that returns a new hash object,
+    the object must have the update and hexdigest methods (like hashlib).
+
+    register_checksum_algorithm('sha256', hashlib.sha256)
+
+    '''
+    checksum_algorithms[name] = factory
+
+for _name in ['md5','sha1','sha256','blake2b','blake2s']:
+    register_checksum_algorithm(_name, getattr(hashlib, _name))
+try:
+    import xxhash  # optional, much faster than md5 (pip install xxhash)
+    register_checksum_algorithm('xxh64', xxhash.xxh64)
+    register_checksum_algorithm('xxh3_64', xxhash.xxh3_64)
+    register_checksum_algorithm('xxh3_128', xxhash.xxh3_128)
+except ImportError:
+    pass
+
+def get_hasher(algorithm = 'md5'):
+    '''
+    Returns a new hash object for an algorithm in the registry.
+    '''
+    if not algorithm in checksum_algorithms.keys():
+        raise ValueError(f'Checksum algorithm {algorithm} is not available; use one of {list(checksum_algorithms.keys())}.')
+    return checksum_algorithms[algorithm]()
+
+def get_secondary_checksum_algorithms():
+    '''
+    Returns the algorithms listed in prefs['checksums']['secondary'] (stored in FileChecksum along with the md5).
+    '''
+    algorithms = []
+    if 'checksums' in prefs.keys():
+        algorithms = prefs['checksums'].get('secondary',[])
+    for a in algorithms:
+        if not a in checksum_algorithms.keys():
+            raise ValueError(f'Secondary checksum {a} is not available (is xxhash installed?).')
+    return [a for a in algorithms if not a == 'md5']
+
+def _get_chunk_size(chunk_size = None):
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHECKSUM_CHUNK_SIZE
+        if 'checksums' in prefs.keys():
+            chunk_size = prefs['checksums'].get('chunk_size',chunk_size)
+    return int(chunk_size)
+
+class ChecksumCache():
+    def __init__(self, filename = None, max_entries = None):
+        '''
+        Local (sqlite) cache of file checksums, so the same files are not hashed multiple times.
+
+        Entries are keyed by the file path and algorithm and are only valid 
+        if the size, modification time and inode of the file did not change.
+        The least recently used entries are removed when there are more than max_entries.
+
+        cache = ChecksumCache()
+        cache.get(path, 'md5')    # returns None if not in the cache or if the file changed
+        cache.put(path, 'md5', checksum)
+
+        The cache is in ~/labdata/checksum_cache.sqlite; use "labdata2 checksums" to inspect or prune it.
+
+        Joao Couto - labdata 2024
+        '''
+        if filename is None:
+            filename = CHECKSUM_CACHE_FILE
+        if max_entries is None:
+            max_entries = DEFAULT_CHECKSUM_CACHE_SIZE
+            if 'checksums' in prefs.keys():
+                max_entries = prefs['checksums'].get('cache_max_entries',max_entries)
+        self.filename = Path(filename)
+        self.max_entries = max_entries
+        self.filename.parent.mkdir(parents = True, exist_ok = True)
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                          file_path   TEXT NOT NULL,
+                          algorithm   TEXT NOT NULL,
+                          file_size   INTEGER NOT NULL,
+                          file_mtime  INTEGER NOT NULL,
+                          file_inode  INTEGER NOT NULL,
+                          checksum    TEXT NOT NULL,
+                          last_access REAL NOT NULL,
+                          PRIMARY KEY (file_path, algorithm))''')
+            db.execute('CREATE INDEX IF NOT EXISTS checksums_access ON checksums (last_access)')
+        
+    @contextmanager
+    def _connect(self):
+        import sqlite3
+        db = sqlite3.connect(str(self.filename), timeout = 60)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')  # multiple processes hash files in parallel
+            with db:  # commits on exit
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _key(path, stat = None):
+        path = Path(path).resolve()
+        if stat is None:
+            stat = path.stat()
+        return str(path), stat
+
+    def get(self, path, algorithm = 'md5', stat = None):
+        '''
+        Returns the checksum or None if the file is not in the cache or changed.
+        '''
+        from time import time
+        path, stat = self._key(path, stat)
+        with self._connect() as db:
+            res = db.execute('''SELECT checksum, file_size, file_mtime, file_inode FROM checksums 
+                                WHERE file_path = ? AND algorithm = ?''',(path, algorithm)).fetchone()
+            if res is None:
+                return None
+            checksum, size, mtime, inode = res
+            if not (size == stat.st_size and mtime == stat.st_mtime_ns and inode == stat.st_ino):
+                # the file changed, invalidate
+                db.execute('DELETE FROM checksums WHERE file_path = ? AND algorithm = ?',(path, algorithm))
+                return None
+            db.execute('UPDATE checksums SET last_access = ? WHERE file_path = ? AND algorithm = ?',
+                       (time(), path, algorithm))
+        return checksum
+
+    def put(self, path, algorithm, checksum, stat = None):
+        '''
+        Adds a checksum to the cache (stat is the os.stat of the file when the checksum was computed).
+        '''
+        from time import time
+        path, stat = self._key(path, stat)
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?,?,?)',
+                       (path, algorithm, stat.st_size, stat.st_mtime_ns, stat.st_ino, checksum, time()))
+        self.prune()
+
+    def prune(self, max_entries = None, remove_missing = False):
+        '''
+        Removes the least recently used entries so there are at most max_entries.
+        remove_missing will also remove the entries of files that do not exist or changed.
+        Returns the number of removed entries.
+        '''
+        if max_entries is None:
+            max_entries = self.max_entries
+        removed = 0
+        with self._connect() as db:
+            if remove_missing:
+                res = db.execute('SELECT file_path, algorithm, file_size, file_mtime, file_inode FROM checksums').fetchall()
+                for path, algorithm, size, mtime, inode in res:
+                    try:
+                        stat = os.stat(path)
+                        if size == stat.st_size and mtime == stat.st_mtime_ns and inode == stat.st_ino:
+                            continue
+                    except OSError:
+                        pass
+                    db.execute('DELETE FROM checksums WHERE file_path = ? AND algorithm = ?',(path, algorithm))
+                    removed += 1
+            if not max_entries is None:
+                n = db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+                if n > max_entries:
+                    db.execute('''DELETE FROM checksums WHERE rowid IN 
+                                  (SELECT rowid FROM checksums ORDER BY last_access ASC LIMIT ?)''',(n - max_entries,))
+                    removed += n - max_entries
+        return removed
+
+    def clear(self):
+        with self._connect() as db:
+            db.execute('DELETE FROM checksums')
+
+    def to_dataframe(self):
+        with self._connect() as db:
+            res = db.execute('SELECT * FROM checksums ORDER BY last_access DESC').fetchall()
+        res = pd.DataFrame(res, columns = ['file_path','algorithm','file_size','file_mtime',
+                                           'file_inode','checksum','last_access'])
+        res['last_access'] = pd.to_datetime(res['last_access'], unit = 's')
+        return res
+
+    def __len__(self):
+        with self._connect() as db:
+            return db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+
+_checksum_cache = None
+def get_checksum_cache():
+    '''
+    Returns the checksum cache for this process or None if disabled (prefs['checksums']['cache'] = False).
+    '''
+    global _checksum_cache
+    if 'checksums' in prefs.keys():
+        if not prefs['checksums'].get('cache', True):
+            return None
+    if _checksum_cache is None:
+        try:
+            _checksum_cache = ChecksumCache()
+        except Exception as err:
+            print(f'Could not open the checksum cache: {err}')
+            return None
+    return _checksum_cache
+
+def compute_checksums(fname, algorithms = ['md5'], chunk_size = None, use_mmap = False, use_cache = True):
+    '''
+    Computes multiple checksums reading the file only once.
+
+    checksums = compute_checksums(fname, algorithms = ['md5','blake2b'])
+
+    fname: path to the file
+    algorithms: list of algorithms from the registry (checksum_algorithms)
+    chunk_size: size of each read (default is 16MB or prefs['checksums']['chunk_size'])
+    use_mmap: memory map the file instead of reading to a buffer
+    use_cache: use the checksums from the ChecksumCache if the file did not change 
+
+    Returns a dictionary {algorithm: hexdigest}
+
+    Joao Couto - labdata 2024
+    '''
+    cache = get_checksum_cache() if use_cache else None
+    cached = dict()
+    if not cache is None:
+        try:
+            stat = os.stat(fname)
+            for a in algorithms:
+                c = cache.get(fname, a, stat = stat)
+                if not c is None:
+                    cached[a] = c
+        except Exception as err:  # the cache should never stop the checksum
+            print(f'Checksum cache error: {err}')
+            cache = None
+        algorithms = [a for a in algorithms if not a in cached.keys()]
+        if not len(algorithms):
+            return cached
+    chunk_size = _get_chunk_size(chunk_size)
+    hashes = {a:get_hasher(a) for a in algorithms}
+    with open(fname, 'rb', buffering = 0) as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if use_mmap and size > 0:
+            import mmap
+            with mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as view:
+                    for offset in range(0, size, chunk_size):
+                        with view[offset:offset+chunk_size] as chunk:
+                            for h in hashes.values():
+                                h.update(chunk)
+        else:
+            buf = bytearray(chunk_size)
+            with memoryview(buf) as view:
+                while True:
+                    n = fd.readinto(buf)
+                    if not n:
+                        break
+                    with view[:n] as chunk:
+                        for h in hashes.values():
+                            h.update(chunk)
+    res = {a:h.hexdigest() for a,h in hashes.items()}
+    if not cache is None:
+        try:
+            for a in res.keys():
+                cache.put(fname, a, res[a], stat = stat)
+        except Exception as err:
+            print(f'Checksum cache error: {err}')
+    return dict(cached, **res)
+
+def compute_file_checksum(fname, algorithm = 'md5', chunk_size = None, use_mmap = False, use_cache = True):
+    '''
+    Computes the checksum of a file.
+
+    hexdigest = compute_file_checksum(fname, algorithm = 'md5')
+    '''
+    return compute_checksums(fname, algorithms = [algorithm],
+                             chunk_size = chunk_size,
+                             use_mmap = use_mmap,
+                             use_cache = use_cache)[algorithm]
+
+def combine_part_checksums(part_checksums, algorithm = 'md5'):
+    '''
+    Combines the checksums of the parts of a file in a single checksum.
+    It is the checksum of the concatenated (binary) part checksums followed by -<number of parts>;
+    for md5 this is the same as the ETag of an S3 multipart upload with the same part size.
+    '''
+    h = get_hasher(algorithm)
+    for c in part_checksums:
+        h.update(bytes.fromhex(c))
+    return f'{h.hexdigest()}-{len(part_checksums)}'
+
+def _checksum_file_part(fd, offset, length, algorithm, chunk_size):
+    h = get_hasher(algorithm)
+    end = offset + length
+    while offset < end:
+        buf = os.pread(fd, min(chunk_size, end - offset), offset)
+        if not len(buf):
+            break
+        h.update(buf)  # hashlib releases the GIL so the parts are hashed in parallel
+        offset += len(buf)
+    return h.hexdigest()
+
+def compute_chunked_checksums(fname, part_size = None, algorithm = 'md5',
+                              parts = None,
+                              n_threads = DEFAULT_N_JOBS,
+                              chunk_size = None,
+                              use_cache = True):
+    '''
+    Computes the checksum of each part of a file using multiple threads (to hash a single large file on many cores).
+
+    manifest = compute_chunked_checksums(fname, part_size = 64*1024**2)
+
+    fname: path to the file
+    part_size: size of each part (default is prefs['checksums']['manifest_part_size'] or 64MB)
+    algorithm: checksum algorithm
+    parts: list of part indices to compute (used to verify part of a file), default is all parts
+    n_threads: number of threads
+
+    Returns a dictionary (manifest) with: 
+        algorithm, part_size, file_size, n_parts, 
+        part_checksums (list of hexdigests, None for parts not computed) and 
+        manifest_checksum (the checksum of the part checksums, see combine_part_checksums)
+
+    Joao Couto - labdata 2024
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    if part_size is None:
+        part_size = DEFAULT_MANIFEST_PART_SIZE
+        if 'checksums' in prefs.keys():
+            part_size = prefs['checksums'].get('manifest_part_size',part_size)
+    part_size = int(part_size)
+    chunk_size = min(_get_chunk_size(chunk_size), part_size)
+    stat = os.stat(fname)
+    file_size = stat.st_size
+    n_parts = max(int(np.ceil(file_size/part_size)),1)
+    cachekey = f'{algorithm}-parts-{part_size}'
+    cache = get_checksum_cache() if use_cache and parts is None else None
+    if not cache is None:
+        try:
+            manifest = cache.get(fname, cachekey, stat = stat)
+            if not manifest is None:
+                return json.loads(manifest)
+        except Exception as err:
+            print(f'Checksum cache error: {err}')
+            cache = None
+    if parts is None:
+        parts = range(n_parts)
+    part_checksums = [None]*n_parts
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers = n_threads) as pool:
+            futures = {ipart:pool.submit(_checksum_file_part, fd,
+                                         ipart*part_size,
+                                         min(part_size, file_size - ipart*part_size),
+                                         algorithm, chunk_size) for ipart in parts}
+            for ipart in futures.keys():
+                part_checksums[ipart] = futures[ipart].result()
+    finally:
+        os.close(fd)
+    manifest = dict(algorithm = algorithm,
+                    part_size = part_size,
+                    file_size = file_size,
+                    n_parts = n_parts,
+                    part_checksums = part_checksums,
+                    manifest_checksum = None)
+    if not None in part_checksums:
+        manifest['manifest_checksum'] = combine_part_checksums(part_checksums, algorithm = algorithm)
+        if not cache is None:
+            try:
+                cache.put(fname, cachekey, json.dumps(manifest), stat = stat)
+            except Exception as err:
+                print(f'Checksum cache error: {err}')
+    return manifest
+
+def verify_chunked_checksums(fname, manifest, parts = None, n_threads = DEFAULT_N_JOBS):
+    '''
+    Compares the parts of a file with a manifest (from compute_chunked_checksums or FileManifest).
+
+    bad_parts = verify_chunked_checksums(fname, manifest, parts = [0, 10])
+
+    parts: the part indices to check (default all)
+
+    Returns a list with the indices of parts that do not match (empty if the file is fine).
+    '''
+    if not Path(fname).stat().st_size == manifest['file_size']:
+        raise OSError(f"File {fname} size does not match the manifest ({manifest['file_size']} bytes).")
+    if parts is None:
+        parts = range(manifest['n_parts'])
+    parts = list(parts)
+    res = compute_chunked_checksums(fname,
+                                    part_size = manifest['part_size'],
+                                    algorithm = manifest['algorithm'],
+                                    parts = parts,
+                                    n_threads = n_threads,
+                                    use_cache = False)
+    return [p for p in parts if not res['part_checksums'][p] == manifest['part_checksums'][p]]
+
+def compute_checksums_for_files(filepaths, algorithms = ['md5'], n_jobs = DEFAULT_N_JOBS, **kwargs):
+    '''
+    Computes multiple checksums for multiple files in parallel.
+    Returns a list of dictionaries {algorithm: hexdigest}
+    '''
+    return Parallel(n_jobs = n_jobs)(delayed(compute_checksums)(filepath,
+                                                                algorithms = algorithms,
+                                                                **kwargs) for filepath in filepaths)
+
+def benchmark_checksums(filename = None,
+                        algorithms = None,
+                        chunk_sizes = [4096, 1024**2, 4*1024**2, 16*1024**2, 64*1024**2],
+                        use_mmap = [False, True],
+                        file_size = 2*1024**3,
+                        folder = None):
+    '''
+    Measures the checksum throughput (GB/s) for each algorithm and chunk size on the local disk.
+
+    res = benchmark_checksums(algorithms = ['md5','blake2b','xxh3_64'])
+
+    filename: file to test, if None creates a temporary file with random data (file_size) in folder
+    algorithms: list of algorithms (default is all in the registry)
+    chunk_sizes: read sizes to test
+    use_mmap: test memory mapped and buffered reads
+    folder: where to write the temporary file (default is the scratch_path)
+
+    The file will likely be in the page cache after the first read, use a file
+    larger than the memory to measure the disk.
+
+    Returns a pandas DataFrame.
+
+    Joao Couto - labdata 2024
+    '''
+    from time import perf_counter
+    from tqdm import tqdm
+    if algorithms is None:
+        algorithms = list(checksum_algorithms.keys())
+    remove_file = False
+    if filename is None:
+        if folder is None:
+            folder = prefs['scratch_path']
+        folder = Path(folder)
+        folder.mkdir(parents = True, exist_ok = True)
+        filename = folder/'labdata_checksum_benchmark.bin'
+        block = np.random.randint(0, 255, size = 64*1024**2, dtype = np.uint8).tobytes()
+        with open(filename,'wb') as fd:
+            for i in range(0, int(file_size), len(block)):
+                fd.write(block[:int(file_size)-i])
+        remove_file = True
+    filename = Path(filename)
+    size = filename.stat().st_size
+    res = []
+    try:
+        tests = [(a,c,m) for a in algorithms for c in chunk_sizes for m in use_mmap]
+        for algorithm, chunk_size, mm in tqdm(tests, desc = 'Benchmarking checksums'):
+            tstart = perf_counter()
+            compute_file_checksum(filename, algorithm = algorithm, chunk_size = chunk_size,
+                                  use_mmap = mm, use_cache = False)
+            duration = perf_counter() - tstart
+            res.append(dict(algorithm = algorithm,
+                            chunk_size = chunk_size,
+                            use_mmap = mm,
+                            file_size = size,
+                            duration = duration,
+                            throughput = (size/1024**3)/duration))
+    finally:
+        if remove_file:
+            filename.unlink()
+    res = pd.DataFrame(res)
+    print(res.sort_values('throughput', ascending = False).to_string(index = False))
+    return res
@@ -21,6 +21,10 @@ Data analysis commands:
             
 Server commands (don't run on experimental computers):
             upload                                          Sends pending data to S3 (applies upload rules)
+
+Maintenance commands:
+            checksums                                       Inspect or prune the local checksum cache
+            cache                                           Inspect or purge the scratch cache of compute nodes
             ''')
         parser.add_argument('command', help= 'type: labdata2 <command> -h for help')
 
@@ -132,6 +136,62 @@ Server commands (don't run on experimental computers):
             task = handle_compute(job_id)
             task.compute()
         
+    def checksums(self):
+        parser = argparse.ArgumentParser(
+            description = 'Inspect or prune the local checksum cache',
+            usage = '''labdata checksums [--list] [--prune] [--max-entries <N>] [--clear]''')
+        parser.add_argument('-l','--list',action = 'store_true', default = False,
+                            help = 'List the cached checksums (most recent first)')
+        parser.add_argument('-p','--prune',action = 'store_true', default = False,
+                            help = 'Remove entries of files that changed or no longer exist')
+        parser.add_argument('-n','--max-entries',action = 'store', default = None, type = int,
+                            help = 'Keep only the N most recently used entries')
+        parser.add_argument('--clear',action = 'store_true', default = False,
+                            help = 'Remove all entries')
+        args = parser.parse_args(sys.argv[2:])
+        from .checksums import ChecksumCache
+        cache = ChecksumCache()
+        if args.clear:
+            cache.clear()
+        if args.prune or not args.max_entries is None:
+            removed = cache.prune(max_entries = args.max_entries, remove_missing = args.prune)
+            print(f'Removed {removed} entries.')
+        if args.list:
+            print(cache.to_dataframe().to_string(index = False))
+        print(f'Checksum cache {cache.filename}: {len(cache)} entries (max {cache.max_entries})')
+
+    def cache(self):
+        parser = argparse.ArgumentParser(
+            description = 'Inspect or purge the scratch cache (files downloaded by compute tasks)',
+            usage = '''labdata cache [--list] [--validate] [--evict] [--max-size <GB>] [--purge]''')
+        parser.add_argument('-l','--list',action = 'store_true', default = False,
+                            help = 'List the cached files (most recently used first)')
+        parser.add_argument('-v','--validate',action = 'store_true', default = False,
+                            help = 'Remove entries of files that changed or no longer exist')
+        parser.add_argument('--checksums',action = 'store_true', default = False,
+                            help = 'Also compare the md5 of the files when validating')
+        parser.add_argument('-e','--evict',action = 'store_true', default = False,
+                            help = 'Delete the least recently used files to fit the size budget')
+        parser.add_argument('-m','--max-size',action = 'store', default = None, type = float,
+                            help = 'Size budget in GB (default from the preferences)')
+        parser.add_argument('--purge',action = 'store_true', default = False,
+                            help = 'Delete all files that are not in use by a task')
+        args = parser.parse_args(sys.argv[2:])
+        from .compute.cache import ScratchCache
+        cache = ScratchCache(max_size = None if args.max_size is None else int(args.max_size*1024**3))
+        if args.validate:
+            removed = cache.validate(verify_checksums = args.checksums)
+            print(f'Removed {removed} entries.')
+        if args.purge:
+            freed = cache.purge()
+            print(f'Deleted {freed/1024**3:.2f} GB.')
+        elif args.evict:
+            freed = cache.evict()
+            print(f'Deleted {freed/1024**3:.2f} GB.')
+        if args.list:
+            print(cache.to_dataframe().to_string(index = False))
+        print(f'Scratch cache {cache.folder}: {len(cache)} files, {cache.size()/1024**3:.2f} GB (max {cache.max_size/1024**3:.2f} GB)')
+        
     def _add_default_arguments(self, parser,level = 3):
         if level >= 1:
             parser.add_argument('-a','--subject',
@@ -0,0 +1,237 @@
+from ..utils import *
+from contextlib import contextmanager
+# Cache of the files downloaded to the scratch path of compute nodes.
+# Files are kept until the cache is larger than the budget, then the least recently used are deleted;
+# files used by running tasks are pinned and never deleted.
+
+__all__ = ['DEFAULT_SCRATCH_CACHE_SIZE',
+           'ScratchCache',
+           'get_scratch_cache']
+
+DEFAULT_SCRATCH_CACHE_SIZE = 500*1024**3  # 500 GB
+SCRATCH_CACHE_INDEX = '.labdata_cache.sqlite'
+
+def _pid_exists(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class ScratchCache():
+    def __init__(self, folder = None, max_size = None):
+        '''
+        Cache of the files downloaded to the scratch path (e.g. raw data of compute tasks).
+
+        cache = ScratchCache()
+        localfile = cache.get(file_path, storage)    # None if not cached (or if the file changed)
+        cache.reserve(nbytes)                        # evicts least recently used files to fit nbytes
+        cache.add(file_path, storage, localfile, md5)
+        cache.pin(file_path, storage, owner = job_id)
+        cache.unpin(owner = job_id)                  # when the task is done
+
+        The files are in folder/<file_path>, the index is in folder/.labdata_cache.sqlite.
+        max_size is the budget in bytes (prefs['compute']['scratch_cache_size']);
+        pinned files (in use by running tasks) are never evicted.
+        Use "labdata2 cache" to inspect or purge it.
+
+        Joao Couto - labdata 2024
+        '''
+        if folder is None:
+            folder = prefs['scratch_path']
+        if max_size is None:
+            max_size = prefs['compute'].get('scratch_cache_size', DEFAULT_SCRATCH_CACHE_SIZE)
+        self.folder = Path(folder)
+        self.max_size = max_size
+        self.folder.mkdir(parents = True, exist_ok = True)
+        self.filename = self.folder/SCRATCH_CACHE_INDEX
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS files (
+                          file_path   TEXT NOT NULL,
+                          storage     TEXT NOT NULL,
+                          local_path  TEXT NOT NULL,
+                          file_size   INTEGER NOT NULL,
+                          file_mtime  INTEGER NOT NULL,
+                          file_md5    TEXT,
+                          added       REAL NOT NULL,
+                          last_access REAL NOT NULL,
+                          PRIMARY KEY (file_path, storage))''')
+            db.execute('CREATE INDEX IF NOT EXISTS files_access ON files (last_access)')
+            db.execute('''CREATE TABLE IF NOT EXISTS pins (
+                          file_path   TEXT NOT NULL,
+                          storage     TEXT NOT NULL,
+                          owner       TEXT NOT NULL,
+                          pid         INTEGER NOT NULL,
+                          host        TEXT NOT NULL,
+                          PRIMARY KEY (file_path, storage, owner))''')
+
+    @contextmanager
+    def _connect(self):
+        import sqlite3
+        db = sqlite3.connect(str(self.filename), timeout = 60)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')  # multiple tasks on the same node
+            with db:  # commits on exit
+                yield db
+        finally:
+            db.close()
+
+    def local_path(self, file_path):
+        return self.folder/file_path
+
+    def get(self, file_path, storage, verify = False):
+        '''
+        Returns the local path of a cached file or None.
+        The entry is removed if the file is missing or changed size or modification time;
+        verify = True also compares the md5 (the checksum cache avoids re-hashing).
+        '''
+        from time import time
+        with self._connect() as db:
+            res = db.execute('''SELECT local_path, file_size, file_mtime, file_md5 FROM files
+                                WHERE file_path = ? AND storage = ?''',(str(file_path), str(storage))).fetchone()
+        if res is None:
+            return None
+        local_path, size, mtime, md5 = res
+        valid = False
+        try:
+            stat = os.stat(local_path)
+            valid = stat.st_size == size and stat.st_mtime_ns == mtime
+        except OSError:
+            pass
+        if valid and verify and not md5 is None:
+            from ..checksums import compute_file_checksum
+            valid = compute_file_checksum(local_path, 'md5') == md5
+        with self._connect() as db:
+            if not valid:
+                db.execute('DELETE FROM files WHERE file_path = ? AND storage = ?',(str(file_path), str(storage)))
+                return None
+            db.execute('UPDATE files SET last_access = ? WHERE file_path = ? AND storage = ?',
+                       (time(), str(file_path), str(storage)))
+        return Path(local_path)
+
+    def add(self, file_path, storage, local_path = None, md5 = None):
+        '''
+        Adds a file that is in the scratch folder to the cache.
+        '''
+        from time import time
+        if local_path is None:
+            local_path = self.local_path(file_path)
+        stat = os.stat(local_path)
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',
+                       (str(file_path), str(storage), str(local_path), stat.st_size, stat.st_mtime_ns,
+                        md5, time(), time()))
+        return Path(local_path)
+
+    def pin(self, file_path, storage, owner):
+        '''
+        Marks a file as in use (e.g. owner is the job_id), pinned files are not evicted.
+        '''
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO pins VALUES (?,?,?,?,?)',
+                       (str(file_path), str(storage), str(owner), os.getpid(), prefs['hostname']))
+
+    def unpin(self, file_path = None, storage = None, owner = None):
+        '''
+        Removes the pins of an owner (or of a file).
+        '''
+        query, args = [], []
+        for k,v in zip(['file_path','storage','owner'],[file_path, storage, owner]):
+            if not v is None:
+                query.append(f'{k} = ?')
+                args.append(str(v))
+        with self._connect() as db:
+            db.execute('DELETE FROM pins' + (' WHERE ' + ' AND '.join(query) if len(query) else ''), args)
+
+    def _remove_stale_pins(self, db):
+        # pins of processes that are no longer running on this node
+        for owner, pid, host in db.execute('SELECT DISTINCT owner, pid, host FROM pins').fetchall():
+            if host == prefs['hostname'] and not _pid_exists(pid):
+                db.execute('DELETE FROM pins WHERE owner = ? AND pid = ?',(owner, pid))
+
+    def size(self):
+        with self._connect() as db:
+            return int(db.execute('SELECT COALESCE(SUM(file_size),0) FROM files').fetchone()[0])
+
+    def evict(self, max_size = None):
+        '''
+        Deletes the least recently used unpinned files until the cache is smaller than max_size.
+        Returns the number of bytes freed.
+        '''
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+        freed = 0
+        with self._connect() as db:
+            self._remove_stale_pins(db)
+            total = int(db.execute('SELECT COALESCE(SUM(file_size),0) FROM files').fetchone()[0])
+            if total <= max_size:
+                return 0
+            candidates = db.execute('''SELECT f.file_path, f.storage, f.local_path, f.file_size FROM files f
+                                       WHERE NOT EXISTS (SELECT 1 FROM pins p WHERE p.file_path = f.file_path
+                                                         AND p.storage = f.storage)
+                                       ORDER BY f.last_access ASC''').fetchall()
+            for file_path, storage, local_path, size in candidates:
+                if total - freed <= max_size:
+                    break
+                Path(local_path).unlink(missing_ok = True)
+                db.execute('DELETE FROM files WHERE file_path = ? AND storage = ?',(file_path, storage))
+                freed += size
+        return freed
+
+    def reserve(self, nbytes):
+        '''
+        Evicts files so that nbytes fit in the budget (call before downloading).
+        '''
+        if self.max_size is None:
+            return 0
+        return self.evict(max(self.max_size - int(nbytes), 0))
+
+    def validate(self, verify_checksums = False):
+        '''
+        Removes entries of files that are missing or changed (verify_checksums also compares the md5).
+        Returns the number of removed entries.
+        '''
+        removed = 0
+        for i,f in self.to_dataframe().iterrows():
+            if self.get(f.file_path, f.storage, verify = verify_checksums) is None:
+                removed += 1
+        return removed
+
+    def purge(self, include_pinned = False):
+        '''
+        Deletes all cached files (that are not pinned). Returns the number of bytes freed.
+        '''
+        if include_pinned:
+            self.unpin()
+        return self.evict(max_size = 0)
+
+    def to_dataframe(self):
+        with self._connect() as db:
+            res = db.execute('''SELECT f.*, (SELECT COUNT(*) FROM pins p WHERE p.file_path = f.file_path
+                                AND p.storage = f.storage) FROM files f ORDER BY f.last_access DESC''').fetchall()
+        res = pd.DataFrame(res, columns = ['file_path','storage','local_path','file_size','file_mtime',
+                                           'file_md5','added','last_access','pins'])
+        for k in ['added','last_access']:
+            res[k] = pd.to_datetime(res[k], unit = 's')
+        return res
+
+    def __len__(self):
+        with self._connect() as db:
+            return db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+_scratch_caches = dict()
+def get_scratch_cache(folder = None):
+    '''
+    Returns the scratch cache of a folder (default prefs['scratch_path']), one per folder in each process
+    so all stagers share the same handle.
+    '''
+    if folder is None:
+        folder = prefs['scratch_path']
+    folder = str(Path(folder).resolve())
+    if not folder in _scratch_caches.keys():
+        _scratch_caches[folder] = ScratchCache(folder)
+    return _scratch_caches[folder]
@@ -1,12 +1,14 @@
 from ..utils import *
 from .utils import BaseCompute
+from concurrent.futures import ThreadPoolExecutor
 
 class SpksCompute(BaseCompute):
     container = 'labdata_spks'
     cuda = True
     name = 'spks'
+    allowed_extensions = ['.ap.bin'] # use the decompressed files if they are local
     url = 'http://github.com/spkware/spks'
-    def __init__(self,job_id, allow_s3 = None, delete_results = True, **kwargs):
+    def __init__(self,job_id, allow_s3 = None, delete_results = True, waveforms_layout = None, **kwargs):
         '''
 #1) find the files
 #2) copy just the file you need to scratch
@@ -27,6 +29,11 @@ class SpksCompute(BaseCompute):
         if not self.job_id is None:
             self.add_parameter_key()
         self.delete_results = delete_results
+        self.scratch_factor = 4 # scratch space needed to sort a probe (times the size of the compressed files)
+        # 'units' saves one group per unit in waveforms.hdf5, 'ragged' concatenates the units (see load_ragged_h5)
+        if waveforms_layout is None:
+            waveforms_layout = prefs['compute'].get('waveforms_layout','units')
+        self.waveforms_layout = waveforms_layout
         
     def add_parameter_key(self):
         parameter_set_num = None
@@ -120,56 +127,134 @@ class SpksCompute(BaseCompute):
             datasets += (EphysRecording()& k).proj('subject_name','session_name','dataset_name').fetch(as_dict = True)
         return datasets
         
+    def _probe_files(self, datasets, probe_num):
+        files = datasets[datasets.probe_num.values == probe_num]
+        dset = []
+        for i,f in files.iterrows():
+            if 'ap.cbin' in f.file_path:
+                dset.append(i)
+        dset = files.loc[dset]
+        if not len(dset):
+            print(files)
+            raise(ValueError(f'Could not find ap.cbin files for probe {probe_num}'))
+        return dset
+
+    def _stage_probe(self, dset, pending = None):
+        '''
+        Gets the files of a probe (runs in a thread while the previous probe is sorted).
+        If there is not enough scratch space, waits for the pending post-processing (that deletes its results),
+        then evicts unpinned files from the scratch cache; raises OSError if there is still not enough space.
+        '''
+        from time import perf_counter
+        from ..schema import File
+        from .utils import get_stager
+        import shutil
+        tstart = perf_counter()
+        if not pending is None:
+            with self._db_lock:
+                size = np.sum((File() & dset[['file_path','storage']].to_dict(orient = 'records')).fetch('file_size'))
+            needed = int(size*self.scratch_factor)
+            self.scratch_path.mkdir(parents = True, exist_ok = True)
+            if shutil.disk_usage(self.scratch_path).free < needed:
+                pending.result()
+                free = shutil.disk_usage(self.scratch_path).free
+                if free < needed:
+                    cache = get_stager(self._db_lock).cache
+                    cache.evict(max(cache.size() - (needed - free), 0))
+                    free = shutil.disk_usage(self.scratch_path).free
+                if free < needed:
+                    raise OSError(f'Not enough scratch space in {self.scratch_path} to sort the next probe '
+                                  f'({free/1024**3:.1f} GB free, {needed/1024**3:.1f} GB needed).')
+        localfiles = self.get_files(dset, allowed_extensions = self.allowed_extensions)
+        probepath = list(filter(lambda x: str(x).endswith('bin'),localfiles))
+        return probepath, perf_counter() - tstart
+
+    def _sort_probe(self, probepath):
+        '''
+        Runs the spike sorting on the GPU, returns the results folder.
+        '''
+        if self.parameters['algorithm_name'] == 'spks_kilosort2.5':      
+            from spks.sorting import ks25_run
+            results_folder = ks25_run(sessionfiles = probepath,
+                                      temporary_folder = prefs['scratch_path'],
+                                      do_post_processing = False,
+                                      motion_correction = self.parameters['motion_correction'],
+                                      thresholds = self.parameters['thresholds'],
+                                      lowpass = self.parameters['low_pass'],
+                                      highpass = self.parameters['high_pass'])
+        elif self.parameters['algorithm_name'] == 'spks_kilosort4':      
+            from spks.sorting import ks4_run
+            results_folder = ks4_run(sessionfiles = probepath,
+                                     temporary_folder = prefs['scratch_path'],
+                                     do_post_processing = False,
+                                     motion_correction = self.parameters['motion_correction'],
+                                     thresholds = self.parameters['thresholds'],
+                                     lowpass = self.parameters['low_pass'],
+                                     highpass = self.parameters['high_pass'])
+        elif self.parameters['algorithm_name'] == 'spks_mountainsort5':
+            raise(NotImplemented(f"Algorithm {self.parameters['algorithm_name']} not implemented."))
+        else:
+            raise(NotImplemented(f"Algorithm {self.parameters['algorithm_name']} not implemented."))
+        return results_folder
+
+    def _postprocess_probe(self, results_folder, probe_num):
+        '''
+        Post-processing, upload and inserts (runs in a thread while the next probe is sorted).
+        '''
+        from time import perf_counter
+        tstart = perf_counter()
+        self.postprocess_and_insert(results_folder,
+                                    probe_num = probe_num,
+                                    remove_duplicates = True,
+                                    n_pre_samples = 45)
+        if self.delete_results:
+            # delete results_folder
+            import shutil
+            shutil.rmtree(results_folder)
+        return perf_counter() - tstart
+
+    def _log_timings(self, timings, status = ''):
+        log = ' | '.join([f'probe {p}: ' + ', '.join([f'{k} {v:.0f}s' for k,v in t.items()])
+                          for p,t in timings.items() if len(t)])
+        log = f'{status} [{log}]' if len(status) else log
+        print(log, flush = True)
+        self.set_job_status(job_log = log[-1999:])
+
     def _compute(self):
+        '''
+        Sorts the probes in a pipeline:
+           - the files of probe N+1 are staged while probe N is sorted (GPU)
+           - probe N-1 is post-processed and uploaded while probe N is sorted
+        Only one probe is staged ahead and one post-processed at a time (bounds the scratch space);
+        the time of each stage is written to the job log.
+        '''
         from ..schema import EphysRecording
-        datasets = pd.DataFrame((EphysRecording.ProbeFile() & self.dataset_key).fetch())
-
-        for probe_num in np.unique(datasets.probe_num):
-            self.set_job_status(job_log = f'Sorting {probe_num}')
-            files = datasets[datasets.probe_num.values == probe_num]
-            dset = []
-            for i,f in files.iterrows():
-                if 'ap.cbin' in f.file_path:
-                    dset.append(i)
-            dset = files.loc[dset]
-            if not len(dset):
-                print(files)
-                raise(ValueError(f'Could not find ap.cbin files for probe {probe_num}'))
-            
-            localfiles = self.get_files(dset, allowed_extensions = ['.ap.bin'])
-            probepath = list(filter(lambda x: str(x).endswith('bin'),localfiles))
-            print(probepath)
-            if self.parameters['algorithm_name'] == 'spks_kilosort2.5':      
-                from spks.sorting import ks25_run
-                results_folder = ks25_run(sessionfiles = probepath,
-                                          temporary_folder = prefs['scratch_path'],
-                                          do_post_processing = False,
-                                          motion_correction = self.parameters['motion_correction'],
-                                          thresholds = self.parameters['thresholds'],
-                                          lowpass = self.parameters['low_pass'],
-                                          highpass = self.parameters['high_pass'])
-            elif self.parameters['algorithm_name'] == 'spks_kilosort4':      
-                from spks.sorting import ks4_run
-                results_folder = ks4_run(sessionfiles = probepath,
-                                         temporary_folder = prefs['scratch_path'],
-                                         do_post_processing = False,
-                                         motion_correction = self.parameters['motion_correction'],
-                                         thresholds = self.parameters['thresholds'],
-                                         lowpass = self.parameters['low_pass'],
-                                         highpass = self.parameters['high_pass'])
-            elif self.parameters['algorithm_name'] == 'spks_mountainsort5':
-                raise(NotImplemented(f"Algorithm {self.parameters['algorithm_name']} not implemented."))
-            else:
-                raise(NotImplemented(f"Algorithm {self.parameters['algorithm_name']} not implemented."))
-            self.set_job_status(job_log = f'Probe {probe_num} sorted, running post-processing.')
-            self.postprocess_and_insert(results_folder,
-                                        probe_num = probe_num,
-                                        remove_duplicates = True,
-                                        n_pre_samples = 45)
-            if self.delete_results:
-                # delete results_folder
-                import shutil
-                shutil.rmtree(results_folder)
+        from concurrent.futures import ThreadPoolExecutor
+        from time import perf_counter
+        with self._db_lock:
+            datasets = pd.DataFrame((EphysRecording.ProbeFile() & self.dataset_key).fetch())
+        probes = np.unique(datasets.probe_num)
+        dsets = [self._probe_files(datasets, probe_num) for probe_num in probes]
+        timings = {p:dict() for p in probes}
+        with ThreadPoolExecutor(max_workers = 1) as stager, ThreadPoolExecutor(max_workers = 1) as postprocessor:
+            staged = stager.submit(self._stage_probe, dsets[0])
+            post = None
+            for i, probe_num in enumerate(probes):
+                probepath, timings[probe_num]['staging'] = staged.result()
+                print(probepath)
+                if i + 1 < len(probes):  # stage the next probe while sorting
+                    staged = stager.submit(self._stage_probe, dsets[i + 1], pending = post)
+                self._log_timings(timings, f'Sorting {probe_num}')
+                tstart = perf_counter()
+                results_folder = self._sort_probe(probepath)
+                timings[probe_num]['sorting'] = perf_counter() - tstart
+                if not post is None:  # one post-processing at a time
+                    timings[probes[i - 1]]['postprocessing'] = post.result()
+                self._log_timings(timings, f'Probe {probe_num} sorted, running post-processing.')
+                post = postprocessor.submit(self._postprocess_probe, results_folder, probe_num)
+            if not post is None:
+                timings[probes[-1]]['postprocessing'] = post.result()
+        self._log_timings(timings, 'Completed')
 
     def prepare_results(self,results_folder,
                         probe_num,
@@ -195,14 +280,14 @@ class SpksCompute(BaseCompute):
                           Path(results_folder).stat().st_ctime),
                       channel_indices = clu.channel_map.flatten(),
                       channel_coords = clu.channel_positions)
-        udict = [] # unit
-        for iclu in clu.cluster_id:
-            idx = np.where(clu.spike_clusters == iclu)[0]
-            udict.append(dict(
-                base_key,unit_id = iclu,
-                spike_positions = clu.spike_positions[idx,:].astype(np.float32),
-                spike_times = clu.spike_times[idx].flatten().astype(np.uint64),
-                spike_amplitudes = clu.spike_amplitudes[idx].flatten().astype(np.float32)))
+        # sort the spikes by unit once, each unit gets views of the sorted arrays
+        unit_ids, units = group_spikes_by_unit(
+            clu.spike_clusters,
+            dict(spike_positions = clu.spike_positions.astype(np.float32),
+                 spike_times = clu.spike_times.flatten().astype(np.uint64),
+                 spike_amplitudes = clu.spike_amplitudes.flatten().astype(np.float32)),
+            unit_ids = clu.cluster_id)
+        udict = [dict(base_key, unit_id = iclu, **u) for iclu,u in zip(unit_ids,units)] # unit
             
         featurestosave = dict(template_features = clu.spike_pc_features.astype(np.float32),
                               spike_templates = clu.spike_templates,
@@ -223,9 +308,9 @@ class SpksCompute(BaseCompute):
                                                                           probe_num,
                                                                           remove_duplicates,
                                                                           n_pre_samples)
-        # save the features to a file, will take like 2 min
-        save_dict_to_h5(Path(results_folder)/'features.hdf5',featurestosave)
         n_jobs = DEFAULT_N_JOBS  # gets the default number of jobs from labdata
+        # save the features to a file (the gzip chunks are compressed in parallel)
+        save_dict_to_h5(Path(results_folder)/'features.hdf5',featurestosave, n_jobs = n_jobs)
         # extract the waveforms from the binary file
         udict, binaryfile, nchannels,res = self.extract_waveforms(udict,
                                                                   clu,
@@ -252,8 +337,11 @@ class SpksCompute(BaseCompute):
                                                  indices = u['waveform_indices'])
             else:
                 print(f"Unit {u['unit_id']} had no spikes extracted")
-        # this takes roughly 7 min per dataset because of the compression...
-        save_dict_to_h5(Path(results_folder)/'waveforms.hdf5',tosave) 
+        if self.waveforms_layout == 'ragged':
+            # one array for all units, offsets and unit_ids index the units
+            tosave = units_to_ragged(tosave)
+        # the compression is done in parallel, chunks hold whole waveforms so they can be read by spike
+        save_dict_to_h5(Path(results_folder)/'waveforms.hdf5',tosave, chunks = 'rows', n_jobs = n_jobs) 
 
         stream_name = f'imec{probe_num}' # to save the events and files
         
@@ -261,7 +349,8 @@ class SpksCompute(BaseCompute):
         dataset = dict(**self.dataset_key)
         dataset['dataset_name'] = f'spike_sorting/{stream_name}/{self.parameter_set_num}'
         from ..schema import AnalysisFile
-        filekeys = AnalysisFile().upload_files(src,dataset)
+        with self._db_lock: # this can run in a thread (see _compute)
+            filekeys = AnalysisFile().upload_files(src,dataset)
         ssdict['waveforms_file'] = filekeys[0]['file_path']
         ssdict['waveforms_storage'] = filekeys[0]['storage']
         ssdict['features_file'] = filekeys[1]['file_path']
@@ -278,39 +367,51 @@ class SpksCompute(BaseCompute):
         from ..schema import SpikeSorting, SpikeSortingParams, EphysRecording, DatasetEvents
         if len(events):
             # Add stream
-            DatasetEvents.insert1(dict(self.dataset_key,
-                                       stream_name = stream_name),
-                                       skip_duplicates = True, allow_direct_insert = True)
-            DatasetEvents.Digital.insert(events,
-                                         skip_duplicates = True,
-                                         allow_direct_insert = True)
+            with self._db_lock:
+                DatasetEvents.insert1(dict(self.dataset_key,
+                                           stream_name = stream_name),
+                                      skip_duplicates = True, allow_direct_insert = True)
+                DatasetEvents.Digital.insert(events,
+                                             skip_duplicates = True,
+                                             allow_direct_insert = True)
     
-        # inserts
-        # do all the inserts here
-        import logging
-        logging.getLogger('datajoint').setLevel(logging.WARNING)
-        # these can't be done in a safe way quickly so if they fail we have delete SpikeSorting
-        SpikeSorting.insert1(ssdict,skip_duplicates = True)
-        # Insert datajoint in parallel.
-        Parallel(n_jobs = n_jobs)(delayed(SpikeSorting.Unit.insert1)(
-            u,
-            skip_duplicates=True,
-            ignore_extra_fields = True) for u in tqdm(udict));
-        Parallel(n_jobs = n_jobs)(delayed(SpikeSorting.Waveforms.insert1)(
-            u,
-            skip_duplicates=True,
-            ignore_extra_fields = True) for u in tqdm(waves_dict));
         # Add a segment from a random location.
         from spks.io import map_binary
         dat = map_binary(binaryfile,nchannels = nchannels)
         nsamples = int(clu.sampling_rate*2)
         offset_samples = int(np.random.uniform(nsamples, len(dat)-nsamples-1))
-        SpikeSorting.Segment.insert1(dict(base_key,
-                                          segment_num = 1,
-                                          offset_samples = offset_samples,
-                                          segment = np.array(dat[offset_samples : offset_samples + nsamples])))
+        segment = np.array(dat[offset_samples : offset_samples + nsamples])
         del dat
-        self.set_job_status(job_log = f'Completed {base_key}')
+        # inserts
+        import logging
+        logging.getLogger('datajoint').setLevel(logging.WARNING)
+        from ..schema import dj
+        from ..schema.utils import bulk_insert, encode_spike_trains
+        # all spikes in one compressed row for population level fetches
+        # (encoded before taking the lock, the main thread uses the same connection)
+        spike_trains = dict(base_key,
+                            **encode_spike_trains(clu.spike_times,
+                                                  clu.spike_clusters,
+                                                  unit_ids = [u['unit_id'] for u in udict]))
+        segment_row = dict(base_key,
+                           segment_num = 1,
+                           offset_samples = offset_samples,
+                           segment = segment)
+        # do all the inserts here, in one transaction so a sorting is never half inserted
+        with self._db_lock, dj.conn().transaction:
+            SpikeSorting.insert1(ssdict,skip_duplicates = True)
+            # multi-row inserts that fit in max_allowed_packet
+            units_stats = bulk_insert(SpikeSorting.Unit, udict,
+                                      skip_duplicates = True,
+                                      ignore_extra_fields = True)
+            waves_stats = bulk_insert(SpikeSorting.Waveforms, waves_dict,
+                                      skip_duplicates = True,
+                                      ignore_extra_fields = True)
+            SpikeSorting.SpikeTrains.insert1(spike_trains, skip_duplicates = True)
+            SpikeSorting.Segment.insert1(segment_row)
+        for name,stats in zip(['units','waveforms'],[units_stats, waves_stats]):
+            print(f"Inserted {stats['rows']} {name} in {stats['batches']} inserts ({stats['rows_per_second']:.1f} rows/s)")
+        self.set_job_status(job_log = f"Completed {base_key} - inserted {units_stats['rows']} units ({units_stats['rows_per_second']:.0f} rows/s)")
 
         # extract the waveforms
     def extract_waveforms(self,udict, clu, results_folder,n_pre_samples,n_jobs):
@@ -325,6 +426,98 @@ class SpksCompute(BaseCompute):
                                         n_jobs = n_jobs)
         return udict, binaryfile, nchannels,res
         
+def sort_spikes_by_unit(spike_clusters, unit_ids = None):
+    '''
+    Sorts the spikes by unit (stable, so spikes stay in time order within each unit).
+
+    order, unit_ids, starts, stops = sort_spikes_by_unit(spike_clusters)
+
+    The spikes of unit_ids[i] are order[starts[i]:stops[i]].
+    unit_ids default to the unique values of spike_clusters; units without spikes have starts == stops.
+
+    Joao Couto - labdata 2024
+    '''
+    spike_clusters = np.asarray(spike_clusters).flatten()
+    order = np.argsort(spike_clusters, kind = 'stable')
+    sorted_clusters = spike_clusters[order]
+    if unit_ids is None:
+        unit_ids = np.unique(sorted_clusters)
+    unit_ids = np.asarray(unit_ids).flatten()
+    starts = np.searchsorted(sorted_clusters, unit_ids, side = 'left')
+    stops = np.searchsorted(sorted_clusters, unit_ids, side = 'right')
+    return order, unit_ids, starts, stops
+
+def group_spikes_by_unit(spike_clusters, arrays, unit_ids = None):
+    '''
+    Groups spike arrays by unit using one sort instead of one scan per unit.
+
+    unit_ids, units = group_spikes_by_unit(spike_clusters,
+                                           dict(spike_times = spike_times,
+                                                spike_amplitudes = spike_amplitudes),
+                                           unit_ids = cluster_id)
+
+    arrays is a dictionary of arrays with the spikes in the first dimension.
+    Returns the unit_ids and a list with a dictionary per unit; the arrays in the
+    dictionaries are views of a copy of the arrays sorted by unit.
+
+    Joao Couto - labdata 2024
+    '''
+    order, unit_ids, starts, stops = sort_spikes_by_unit(spike_clusters, unit_ids = unit_ids)
+    sorted_arrays = {k:np.asarray(v)[order] for k,v in arrays.items()}
+    units = [{k:v[start:stop] for k,v in sorted_arrays.items()} for start,stop in zip(starts,stops)]
+    return unit_ids, units
+
+def benchmark_spike_grouping(n_units = 800,
+                             n_spikes = 50000000,
+                             n_loop_units = 20,
+                             seed = 0):
+    '''
+    Compares grouping spikes by unit with one np.where per unit (as it was done in prepare_results)
+    against group_spikes_by_unit on a synthetic sorting.
+
+    res = benchmark_spike_grouping(n_units = 800, n_spikes = 50000000)
+
+    Firing rates are lognormal (few units have most spikes, like real sortings).
+    The np.where loop is timed on n_loop_units and extrapolated to all units.
+
+    Returns a pandas DataFrame with the duration (s) of each method.
+
+    Joao Couto - labdata 2024
+    '''
+    from time import perf_counter
+    rng = np.random.default_rng(seed)
+    rates = rng.lognormal(mean = 0, sigma = 1.2, size = n_units)
+    spike_clusters = rng.choice(n_units, size = n_spikes, p = rates/rates.sum()).astype(np.int32)
+    spike_times = np.sort(rng.integers(0, 30000*3600, size = n_spikes)).astype(np.uint64)
+    spike_amplitudes = rng.random(n_spikes, dtype = np.float32)
+    spike_positions = rng.random((n_spikes, 2), dtype = np.float32)
+    unit_ids = np.arange(n_units)
+    res = []
+    # per unit scans
+    tstart = perf_counter()
+    for iclu in unit_ids[:n_loop_units]:
+        idx = np.where(spike_clusters == iclu)[0]
+        tmp = (spike_positions[idx,:], spike_times[idx], spike_amplitudes[idx])
+    duration = (perf_counter() - tstart)*n_units/min(n_loop_units, n_units)
+    res.append(dict(method = 'np.where per unit (extrapolated)', n_units = n_units,
+                    n_spikes = n_spikes, duration = duration))
+    # sort based
+    tstart = perf_counter()
+    ids, units = group_spikes_by_unit(spike_clusters,
+                                      dict(spike_positions = spike_positions,
+                                           spike_times = spike_times,
+                                           spike_amplitudes = spike_amplitudes),
+                                      unit_ids = unit_ids)
+    duration = perf_counter() - tstart
+    res.append(dict(method = 'group_spikes_by_unit', n_units = n_units,
+                    n_spikes = n_spikes, duration = duration))
+    # check that the results are the same
+    for iclu in unit_ids[:n_loop_units]:
+        assert np.array_equal(units[iclu]['spike_times'], spike_times[spike_clusters == iclu])
+    res = pd.DataFrame(res)
+    res['speedup'] = res.duration.values[0]/res.duration.values
+    return res
+
 def select_random_waveforms(unit_dict,
                             wpre = 45,
                             wpost = 45,
@@ -357,19 +550,109 @@ def get_spike_waveforms(data,indices,wpre = 45,wpost = 45):
     else:
         return None
 
+def _waveform_blocks(starts, stops, max_block_samples, max_gap):
+    '''
+    Splits sorted waveform windows in blocks of contiguous samples.
+    A new block starts when the gap to the previous window is larger than max_gap
+    or the block would be larger than max_block_samples.
+    Returns a list of (first, last+1) spike indices.
+    '''
+    blocks = []
+    first = 0
+    for i in range(1,len(starts)):
+        if (starts[i] - stops[i-1] > max_gap) or (stops[i] - starts[first] > max_block_samples):
+            blocks.append((first, i))
+            first = i
+    if len(starts):
+        blocks.append((first, len(starts)))
+    return blocks
+
+def _read_samples(fd, start, stop, nchannels, dtype, nsamples):
+    '''
+    Reads samples [start, stop) of a binary file (samples x channels); out of bounds samples are zero.
+    '''
+    itemsize = np.dtype(dtype).itemsize
+    chunk = np.zeros((stop - start, nchannels), dtype = dtype)
+    s0, s1 = max(start, 0), min(stop, nsamples)
+    if s1 > s0:
+        # os.pread releases the GIL so blocks can be read in threads
+        buf = os.pread(fd, int((s1 - s0)*nchannels*itemsize), int(s0*nchannels*itemsize))
+        chunk[s0 - start:s0 - start + (s1 - s0)] = np.frombuffer(buf, dtype = dtype).reshape(-1, nchannels)
+    return chunk
+
 def get_waveforms_from_binary(binary_file,
                               binary_file_nchannels,
                               waveform_indices,
                               wpre = 45,
                               wpost = 45,
-                              n_jobs = 8):
+                              n_jobs = 8,
+                              channels = None,
+                              dtype = np.int16,
+                              block_size = 256*1024**2):
+    '''
+    Extracts the waveforms of multiple units from a binary file (samples x channels).
+
+    waves = get_waveforms_from_binary(binary_file, nchannels, [u['waveform_indices'] for u in units])
+
+    The indices of all units are sorted and the file is read in large contiguous blocks
+    (block_size bytes, in n_jobs threads); the snippets are gathered with fancy indexing
+    into one preallocated (n_spikes, wpre+wpost, n_channels) array in unit order.
+
+    channels (optional): list with the channels to extract for each unit (same number for all units,
+    e.g. the channels around the peak), this reduces the memory by nchannels/len(channels).
+
+    Returns a list with the waveforms of each unit (views of the preallocated array);
+    None for units without indices.
+
+    Joao Couto - labdata 2024
+    '''
     from tqdm import tqdm
-    from spks.io import map_binary
-    dat = map_binary(binary_file,nchannels = binary_file_nchannels)
-    res = Parallel(backend='loky',n_jobs=n_jobs)(delayed(get_spike_waveforms)(
-        dat,
-        w,
-        wpre = wpre,
-        wpost = wpost) for w in tqdm(
-            waveform_indices,desc = "Extracting waveforms"))
-    return res
+    waveform_indices = [np.asarray(w, dtype = np.int64).flatten() for w in waveform_indices]
+    counts = np.array([len(w) for w in waveform_indices], dtype = np.int64)
+    unit_offsets = np.concatenate([[0], np.cumsum(counts)])
+    nspikes = int(unit_offsets[-1])
+    nwindow = wpre + wpost
+    if channels is None:
+        nchannels_out = binary_file_nchannels
+        spike_channels = None
+    else:
+        channels = [np.asarray(c, dtype = np.int64).flatten() for c in channels]
+        nchannels_out = len(channels[0])
+        if not all([len(c) == nchannels_out for c in channels]):
+            raise ValueError('Specify the same number of channels for all units.')
+        spike_channels = np.repeat(np.stack(channels), counts, axis = 0)
+    waves = np.empty((nspikes, nwindow, nchannels_out), dtype = dtype)
+    if nspikes:
+        all_indices = np.concatenate(waveform_indices)
+        order = np.argsort(all_indices, kind = 'stable')
+        times = all_indices[order]
+        starts = times - wpre
+        stops = times + wpost
+        bytes_per_sample = binary_file_nchannels*np.dtype(dtype).itemsize
+        blocks = _waveform_blocks(starts, stops,
+                                  max_block_samples = max(int(block_size//bytes_per_sample), nwindow),
+                                  max_gap = nwindow)
+        nsamples = Path(binary_file).stat().st_size//bytes_per_sample
+        window = np.arange(nwindow, dtype = np.int64)
+        fd = os.open(binary_file, os.O_RDONLY)
+        def _extract(block):
+            i0, i1 = block
+            chunk = _read_samples(fd, int(starts[i0]), int(stops[i1-1]),
+                                  binary_file_nchannels, dtype, nsamples)
+            tidx = (starts[i0:i1] - starts[i0])[:,None] + window[None,:]
+            if spike_channels is None:
+                snippets = chunk[tidx]
+            else:
+                snippets = chunk[tidx[:,:,None], spike_channels[order[i0:i1]][:,None,:]]
+            # scatter back to the position of the spike in unit order
+            waves[order[i0:i1]] = snippets
+            return i1 - i0
+        try:
+            with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+                with tqdm(total = nspikes, desc = "Extracting waveforms") as pbar:
+                    for n in pool.map(_extract, blocks):
+                        pbar.update(n)
+        finally:
+            os.close(fd)
+    return [waves[unit_offsets[i]:unit_offsets[i+1]] if counts[i] else None
+            for i in range(len(waveform_indices))]
@@ -1,5 +1,6 @@
 from ..utils import *
 import traceback
+import threading
 
 def load_analysis_object(analysis):
     if not analysis in prefs['compute']['analysis'].keys():
@@ -45,11 +46,178 @@ def parse_analysis(analysis, job_id = None,
         # now we have the job ids, need to figure out how to launch the jobs
         return job_ids,obj.container,obj.cuda, obj.name # returns the name of the container to use and the job ids
         
+class FileStager():
+    def __init__(self, scratch_path = None, allow_s3 = None, n_jobs = DEFAULT_N_JOBS, verify = True, db_lock = None,
+                 cache = None):
+        '''
+        Finds the files of a compute task and downloads the missing ones to the scratch path,
+        in the background so the download can start before the files are needed.
+
+        stager = FileStager()
+        future = stager.stage(file_paths, storages, owner = job_id)     # returns immediately
+        ...
+        localfiles, downloaded = future.result()
+
+        The local paths are searched once for all files, then the scratch cache (see ScratchCache);
+        the missing files are downloaded in parallel (see TransferScheduler), compared with File.file_md5
+        and added to the cache. Files in the cache are pinned for the owner until cache.unpin(owner = job_id).
+        Bundles (see labdata.bundles) are replaced by the files they contain, those are fetched with range requests.
+        Stagings for other tasks (background = True, e.g. prefetching the next task) run in a separate
+        thread so they never delay the files of the running task.
+
+        Joao Couto - labdata 2024
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        from .cache import get_scratch_cache
+        if scratch_path is None:
+            scratch_path = prefs['scratch_path']
+        self.scratch_path = Path(scratch_path)
+        if allow_s3 is None:
+            allow_s3 = prefs['allow_s3_download']
+        self.allow_s3 = allow_s3
+        self.n_jobs = n_jobs
+        self.verify = verify
+        self.db_lock = threading.RLock() if db_lock is None else db_lock
+        self.cache = get_scratch_cache(self.scratch_path) if cache is None else cache
+        self.pool = ThreadPoolExecutor(max_workers = 1)  # one staging at a time (downloads use n_jobs)
+        self.background_pool = ThreadPoolExecutor(max_workers = 1)  # prefetching of other tasks
+
+    def resolve(self, files, allowed_extensions = []):
+        '''
+        Returns the local path of each file (None if it is not local); searches the local paths.
+        '''
+        return [find_local_filepath(f, allowed_extensions = allowed_extensions,
+                                    local_paths = prefs['local_paths'])
+                for f in files]
+
+    def _file_info(self, files, storages):
+        # size and md5 of the files from the database
+        from ..schema import File
+        if not len(files):
+            return [None]*len(files), [None]*len(files)
+        with self.db_lock:
+            res = (File() & [dict(file_path = f, storage = s) for f,s in zip(files, storages)]).fetch(as_dict = True)
+        info = {(r['file_path'], r['storage']):r for r in res}
+        md5 = [info[(f,s)]['file_md5'] if (f,s) in info.keys() else None for f,s in zip(files, storages)]
+        sizes = [info[(f,s)]['file_size'] if (f,s) in info.keys() else None for f,s in zip(files, storages)]
+        return md5, sizes
+
+    def _expand_bundles(self, files, storages):
+        # the bundles are replaced by the files they contain (BundledFile rows)
+        from ..bundles import is_bundle, get_bundle_members
+        if not any([is_bundle(f) for f in files]):
+            return files, storages, dict()
+        with self.db_lock:
+            members = get_bundle_members(files, storages)
+        members = {(m['file_path'], m['storage']):m for b in members.values() for m in b}
+        keep = [not is_bundle(f) for f in files]
+        files = [f for f,k in zip(files, keep) if k] + [k[0] for k in members.keys()]
+        storages = [s for s,k in zip(storages, keep) if k] + [k[1] for k in members.keys()]
+        return files, storages, members
+
+    def _from_cache(self, file_path, storage, md5, size):
+        localfile = self.cache.get(file_path, storage)
+        if localfile is None:
+            # files in the scratch path from before the cache (the size must match the database)
+            localfile = self.cache.local_path(file_path)
+            if not localfile.exists() or size is None or not localfile.stat().st_size == size:
+                return None
+            self.cache.add(file_path, storage, localfile, md5)
+        return localfile
+
+    def _stage(self, files, storages, allowed_extensions, owner = None):
+        from ..s3 import copy_from_s3
+        from ..bundles import get_bundled_files
+        files, storages, members = self._expand_bundles(files, storages)
+        bundled = lambda i: (files[i], storages[i]) in members
+        localfiles = self.resolve(files, allowed_extensions)
+        missing = [i for i,l in enumerate(localfiles) if l is None]
+        inbucket = [i for i in missing if not bundled(i)]
+        md5, sizes = self._file_info([files[i] for i in inbucket], [storages[i] for i in inbucket])
+        md5 = {i:m for i,m in zip(inbucket, md5)}
+        sizes = {i:s for i,s in zip(inbucket, sizes)}
+        for i in missing:
+            if bundled(i):
+                md5[i] = members[(files[i], storages[i])]['file_md5']
+                sizes[i] = members[(files[i], storages[i])]['file_size']
+        for i in missing:
+            localfiles[i] = self._from_cache(files[i], storages[i], md5[i], sizes[i])
+            if not owner is None and not localfiles[i] is None:
+                self.cache.pin(files[i], storages[i], owner)
+        missing = [i for i in missing if localfiles[i] is None]
+        if len(missing) and not self.allow_s3:
+            raise(ValueError(f'Files not found locally, set allow_s3 in the preferences to download: {[files[i] for i in missing]}'))
+        if len(missing):
+            # make room for the download (least recently used files that are not pinned)
+            self.cache.reserve(np.sum([sizes[i] for i in missing if not sizes[i] is None]))
+        for s in np.unique([storages[i] for i in missing]):
+            # so it can work with multiple storages
+            idx = [i for i in missing if storages[i] == s and not bundled(i)]
+            if len(idx):
+                copy_from_s3([files[i] for i in idx], [self.cache.local_path(files[i]) for i in idx],
+                             storage_name = s,
+                             n_jobs = self.n_jobs,
+                             md5_checksum = [md5[i] for i in idx] if self.verify else None)
+            members_idx = [i for i in missing if storages[i] == s and bundled(i)]
+            if len(members_idx):
+                # range requests of the bundles (the checksums of the files are compared)
+                get_bundled_files([files[i] for i in members_idx],
+                                  local_path = self.cache.folder,
+                                  storage = s,
+                                  n_jobs = self.n_jobs,
+                                  overwrite = True)
+            idx += members_idx
+            for i in idx:
+                localfiles[i] = self.cache.add(files[i], s, self.cache.local_path(files[i]), md5[i])
+                if not owner is None:
+                    self.cache.pin(files[i], s, owner)
+        return localfiles, [files[i] for i in missing]
+
+    def stage(self, files, storages, allowed_extensions = [], owner = None, background = False):
+        '''
+        Starts finding/downloading the files, returns a future with (localfiles, downloaded_files).
+        The files in the scratch cache are pinned for the owner (e.g. the job_id).
+        background = True uses the prefetch thread (for files that are not needed yet).
+        '''
+        pool = self.background_pool if background else self.pool
+        return pool.submit(self._stage, [str(f) for f in files], [str(s) for s in storages],
+                           allowed_extensions, owner)
+
+    def close(self):
+        '''
+        Stops the stager: queued stagings are cancelled, a download that already started is not interrupted.
+        '''
+        for pool in [self.pool, self.background_pool]:
+            pool.shutdown(wait = False, cancel_futures = True)
+
+def get_stager(db_lock = None):
+    '''
+    Returns a FileStager shared by the compute tasks of this process (so a task can prefetch the next).
+    db_lock is the lock of the database connection of the caller, the stager uses the lock of the last caller.
+    '''
+    global _file_stager
+    if _file_stager is None:
+        _file_stager = FileStager(db_lock = db_lock)
+    elif not db_lock is None:
+        _file_stager.db_lock = db_lock
+    return _file_stager
+
+def close_stager():
+    '''
+    Closes the FileStager of this process (see FileStager.close), get_stager creates a new one.
+    '''
+    global _file_stager
+    if not _file_stager is None:
+        _file_stager.close()
+        _file_stager = None
+_file_stager = None
+
 # this class will execute compute jobs, it should be independent from the CLI but work with it.
 class BaseCompute():
     name = None
     container = 'labdata-base'
     cuda = False
+    allowed_extensions = [] # local files that can be used instead of the files in the task (see find_local_filepath)
     def __init__(self,job_id, allow_s3 = None):
         '''
         Executes a computation on a dataset, that can be remote or local
@@ -57,10 +225,13 @@ class BaseCompute():
         '''
         self.file_filters = ['.'] # selects all files...
         self.parameters = dict()
+        # the database connection is shared, use this lock when accessing it from threads
+        self._db_lock = threading.RLock()
         
         self.job_id = job_id
         if not self.job_id is None:
             self._check_if_taken()
+        self._prefetch_next = False # set by compute, the next task is prefetched after get_files
             
         self.paths = None
         self.local_path = Path(prefs['local_paths'][0])
@@ -100,47 +271,80 @@ class BaseCompute():
                     # that should just be a problem to fix
                     raise ValueError(f'job_id {self.job_id} does not exist.')
 
+    def prefetch_files(self, dset, allowed_extensions = [], owner = None, background = False):
+        '''
+        Starts getting the files of a dataset (rows with file_path and storage) in the background.
+        Returns a future, get_files waits for it. Cached files are pinned for owner (default the job_id).
+        background = True is for files of other tasks, those do not delay the files of this task.
+        '''
+        if owner is None:
+            owner = self.job_id
+        return get_stager(self._db_lock).stage(list(dset.file_path.values), list(dset.storage.values),
+                                               allowed_extensions = allowed_extensions,
+                                               owner = owner,
+                                               background = background)
+
     def get_files(self, dset, allowed_extensions=[]):
         '''
-        Gets the paths and downloads from S3 if needed.
+        Gets the paths and downloads from S3 if needed (checksums are compared with File).
+        dset can also be a future from prefetch_files.
+
+        Files in prefs['local_paths'] are used where they are; missing files are downloaded to
+        prefs['scratch_path'] (the scratch cache), not to local_paths[0]. Use the returned paths
+        instead of looking for the inputs in the local paths.
         '''
-        
-        files = dset.file_path.values
-        storage = dset.storage.values
-        localpath = Path(prefs['local_paths'][0])
-        self.files_existed = True
-        localfiles = np.unique([find_local_filepath(f,
-                                                    allowed_extensions = allowed_extensions) for f in files])
-        if not len(localfiles):
-            # then you can try downloading the files
-            if self.allow_s3: # get the files from s3
-                from ..s3 import copy_from_s3
-                for s in np.unique(storage):
-                    # so it can work with multiple storages
-                    srcfiles = files[storage == s]
-                    dstfiles = [localpath/f for f in srcfiles]
-                    copy_from_s3(srcfiles,dstfiles,storage = s)
-                localfiles = np.unique([find_local_filepath(f,
-                                                            allowed_extensions = allowed_extensions) for f in files])
-                if len(localfiles): self.files_existed = False # delete the files in the end if they were not local.
-            else:
-                print(files, localpath)
-                raise(ValueError('Files not found locally, set allow_s3 in the preferences to download.'))
-        return localfiles
+        future = dset if hasattr(dset, 'result') else self.prefetch_files(dset, allowed_extensions)
+        localfiles, downloaded = future.result()
+        if self._prefetch_next:
+            # only after the files of this task are here (prefs['compute']['prefetch_next_task'])
+            self._prefetch_next = False
+            self.prefetch_next_task()
+        return [Path(f) for f in np.unique([str(f) for f in localfiles])]
+
+    def prefetch_task(self, job_id, allowed_extensions = []):
+        '''
+        Starts downloading the files of another compute task (e.g. the next in the queue) while this one computes.
+        '''
+        from ..schema import ComputeTask
+        with self._db_lock:
+            files = pd.DataFrame((ComputeTask.AssignedFiles() & dict(job_id = job_id)).fetch())
+        if not len(files):
+            return None
+        return self.prefetch_files(files, allowed_extensions = allowed_extensions, owner = job_id,
+                                   background = True)
 
+    def prefetch_next_task(self):
+        '''
+        Starts downloading the files of the next waiting task of the same analysis (prefs['compute']['prefetch_next_task']).
+        compute calls it after the first get_files of this task, so the downloads of this task go first.
+        '''
+        from ..schema import ComputeTask
+        with self._db_lock:
+            job_ids = (ComputeTask() & dict(task_name = self.name, task_waiting = 1) &
+                       f'job_id != {int(self.job_id)}').fetch('job_id', order_by = 'job_id', limit = 1)
+        if not len(job_ids):
+            return None
+        return self.prefetch_task(job_ids[0], allowed_extensions = self.allowed_extensions)
 
     def place_tasks_in_queue(self,datasets,task_cmd = None):
         ''' This will put the tasks in the queue for each dataset.
         If the task and parameters are the same it will return the job_id instead.
         '''
         from ..schema import ComputeTask, Dataset,dj
+        from ..bundles import get_bundle_members
         job_ids = []
+        new_tasks = []   # tasks are inserted together in the end
+        new_files = []
         for dataset in datasets:
             files = pd.DataFrame((Dataset.DataFiles() & dataset).fetch())
+            # bundles are selected by the files they contain (the stager gets the files from the bundle)
+            members = get_bundle_members(files.file_path.values, files.storage.values)
+            names = [[m['file_path'] for m in members[(p,s)]] if (p,s) in members.keys() else [p]
+                     for p,s in zip(files.file_path.values, files.storage.values)]
             idx = []
             for f in self.file_filters:
-                idx += list(filter(lambda x: not x is None,[i if f in s else None for i,s in enumerate(
-                    files.file_path.values)]))
+                idx += list(filter(lambda x: not x is None,[i if any([f in n for n in s]) else None for i,s in enumerate(
+                    names)]))
             if len(idx) == 0:
                 raise ValueError(f'Could not find valid Dataset.DataFiles for {dataset}')
             files = files.iloc[idx]
@@ -153,26 +357,19 @@ class BaseCompute():
                     print(f'There is a task to analyse dataset {key} with the same parameters. [{job_id}]')
                     job_ids.append(job_id)
             else:
-                with dj.conn().transaction:
-                    job_id = ComputeTask().fetch('job_id')
-                    if len(job_id):
-                        job_id = np.max(job_id) + 1 
-                    else:
-                        job_id = 1
-                    ComputeTask().insert1(dict(key,
-                                               job_id = job_id,
-                                               task_waiting = 1,
-                                               task_status = "WAITING",
-                                               task_target = None,
-                                               task_host = None,
-                                               task_cmd = task_cmd,
-                                               task_parameters = json.dumps(self.parameters),
-                                               task_log = None))
-                    ComputeTask.AssignedFiles().insert([dict(job_id = job_id,
-                                                             storage = f.storage,
-                                                             file_path = f.file_path)
-                                                        for i,f in files.iterrows()])
-                    job_ids.append(job_id)
+                new_tasks.append(dict(key,
+                                      task_waiting = 1,
+                                      task_status = "WAITING",
+                                      task_target = None,
+                                      task_host = None,
+                                      task_cmd = task_cmd,
+                                      task_parameters = json.dumps(self.parameters),
+                                      task_log = None))
+                new_files.append([dict(storage = f.storage,
+                                       file_path = f.file_path)
+                                  for i,f in files.iterrows()])
+        # the job ids are assigned by the database (auto_increment)
+        job_ids += ComputeTask.create_tasks(new_tasks, new_files)
         return job_ids
     
     def find_datasets(self,subject_name = None, session_name = None, dataset_name = None):
@@ -182,6 +379,13 @@ class BaseCompute():
         '''
         raise NotImplemented('The find_datasets method has to be implemented.')
         
+    def release_files(self):
+        '''
+        Unpins the files of this task in the scratch cache (they can be evicted when space is needed).
+        '''
+        if not self.job_id is None and not _file_stager is None:
+            _file_stager.cache.unpin(owner = self.job_id)
+
     def secondary_parse(self,secondary_arguments):
         if secondary_arguments is None:
             return
@@ -239,6 +443,7 @@ class BaseCompute():
         
     def compute(self):
         '''This calls the compute function. If "use_s3" is true it will download the files from s3 when needed.'''
+        self._prefetch_next = prefs['compute'].get('prefetch_next_task', False)
         try:
             self._compute() # can use the src_paths
         except Exception as err:
@@ -251,6 +456,10 @@ class BaseCompute():
                 err = err[-1900:]
             self.set_job_status(job_status = 'FAILED',job_log = f'{err}')
             return
+        finally:
+            self.release_files()
+            if not prefs['compute'].get('prefetch_next_task', False):
+                close_stager() # otherwise the files of the next task keep downloading
         self._post_compute() # so the rules can insert tables and all.
         # get the job from the DB if the status is not failed, mark completed (remember to clean the log)
         from ..schema import ComputeTask
@@ -269,7 +478,8 @@ class BaseCompute():
                 dd['task_status'] = job_status
             if not job_log is None:
                 dd['task_log'] = job_log
-            ComputeTask.update1(dd)
+            with self._db_lock:
+                ComputeTask.update1(dd)
             if not job_status is None:
                 if not 'WORK' in job_status: # display the message
                     print(f'Check job_id {self.job_id} : {job_status}')
@@ -1,11 +1,123 @@
 from .utils import *
+from .checksums import get_hasher, get_checksum_cache, DEFAULT_CHECKSUM_CHUNK_SIZE
 
-def _copyfile_to_upload_server(filepath, local_path=None, server_path = None,overwrite = False):
+DEFAULT_COPY_BUFFER_SIZE = DEFAULT_CHECKSUM_CHUNK_SIZE  # 16 MB, multiple of the page size
+
+def _fast_copyfile(src, dst):
+    '''
+    Copies a file without passing the data through python (when no checksum is needed).
+    Uses copy_file_range or sendfile when available, falls back to shutil.copyfileobj.
+    '''
+    from shutil import copyfileobj
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        for fastcopy in ['copy_file_range', 'sendfile']:
+            if not hasattr(os, fastcopy):
+                continue
+            try:
+                offset = 0
+                while offset < size:
+                    if fastcopy == 'copy_file_range':
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset)
+                    else:
+                        n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if n == 0:
+                        break
+                    offset += n
+                if offset == size:
+                    return size
+            except OSError:
+                pass  # not supported in this filesystem (e.g. network mounts), try the next
+            # start over 
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        copyfileobj(fsrc, fdst, length = DEFAULT_COPY_BUFFER_SIZE)
+        return fdst.tell()
+
+def copyfile_with_checksum(src, dst = None,
+                           algorithms = ['md5'],
+                           buffer_size = DEFAULT_COPY_BUFFER_SIZE):
+    '''
+    Copies a file and computes checksums on the same buffers that are written, 
+    so the source file is read only once. 
+
+    res = copyfile_with_checksum(src, dst, algorithms = ['md5','sha1'])
+
+    src: source file
+    dst: destination file (if None, it will only compute the checksums)
+    algorithms: list of checksum algorithms (labdata.checksums); if empty it will use a copy_file_range/sendfile fast path
+    buffer_size: size of the read buffer (page aligned)
+
+    Returns a dictionary with the checksums, the number of bytes copied, 
+    the duration of the copy (seconds) and the throughput (MB/s).
+
+    Joao Couto - labdata 2024
+    '''
+    import mmap
+    from time import perf_counter
+    tstart = perf_counter()
+    srcstat = os.stat(src)
+    if not len(algorithms) and not dst is None:
+        nbytes = _fast_copyfile(src, dst)
+        checksums = dict()
+    else:
+        hashes = {a:get_hasher(a) for a in algorithms}
+        # anonymous mmap gives a page aligned buffer that is re-used for every read
+        buf = mmap.mmap(-1, buffer_size)
+        view = memoryview(buf)
+        nbytes = 0
+        fdst = None
+        try:
+            with open(src, 'rb', buffering = 0) as fsrc:
+                if not dst is None:
+                    fdst = open(dst, 'wb', buffering = 0)
+                while True:
+                    n = fsrc.readinto(buf)
+                    if not n:
+                        break
+                    with view[:n] as chunk:
+                        for h in hashes.values():
+                            h.update(chunk)
+                        if not fdst is None:
+                            written = 0
+                            while written < n:
+                                written += fdst.write(chunk[written:])
+                    nbytes += n
+        finally:
+            if not fdst is None:
+                fdst.close()
+            view.release()
+            buf.close()
+        checksums = {a:h.hexdigest() for a,h in hashes.items()}
+    if not dst is None:
+        from shutil import copystat
+        copystat(src, dst)  # same as copy2
+    # so the source is not hashed again (e.g. by compute_md5s); the destination is not added because
+    # these are the checksums of the bytes that were read, the copy is verified by hashing it.
+    cache = get_checksum_cache() if len(checksums) else None
+    if not cache is None:
+        try:
+            for a in checksums.keys():
+                cache.put(src, a, checksums[a], stat = srcstat)
+        except Exception as err:
+            print(f'Checksum cache error: {err}')
+    duration = perf_counter() - tstart
+    return dict(checksums = checksums,
+                nbytes = nbytes,
+                duration = duration,
+                throughput = (nbytes/1024**2)/duration if duration > 0 else np.nan)
+
+def _copyfile_to_upload_server(filepath, local_path=None, server_path = None,overwrite = False,
+                               checksum_algorithms = ['md5'], verbose = True):
     '''
     This is a support function that will copy data between computers; it will not overwrite, unless forced.
     It will raise an exception if the files are already there unless overwrite is true.
     Does not insert to the Upload table.
 
+    The md5 checksum (and other checksum_algorithms) are computed while copying,
+    the file is read only once.
+
     Returns a dictionary
     Joao Couto - labdata 2024
     
@@ -16,21 +128,26 @@ def _copyfile_to_upload_server(filepath, local_path=None, server_path = None,ove
     dst = Path(server_path)/filepath
     if not overwrite and dst.exists():
         raise OSError(f'File {dst} exists; will not overwrite.')
-    
-    hash = compute_md5_hash(src)  # computes the hash
+    if not 'md5' in checksum_algorithms:
+        checksum_algorithms = ['md5'] + list(checksum_algorithms)
     srcstat = src.stat()
     file_size = srcstat.st_size
-    from shutil import copy2
     dst.parent.mkdir(parents=True, exist_ok = True)
-    if not src == dst: # if the source and destination are the same, don't copy - just return cause its nonesense..
-        try:
-            copy2(src, dst)
-        except:
-            raise OSError(f'Could not copy {src} to {dst}.')
+    if src == dst: # if the source and destination are the same, don't copy - just compute the checksum.
+        dst = None
+    try:
+        copyres = copyfile_with_checksum(src, dst, algorithms = checksum_algorithms)
+    except Exception as err:
+        raise OSError(f'Could not copy {src} to {dst}: {err}')
+    if verbose and not dst is None:
+        print(f'Copied {filepath} ({file_size/1024**2:.1f} MB) in {copyres["duration"]:.1f}s [{copyres["throughput"]:.1f} MB/s]')
     return dict(src_path = filepath,
-                src_md5 = hash,
+                src_md5 = copyres['checksums']['md5'],
                 src_size = file_size,
-                src_datetime = datetime.fromtimestamp(srcstat.st_ctime))
+                src_datetime = datetime.fromtimestamp(srcstat.st_ctime),
+                src_checksums = copyres['checksums'],
+                copy_duration = copyres['duration'],
+                copy_throughput = copyres['throughput'])
 
 
 def copy_to_upload_server(filepaths, local_path = None, server_path = None,
@@ -65,8 +182,10 @@ def copy_to_upload_server(filepaths, local_path = None, server_path = None,
     # remove trailing / or \
     filepaths = [f if not f.startswith(pathlib.os.sep) else f[1:] for f in filepaths]
 
-    if any_path_uploaded(filepaths):
-        print('Path was already uploaded {0}'.format(Path(filepaths[0]).parent))
+    known = paths_uploaded(filepaths)
+    if len(known):
+        print('Path was already uploaded {0} ({1} of {2} files)'.format(Path(filepaths[0]).parent,
+                                                                       len(known), len(filepaths)))
         return False
     
     if parse_filename: # parse filename based on the path rules
@@ -75,11 +194,17 @@ def copy_to_upload_server(filepaths, local_path = None, server_path = None,
             if not k in kwargs.keys():
                 kwargs[k] = tmp[k]
         
-    # copy and compute checksum for all paths in parallel.
+    # copy and compute checksum for all paths in parallel (files are read only once).
+    from time import perf_counter
+    tstart = perf_counter()
     res = Parallel(n_jobs = n_jobs)(delayed(_copyfile_to_upload_server)(path,
                                                                         local_path = local_path,
                                                                         server_path = server_path,
                                                                         overwrite = overwrite) for path in filepaths)
+    duration = perf_counter() - tstart
+    total_size = np.sum([r['src_size'] for r in res])
+    if duration > 0:
+        print(f'Copied {len(res)} files ({total_size/1024**3:.2f} GB) in {duration:.1f}s [{(total_size/1024**2)/duration:.1f} MB/s]')
     # Add it to the upload table
     # check the job id
     with dj.conn().transaction:
@@ -97,37 +222,52 @@ def copy_to_upload_server(filepaths, local_path = None, server_path = None,
                                         session_name = kwargs['session_name'],
                                         dataset_name = kwargs['dataset_name'])):
                 Dataset.insert1(kwargs, skip_duplicates = True,ignore_extra_fields = True) # try to insert dataset
-        jobid = UploadJob().fetch('job_id')
-        if len(jobid):
-            jobid = np.max(jobid) + 1 
-        else:
-            jobid = 1
-        UploadJob.insert1(dict(job_id = jobid, 
-                               job_status = "ON SERVER",
-                               upload_storage = upload_storage,
-                               **kwargs),
-                          ignore_extra_fields = True) # Need to insert the dataset first if not there
-        
+        # the job_id is assigned by the database (auto_increment)
+        jobid = UploadJob.create_jobs([dict(job_status = "ON SERVER",
+                                            upload_storage = upload_storage,
+                                            **kwargs)],
+                                      [res])[0] # Need to insert the dataset first if not there
         res = [dict(r, job_id = jobid) for r in res] # add dataset through kwargs
-        UploadJob.AssignedFiles.insert(res, ignore_extra_fields=True)
         # the upload server will run the checksum and upload the files.
     return res
 
+def paths_uploaded(filepaths, batch_size = 1000):
+    '''
+    known = paths_uploaded(filepaths)
+
+    Returns the paths that were already uploaded, processed, bundled or are on the upload list
+    (in the same order as filepaths).
+
+    The paths are checked in batches (batch_size paths per query), each batch is a
+    single query to the database for all tables.
+
+    '''
+    from .schema import UploadJob, File, ProcessedFile, BundledFile, dj
+    filepaths = [str(p) for p in filepaths]
+    tables = [(File().full_table_name, 'file_path'),
+              (BundledFile().full_table_name, 'file_path'),
+              (ProcessedFile().full_table_name, 'file_path'),
+              (UploadJob.AssignedFiles().full_table_name, 'src_path')]
+    unique_paths = list(dict.fromkeys(filepaths)) # unique but keep the order
+    known = set()
+    conn = dj.conn()
+    for i in range(0, len(unique_paths), batch_size):
+        batch = unique_paths[i:i + batch_size]
+        placeholders = ','.join(['%s']*len(batch))
+        # the paths are passed as arguments so they are escaped by the driver
+        sql = ' UNION '.join([f'SELECT {column} FROM {table} WHERE {column} IN ({placeholders})'
+                              for table, column in tables])
+        known.update([r[0] for r in conn.query(sql, args = batch*len(tables)).fetchall()])
+    return [p for p in filepaths if p in known]
+
 def any_path_uploaded(filepaths):
     '''
     any_path_uploaded(filepaths)
 
-    Checks if any file was already uploaded or on the upload list
+    Checks if any file was already uploaded or on the upload list (see paths_uploaded)
 
     '''
-    from .schema import UploadJob, File, ProcessedFile
-    # check if the paths are in "Upload or in Files"
-    for p in filepaths: # if true for any of the filepaths return True
-        if len((File() & f'file_path = "{p}"')) > 0 or len(UploadJob.AssignedFiles() & f'src_path = "{p}"' )>0:
-            return True
-        if len((ProcessedFile() & f'file_path = "{p}"'))>0:
-            return True
-    return False # Otherwise return False
+    return len(paths_uploaded(filepaths)) > 0
                     
 
 def process_upload_jobs(key = None, rule = 'all',n_jobs = 8):
@@ -4,19 +4,36 @@ class EphysRule(UploadRule):
     def __init__(self, job_id):
         super(EphysRule,self).__init__(job_id = job_id)
         self.rule_name = 'ephys'
+        self.bundle_small_files = False # the probe files (.meta, .ch) are referenced in File
+        self.n_jobs = DEFAULT_N_JOBS # cores for compression (shared by all files)
+        settings = (prefs.get('upload_rules') or dict()).get('ephys', dict())
+        # upload the compressed data while compressing (the .cbin is not written locally, see compress_ephys_files)
+        self.stream_upload = settings.get('stream_upload', False)
+        self.compression_check = settings.get('compression_check', 'chunks') # see compress_ephys_file
+        self.compression_check_fraction = settings.get('compression_check_fraction', 0.1)
 
     def _apply_rule(self):
         
         files_to_compress = list(filter(lambda x: '.ap.bin' in x, self.src_paths.src_path.values))
-        n_jobs = DEFAULT_N_JOBS
-        # compress these in parallel, will work for multiprobe sessions faster?
         if len(files_to_compress): # in some cases data might have already been compressed
-            res = Parallel(n_jobs = n_jobs)(delayed(compress_ephys_file)(
-                filename,
-                local_path = self.local_path,
-                n_jobs = n_jobs) for filename in files_to_compress)
+            storage = None
+            if self.stream_upload:
+                storage = prefs['storage'][self.upload_storage]
+            res, checksums, stats = compress_ephys_files(files_to_compress,
+                                                         local_path = self.local_path,
+                                                         n_jobs = self.n_jobs,
+                                                         storage = storage,
+                                                         check = self.compression_check,
+                                                         check_fraction = self.compression_check_fraction)
+            log = '; '.join([f"{Path(s['filename']).name}: {s['mb_per_s']:.0f} MB/s, ratio {s['ratio']:.2f}"
+                             for s in stats])
+            self.set_job_status(job_status = 'WORKING', job_log = log[-499:])
+            for f,s in zip(res, stats):
+                if s['streamed']:
+                    self.uploaded_paths[f[0]] = s['manifest']
             new_files = np.stack(res).flatten() # stack the resulting files and add them to the path
-            self._handle_processed_and_src_paths(files_to_compress, new_files)
+            self._handle_processed_and_src_paths(files_to_compress, new_files,
+                                                 checksums = [c for cc in checksums for c in cc])
         return self.src_paths
     
     def _post_upload(self):
@@ -28,17 +45,93 @@ class EphysRule(UploadRule):
 ############################################################################################################
 ############################################################################################################
 
+COMPRESSION_CHECKS = [None, 'sample', 'chunks', 'full']
+
+def _chunks_to_check(n_chunks, check = 'chunks', check_fraction = 0.1):
+    # chunk indices to verify after compression ('sample' always includes the first and the last chunk)
+    if check is None:
+        return set()
+    if check == 'sample':
+        step = max(int(np.round(1/max(check_fraction, 1e-6))), 1)
+        return set(range(0, n_chunks, step)) | {n_chunks - 1}
+    return set(range(n_chunks))
+
+def _get_chunk_writer():
+    from mtscomp import Writer
+    class _ChunkWriter(Writer):
+        '''
+        mtscomp Writer that writes the compressed chunks to a file-like object (a file or e.g. S3StreamingUpload)
+        and checks the chunks in memory right after they are compressed (instead of decompressing the file at the end).
+        The .cbin is the same as the one written by mtscomp.compress.
+        '''
+        def _check_chunk(self, chunk_idx, uncompressed_chunk, compressed_chunk):
+            from mtscomp import cumsum_along_axis
+            import zlib
+            chunk = np.frombuffer(zlib.decompress(compressed_chunk), dtype = self.dtype).reshape(
+                uncompressed_chunk.shape, order = self.chunk_order)
+            chunk = cumsum_along_axis(chunk, axis = 1 if self.do_spatial_diff else None)
+            chunk = cumsum_along_axis(chunk, axis = 0 if self.do_time_diff else None)
+            # exact comparison (cheaper than hashing both arrays)
+            if not np.array_equal(chunk, uncompressed_chunk):
+                raise OSError(f'Compression check failed for chunk {chunk_idx} of {self.data_path}.')
+
+        def _compress_chunk(self, chunk_idx):
+            # runs in the compression threads so the checks are also parallel
+            chunk_idx, (chunk, chunkdc) = super()._compress_chunk(chunk_idx)
+            if chunk_idx in self.chunks_to_check:
+                self._check_chunk(chunk_idx, chunk, chunkdc)
+            return chunk_idx, (chunk, chunkdc)
+
+        def write_stream(self, stream, outmeta, check = 'chunks', check_fraction = 0.1):
+            from multiprocessing.pool import ThreadPool
+            self.chunks_to_check = _chunks_to_check(self.n_chunks, check, check_fraction)
+            offset = 0
+            self.chunk_offsets = [0]
+            self.pool = ThreadPool(self.batch_size)
+            try:
+                for batch in range(self.n_batches):
+                    first_chunk = self.batch_size * batch
+                    last_chunk = min(self.batch_size * (batch + 1), self.n_chunks)
+                    compressed_chunks = self.compress_batch(first_chunk, last_chunk)
+                    for chunk_idx in sorted(compressed_chunks.keys()):
+                        uncompressed_chunk, compressed_chunk = compressed_chunks[chunk_idx]
+                        stream.write(compressed_chunk)
+                        offset += len(compressed_chunk)
+                        self.chunk_offsets.append(offset)
+                        self.sha1_uncompressed.update(uncompressed_chunk)
+                        self.sha1_compressed.update(compressed_chunk)
+            finally:
+                self.pool.close()
+                self.pool.join()
+            with open(outmeta, 'w') as fd:
+                json.dump(self.get_cmeta(), fd, indent = 2, sort_keys = True)
+            return offset / self.file_size
+    return _ChunkWriter
         
 def compress_ephys_file(filename, local_path = None, 
                         ext = '.bin',
                         n_jobs = DEFAULT_N_JOBS,
-                        check_after_compress = True):
+                        check = 'chunks',
+                        check_fraction = 0.1,
+                        stream = None):
     '''
     Compress ephys data
+
+    check: how to verify the compressed data
+       - 'chunks': each chunk is decompressed in memory right after it is compressed and compared with the original
+       - 'sample': same but only for a fraction of the chunks (check_fraction; the first and last are always checked)
+       - 'full': decompresses the whole file after compression (mtscomp check_after_compress, reads the file again)
+       - None: no verification
+    stream (optional) is a file-like object that receives the .cbin data instead of a local file 
+    (e.g. S3StreamingUpload); 'full' checks each chunk in that case.
+
+    See benchmark_compression_check to compare the modes.
     '''
     if local_path is None:
         local_path = prefs['local_paths'][0]
     local_path = Path(local_path)
+    if not check in COMPRESSION_CHECKS:
+        raise ValueError(f'Compression check {check} is not one of {COMPRESSION_CHECKS}.')
     
     from spks.spikeglx_utils import read_spikeglx_meta
     
@@ -53,15 +146,189 @@ def compress_ephys_file(filename, local_path = None,
     meta = read_spikeglx_meta(metafile)  # to get the sampling rate and nchannels
     srate = meta['sRateHz']
     nchannels = meta['nSavedChans']
-    from mtscomp import compress, decompress
     # Compress a .bin file into a pair .cbin (compressed binary file) and .ch (JSON file).
     cbin,ch = (str(binfile).replace(ext,'.cbin'),str(binfile).replace(ext,'.ch'))
-    compress(binfile, cbin, ch,
-             sample_rate = srate, n_channels = int(nchannels),
-             check_after_compress = check_after_compress,
-             chunk_duration = 1, dtype=np.int16, n_threads = n_jobs)
+    _compress_ephys_binary(binfile, cbin, ch, sample_rate = srate, n_channels = int(nchannels),
+                           n_jobs = n_jobs, check = check, check_fraction = check_fraction, stream = stream)
     return cbin.replace(str(local_path),'').strip(pathlib.os.sep),ch.replace(str(local_path),'').strip(pathlib.os.sep)
-    
+
+def _compress_ephys_binary(binfile, cbin, ch, sample_rate, n_channels, n_jobs = DEFAULT_N_JOBS,
+                           check = 'chunks', check_fraction = 0.1, stream = None, dtype = np.int16):
+    if check == 'full' and stream is None:
+        from mtscomp import compress
+        return compress(binfile, cbin, ch,
+                        sample_rate = sample_rate, n_channels = n_channels,
+                        check_after_compress = True,
+                        chunk_duration = 1, dtype = dtype, n_threads = n_jobs)
+    writer = _get_chunk_writer()(chunk_duration = 1, n_threads = n_jobs, quiet = True)
+    writer.open(binfile, sample_rate = sample_rate, n_channels = n_channels, dtype = dtype)
+    try:
+        if stream is None:
+            with open(cbin, 'wb') as fd:
+                return writer.write_stream(fd, ch, check = check, check_fraction = check_fraction)
+        return writer.write_stream(stream, ch, check = 'chunks' if check == 'full' else check,
+                                   check_fraction = check_fraction)
+    finally:
+        writer.close()
+
+def benchmark_compression_check(filename = None,
+                                sample_rate = 30000,
+                                n_channels = 385,
+                                duration = 60,
+                                checks = COMPRESSION_CHECKS,
+                                check_fraction = 0.1,
+                                n_jobs = DEFAULT_N_JOBS,
+                                folder = None):
+    '''
+    Measures the compression time (and throughput) with each verification mode (see compress_ephys_file).
+
+    res = benchmark_compression_check(duration = 120)
+
+    filename: int16 binary file to compress, if None creates a temporary file with synthetic data
+              (duration seconds of n_channels) in folder (default is the scratch_path)
+
+    Returns a pandas DataFrame.
+
+    Joao Couto - labdata 2024
+    '''
+    from time import perf_counter
+    if folder is None:
+        folder = prefs['scratch_path']
+    folder = Path(folder)
+    folder.mkdir(parents = True, exist_ok = True)
+    remove_file = False
+    if filename is None:
+        filename = folder/'labdata_compression_benchmark.bin'
+        rng = np.random.default_rng(0)
+        with open(filename,'wb') as fd:
+            for i in range(int(duration)):  # 1 second at a time, noise with slow drifts
+                data = rng.normal(0, 20, size = (int(sample_rate), n_channels)).cumsum(axis = 0)*0.05
+                data += rng.normal(0, 15, size = data.shape)
+                fd.write(data.astype(np.int16).tobytes())
+        remove_file = True
+    filename = Path(filename)
+    size = filename.stat().st_size
+    cbin, ch = folder/'labdata_compression_benchmark.cbin', folder/'labdata_compression_benchmark.ch'
+    res = []
+    try:
+        for check in checks:
+            tstart = perf_counter()
+            _compress_ephys_binary(filename, cbin, ch, sample_rate = sample_rate, n_channels = n_channels,
+                                   n_jobs = n_jobs, check = check, check_fraction = check_fraction)
+            elapsed = perf_counter() - tstart
+            res.append(dict(check = str(check),
+                            file_size = size,
+                            duration = elapsed,
+                            throughput = (size/1024**2)/elapsed,
+                            ratio = cbin.stat().st_size/size))
+    finally:
+        for f in [cbin, ch] + ([filename] if remove_file else []):
+            Path(f).unlink(missing_ok = True)
+    res = pd.DataFrame(res)
+    res['relative_duration'] = res.duration/res.duration[res.check == 'None'].values[0] if 'None' in res.check.values else np.nan
+    print(res.to_string(index = False))
+    return res
+
+def schedule_compression_threads(file_sizes, n_jobs = DEFAULT_N_JOBS):
+    '''
+    Divides n_jobs cores between files, proportionally to the file sizes (at least 1 per file),
+    so that files that are compressed at the same time do not use more than n_jobs threads.
+    With more files than cores, each file gets 1 thread and n_jobs files are compressed at a time.
+
+    Returns the number of threads for each file.
+    '''
+    sizes = np.asarray(file_sizes, dtype = float)
+    if len(sizes) >= n_jobs or not len(sizes):
+        return [1]*len(sizes)
+    share = (sizes/sizes.sum() if sizes.sum() > 0 else np.ones_like(sizes)/len(sizes))*n_jobs
+    threads = np.maximum(np.floor(share).astype(int), 1)
+    while threads.sum() > n_jobs:  # the minimum of 1 can go over the budget
+        threads[np.argmax(np.where(threads > 1, threads - share, -np.inf))] -= 1
+    while threads.sum() < n_jobs:
+        threads[np.argmax(share - threads)] += 1
+    return [int(t) for t in threads]
+
+def compress_ephys_files(filenames, local_path = None, n_jobs = DEFAULT_N_JOBS, storage = None, **kwargs):
+    '''
+    Compresses ephys files sharing n_jobs cores (see schedule_compression_threads); the largest files start first.
+    The checksums of the compressed files are computed while the other files are still compressing.
+
+    files, checksums, stats = compress_ephys_files(filenames, local_path)
+
+    When storage is specified, the compressed data are uploaded while compressing (S3StreamingUpload)
+    to the path of the .cbin and not written locally; the checksums are computed from the stream.
+    The steps after the upload then need the raw .ap.bin (e.g. EphysRecordingNoiseStats reads it),
+    and the uploaded .cbin stays in S3 if a later step of the upload job fails.
+
+    Returns for each file:
+       - the (.cbin, .ch) paths (like compress_ephys_file)
+       - the checksums of the outputs (see rules.utils._checksum_files)
+       - dict(filename, size (bytes), compressed_size, duration (s), mb_per_s, ratio, 
+              streamed, manifest (the part checksums of streamed files))
+
+    Joao Couto - labdata 2024
+    '''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from time import perf_counter
+    from .utils import _checksum_files
+    from ..s3 import S3StreamingUpload
+    if local_path is None:
+        local_path = prefs['local_paths'][0]
+    local_path = Path(local_path)
+    sizes = [(local_path/f).stat().st_size for f in filenames]
+    threads = schedule_compression_threads(sizes, n_jobs)
+    secondary = get_secondary_checksum_algorithms()
+
+    def _compress(i):
+        tstart = perf_counter()
+        if storage is None:
+            res = compress_ephys_file(filenames[i], local_path = local_path, n_jobs = threads[i], **kwargs)
+            csize, upload = (local_path/res[0]).stat().st_size, None
+        else:
+            cbin = str(filenames[i]).replace('.bin','.cbin')
+            with S3StreamingUpload(cbin, storage, checksum_algorithms = ['md5'] + secondary) as stream:
+                res = compress_ephys_file(filenames[i], local_path = local_path, n_jobs = threads[i],
+                                          stream = stream, **kwargs)
+            upload = stream.result
+            csize = upload['size']
+        duration = perf_counter() - tstart
+        return res, upload, dict(filename = filenames[i],
+                                 size = sizes[i],
+                                 compressed_size = csize,
+                                 duration = duration,
+                                 mb_per_s = sizes[i]/1024**2/max(duration, 1e-6),
+                                 ratio = csize/max(sizes[i], 1),
+                                 streamed = not upload is None,
+                                 manifest = None if upload is None else upload['manifest'])
+
+    def _streamed_checksums(i, path, upload):
+        # the .cbin is not local, the date is from the raw file (like _checksum_files)
+        return dict(src_path = path,
+                    src_md5 = upload['checksums']['md5'],
+                    src_size = upload['size'],
+                    src_datetime = datetime.fromtimestamp((local_path/filenames[i]).stat().st_ctime),
+                    **{f'src_{a}':upload['checksums'][a] for a in secondary})
+    # zlib releases the GIL, so threads are enough (mtscomp also uses threads)
+    order = np.argsort(sizes)[::-1]
+    with ThreadPoolExecutor(max_workers = min(len(filenames), n_jobs)) as compress_pool, \
+         ThreadPoolExecutor(max_workers = 1) as checksum_pool:
+        compressed = {i:compress_pool.submit(_compress, i) for i in order}
+        checksums = {}
+        for future in as_completed(compressed.values()):  # checksum each file as soon as it is compressed
+            i = [k for k,v in compressed.items() if v is future][0]
+            res, upload, stats = future.result()
+            checksums[i] = [checksum_pool.submit(_checksum_files, f, local_path = local_path)
+                            for f in (res if upload is None else res[1:])]
+            if not upload is None:
+                checksums[i].insert(0, checksum_pool.submit(_streamed_checksums, i, res[0], upload))
+        files = [compressed[i].result()[0] for i in range(len(filenames))]
+        stats = [compressed[i].result()[2] for i in range(len(filenames))]
+        checksums = [[c.result() for c in checksums[i]] for i in range(len(filenames))]
+    for s in stats:
+        print(f"Compressed {s['filename']}: {s['size']/1024**2:.0f} MB in {s['duration']:.1f}s "
+              f"({s['mb_per_s']:.0f} MB/s, ratio {s['ratio']:.2f}{', uploaded' if s['streamed'] else ''})",
+              flush = True)
+    return files, checksums, stats
 
 def get_probe_configuration(meta):
     '''
@@ -95,45 +362,327 @@ def get_probe_configuration(meta):
                 probe_recording_channels = int(meta['nSavedChans']-1))
 
 
-def ephys_noise_statistics_from_file(filepath,channel_indices, gain, sampling_rate = 30000, duration = 60):
-    '''
-    statistics = ephys_noise_statistics_from_file(filepath,channel_indices, gain, sampling_rate = 30000, duration = 60)
+EPHYS_CHUNK_CACHE_SIZE = 2*1024**3  # bytes of decompressed chunks kept in memory (shared by all readers)
 
-    Gets the noise statistics from a raw data file. It won't parse the whole file, instead it will extract 2 chunks, one 
-    from t=duration to t=duration*2 and another from t=end of recording-duration*2 to t=end of recording-duration.
-    Then computes: the peak to peak, min, max, median and absolute median deviation of those chunks.
+class CompressedEphysReader():
+    def __init__(self, filepath, chfile = None, cache = None, n_jobs = DEFAULT_N_JOBS):
+        '''
+        Random access to a compressed (mtscomp) recording, with numpy-like slicing.
 
-    This is useful just to compare the start and end of the recording or to have ballpark estimations of these values. 
-    For more accurate measurements split the recording in chunks of e.g. 1 second, compute it for the entire file, then average and std.
-    This will max if there are artifacts in the chunks. 
+        data = CompressedEphysReader('probe.imec0.ap.cbin')
+        data.shape                          # (nsamples, nchannels)
+        segment = data[30000:60000]         # decompresses only the chunks that overlap the window
+        segment = data[30000:60000, :384]   # slicing channels
+        windows = data.read_windows(onsets, 90)  # (nwindows, 90, nchannels), windows are read in parallel
 
-    Joao Couto - labdata 2024
+        The chunk index in the .ch file is used to read (os.pread) and decompress only the needed chunks.
+        Decompressed chunks are kept in a least recently used cache shared by all readers
+        (get_ephys_chunk_cache, EPHYS_CHUNK_CACHE_SIZE bytes); cache = False disables it.
+        Chunks are decompressed in a thread pool of n_jobs threads. Readers can be used from multiple threads.
+
+        Joao Couto - labdata 2024
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        self.filepath = Path(filepath)
+        if chfile is None:
+            chfile = self.filepath.with_suffix('.ch')
+        with open(chfile,'r') as fd:
+            self.cmeta = json.load(fd)
+        self.dtype = np.dtype(self.cmeta['dtype'])
+        self.n_channels = int(self.cmeta['n_channels'])
+        self.sample_rate = float(self.cmeta['sample_rate'])
+        self.chunk_bounds = np.array(self.cmeta['chunk_bounds'], dtype = np.int64)
+        self.chunk_offsets = np.array(self.cmeta['chunk_offsets'], dtype = np.int64)
+        self.n_chunks = len(self.chunk_bounds) - 1
+        self.n_samples = int(self.chunk_bounds[-1])
+        self.shape = (self.n_samples, self.n_channels)
+        self.ndim = 2
+        if cache is None:
+            cache = get_ephys_chunk_cache()
+        self.cache = cache
+        self._key = (str(self.filepath.resolve()), self.filepath.stat().st_mtime_ns)
+        self._fd = os.open(self.filepath, os.O_RDONLY)
+        self.pool = ThreadPoolExecutor(max_workers = n_jobs)
+
+    def __len__(self):
+        return self.n_samples
+
+    def _decompress_chunk(self, ichunk):
+        from mtscomp import cumsum_along_axis
+        import zlib
+        start, stop = self.chunk_offsets[ichunk], self.chunk_offsets[ichunk + 1]
+        buffer = os.pread(self._fd, int(stop - start), int(start))
+        if not len(buffer) == stop - start:
+            raise OSError(f'Could not read chunk {ichunk} of {self.filepath}.')
+        chunk = np.frombuffer(zlib.decompress(buffer), dtype = self.dtype)
+        nsamples = int(self.chunk_bounds[ichunk + 1] - self.chunk_bounds[ichunk])
+        chunk = chunk.reshape((nsamples, self.n_channels), order = self.cmeta.get('chunk_order','C'))
+        chunk = cumsum_along_axis(chunk, axis = 1 if self.cmeta['do_spatial_diff'] else None)
+        chunk = cumsum_along_axis(chunk, axis = 0 if self.cmeta['do_time_diff'] else None)
+        return np.ascontiguousarray(chunk)
+
+    def get_chunk(self, ichunk):
+        '''
+        Returns a decompressed chunk (nsamples x nchannels), from the cache if possible.
+        '''
+        if self.cache is False:
+            return self._decompress_chunk(ichunk)
+        chunk = self.cache.get(self._key + (ichunk,))
+        if chunk is None:
+            chunk = self._decompress_chunk(ichunk)
+            chunk.flags.writeable = False  # the cached chunks are shared
+            self.cache.put(self._key + (ichunk,), chunk)
+        return chunk
+
+    def get_chunks(self, chunk_indices):
+        '''
+        Returns a dictionary with the decompressed chunks, the chunks that are not cached are decompressed in parallel.
+        '''
+        chunk_indices = np.unique(chunk_indices)
+        if len(chunk_indices) == 1:
+            return {chunk_indices[0]:self.get_chunk(chunk_indices[0])}
+        return dict(zip(chunk_indices, self.pool.map(self.get_chunk, chunk_indices)))
+
+    def _chunks_for_window(self, start, stop):
+        first = int(np.searchsorted(self.chunk_bounds, start, side = 'right') - 1)
+        last = int(np.searchsorted(self.chunk_bounds, stop, side = 'left') - 1)
+        return np.arange(first, max(first, last) + 1)
+
+    def _channel_selection(self, channels):
+        # returns the channels as a slice or array and whether the channel axis is dropped (integer channel)
+        if channels is None:
+            return None, self.n_channels, False
+        if np.isscalar(channels) and np.issubdtype(type(channels), np.integer):
+            channels = np.arange(self.n_channels)[channels]  # IndexError if out of bounds, like numpy
+            return [channels], 1, True
+        return channels, len(np.arange(self.n_channels)[channels]), False
+
+    def read(self, start, stop, channels = None):
+        '''
+        Reads the samples from start to stop (stop is not included). Returns a (nsamples x nchannels) array,
+        (nsamples) if channels is an integer.
+        '''
+        channels, nchannels, drop_axis = self._channel_selection(channels)
+        res = self._read(start, stop, channels, nchannels)
+        return res[:, 0] if drop_axis else res
+
+    def _read(self, start, stop, channels, nchannels):
+        start, stop = int(max(start, 0)), int(min(stop, self.n_samples))
+        if stop <= start:
+            return np.zeros((0, nchannels), dtype = self.dtype)
+        ichunks = self._chunks_for_window(start, stop)
+        chunks = self.get_chunks(ichunks)
+        res = np.empty((stop - start, nchannels), dtype = self.dtype)
+        for ichunk in ichunks:
+            c0, c1 = self.chunk_bounds[ichunk], self.chunk_bounds[ichunk + 1]
+            i0, i1 = max(start, c0), min(stop, c1)
+            chunk = chunks[ichunk][i0 - c0:i1 - c0]
+            res[i0 - start:i1 - start] = chunk if channels is None else chunk[:, channels]
+        return res
+
+    def read_windows(self, starts, nsamples, channels = None):
+        '''
+        Reads windows of nsamples starting at each of the starts (e.g. spike times - pre samples).
+        The chunks of all windows are decompressed in parallel first.
+        Windows that extend past the recording are padded with zeros.
+        Returns a (nwindows x nsamples x nchannels) array, (nwindows x nsamples) if channels is an integer.
+        '''
+        starts = np.asarray(starts, dtype = np.int64)
+        channels, nchannels, drop_axis = self._channel_selection(channels)
+        res = np.zeros((len(starts), int(nsamples), nchannels), dtype = self.dtype)
+        if not len(starts):
+            return res[..., 0] if drop_axis else res
+        ichunks = np.unique(np.concatenate([self._chunks_for_window(max(s,0), min(s + nsamples, self.n_samples))
+                                            for s in starts]))
+        self.get_chunks(ichunks[(ichunks >= 0) & (ichunks < self.n_chunks)])  # in the cache now
+        def _read(i):
+            offset = max(-starts[i], 0)
+            data = self._read(starts[i], starts[i] + nsamples, channels, nchannels)
+            res[i, offset:offset + len(data)] = data
+        list(self.pool.map(_read, range(len(starts))))
+        return res[..., 0] if drop_axis else res
+
+    def __getitem__(self, item):
+        channels = None
+        if isinstance(item, tuple):
+            item, channels = item[0], (item[1] if len(item) > 1 else None)
+            if isinstance(channels, slice) and channels == slice(None):
+                channels = None
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.n_samples)
+            if step < 0:
+                return self[slice(stop + 1, start + 1), channels][::step]
+            data = self.read(start, stop, channels = channels)
+            return data[::step] if step > 1 else data
+        if np.isscalar(item):
+            item = int(item) + (self.n_samples if item < 0 else 0)
+            if item < 0 or item >= self.n_samples:
+                raise IndexError(f'Index {item} out of bounds for {self.n_samples} samples.')
+            return self.read(item, item + 1, channels = channels)[0]
+        # array of samples
+        item = np.asarray(item, dtype = np.int64)
+        item[item < 0] += self.n_samples
+        if np.any((item < 0) | (item >= self.n_samples)):
+            raise IndexError(f'Index out of bounds for {self.n_samples} samples.')
+        ichunks = np.searchsorted(self.chunk_bounds, item, side = 'right') - 1
+        chunks = self.get_chunks(ichunks)
+        res = np.stack([chunks[c][i - self.chunk_bounds[c]] for i,c in zip(item, ichunks)])
+        return res if channels is None else res[:, channels]
+
+    def close(self):
+        if not self._fd is None:
+            os.close(self._fd)
+            self._fd = None
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class _LockedChunkCache():
+    # least recently used cache of decompressed chunks that can be used from threads
+    def __init__(self, max_bytes):
+        import threading
+        from ..utils import _H5ArrayCache
+        self._cache = _H5ArrayCache(max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            self._cache.put(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+_ephys_chunk_cache = None
+def get_ephys_chunk_cache():
+    '''
+    Returns the cache of decompressed chunks shared by the CompressedEphysReaders of this process.
+    '''
+    global _ephys_chunk_cache
+    if _ephys_chunk_cache is None:
+        _ephys_chunk_cache = _LockedChunkCache(EPHYS_CHUNK_CACHE_SIZE)
+    return _ephys_chunk_cache
+
+def open_ephys_recording(filepath, **kwargs):
+    '''
+    Returns an array-like (nsamples x nchannels) to read a .cbin (CompressedEphysReader) or .bin (memory map) recording.
     '''
-    
     filepath = Path(filepath)
     if str(filepath).endswith('.cbin'):
-        from mtscomp import decompress
-        data = decompress(filepath) #,filepath.with_suffix('.ch'))
+        return CompressedEphysReader(filepath, **kwargs)
     elif str(filepath).endswith('.bin'):
         from spks.spikeglx_utils import load_spikeglx_binary
         data,meta = load_spikeglx_binary(filepath)
-    else:
-        raise ValueError(f'Could not handle extension: {filepath}')
-    # read the head and tail data
-    head_data = np.array(data[int(sampling_rate*duration):int(sampling_rate*duration)*2],dtype=np.float32)*gain
-    tail_data = np.array(data[-int(sampling_rate*duration)*2:-int(sampling_rate*duration)],dtype = np.float32)*gain
-    dd = [head_data,tail_data]
-
-    res = dict(channel_peak_to_peak = np.zeros((len(channel_indices),len(dd))),
-                 channel_median = np.zeros((len(channel_indices),len(dd))),
-                 channel_mad = np.zeros((len(channel_indices),len(dd))),
-                 channel_max = np.zeros((len(channel_indices),len(dd))),
-                 channel_min = np.zeros((len(channel_indices),len(dd))))
-    from scipy.stats import median_abs_deviation
-    for i,d in enumerate(dd):
-        res['channel_mad'][:,i] = median_abs_deviation(d[:,channel_indices],axis = 0) 
-        res['channel_max'][:,i] = np.max(d[:,channel_indices],axis = 0) 
-        res['channel_min'][:,i] = np.min(d[:,channel_indices],axis = 0) 
-        res['channel_median'][:,i] = np.median(d[:,channel_indices],axis = 0) 
+        return data
+    raise ValueError(f'Could not handle extension: {filepath}')
+
+def _chunk_noise_statistics(data, channel_indices, gain):
+    data = np.asarray(data[:,channel_indices], dtype = np.float32)*gain
+    median = np.median(data, axis = 0)
+    mad = np.median(np.abs(data - median), axis = 0)  # median absolute deviation
+    cmax = np.max(data, axis = 0)
+    cmin = np.min(data, axis = 0)
+    return dict(channel_median = median,
+                channel_mad = mad,
+                channel_max = cmax,
+                channel_min = cmin,
+                channel_peak_to_peak = cmax - cmin)
+
+def ephys_noise_statistics_per_chunk(filepath, channel_indices, gain,
+                                     sampling_rate = 30000,
+                                     chunk_duration = 1,
+                                     chunk_interval = None,
+                                     n_jobs = DEFAULT_N_JOBS):
+    '''
+    chunks = ephys_noise_statistics_per_chunk(filepath, channel_indices, gain, sampling_rate = 30000, chunk_duration = 1)
+
+    Walks the recording in chunks of chunk_duration seconds (every chunk_interval seconds, default all chunks)
+    and computes the median, median absolute deviation, max, min and peak to peak of each channel.
+    Chunks are read in parallel threads (for .cbin files only the compressed chunks that are needed
+    are decompressed, see CompressedEphysReader) and only 2*n_jobs chunks are in memory at a time.
+
+    Returns a dictionary with chunk_start (seconds) and the statistics (nchunks x nchannels float32 arrays).
+
+    Joao Couto - labdata 2024
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    channel_indices = np.array(channel_indices)
+    # each chunk is read once, so the decompressed chunks are not cached
+    data = open_ephys_recording(filepath, **(dict(cache = False, n_jobs = 1) if str(filepath).endswith('.cbin') else {}))
+    nsamples = data.shape[0]
+    chunk_size = int(sampling_rate*chunk_duration)
+    step = chunk_size if chunk_interval is None else int(sampling_rate*chunk_interval)
+    starts = np.arange(0, max(nsamples - chunk_size, 0) + 1, step, dtype = np.int64)
+    def _run(start):
+        return _chunk_noise_statistics(data[start:min(start + chunk_size, nsamples)],
+                                       channel_indices, gain)
+    res = dict(chunk_start = starts/sampling_rate)
+    keys = ['channel_median','channel_mad','channel_max','channel_min','channel_peak_to_peak']
+    for k in keys:
+        res[k] = np.zeros((len(starts),len(channel_indices)), dtype = np.float32)
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        pending = deque()
+        for ichunk, start in enumerate(starts):
+            pending.append((ichunk, pool.submit(_run, start)))
+            while len(pending) >= 2*n_jobs or (ichunk == len(starts) - 1 and len(pending)):
+                i, future = pending.popleft()
+                stats = future.result()
+                for k in keys:
+                    res[k][i] = stats[k]
+    if hasattr(data, 'close'):
+        data.close()
+    return res
+
+def ephys_noise_statistics_from_file(filepath,channel_indices, gain, sampling_rate = 30000, duration = 60,
+                                     chunk_duration = 1, chunk_interval = None, n_jobs = DEFAULT_N_JOBS):
+    '''
+    statistics = ephys_noise_statistics_from_file(filepath,channel_indices, gain, sampling_rate = 30000, duration = 60)
+
+    Gets the noise statistics from a raw data file, computed in chunks over the entire recording
+    (see ephys_noise_statistics_per_chunk); the statistics of each chunk are in statistics['chunks'].
+
+    The other values are nchannels*2 arrays that summarize the chunks from t=duration to t=duration*2 (1st column)
+    and from t=end of recording-duration*2 to t=end of recording-duration (2nd column):
+    the median across chunks of the median and median absolute deviation, the max, the min and the peak to peak.
+    This is useful to compare the start and end of the recording, use the chunks to look at drift and artifacts.
+
+    Joao Couto - labdata 2024
+    '''
+    chunks = ephys_noise_statistics_per_chunk(filepath, channel_indices, gain,
+                                              sampling_rate = sampling_rate,
+                                              chunk_duration = chunk_duration,
+                                              chunk_interval = chunk_interval,
+                                              n_jobs = n_jobs)
+    t = chunks['chunk_start']
+    tend = t[-1] + chunk_duration
+    selection = [(t >= duration) & (t < duration*2),
+                 (t >= tend - duration*2) & (t < tend - duration)]
+    selection = [s if np.any(s) else np.ones_like(s) for s in selection]  # short recordings use all chunks
+    res = dict(channel_peak_to_peak = np.zeros((len(channel_indices),len(selection))),
+               channel_median = np.zeros((len(channel_indices),len(selection))),
+               channel_mad = np.zeros((len(channel_indices),len(selection))),
+               channel_max = np.zeros((len(channel_indices),len(selection))),
+               channel_min = np.zeros((len(channel_indices),len(selection))))
+    for i,s in enumerate(selection):
+        res['channel_mad'][:,i] = np.median(chunks['channel_mad'][s],axis = 0)
+        res['channel_median'][:,i] = np.median(chunks['channel_median'][s],axis = 0)
+        res['channel_max'][:,i] = np.max(chunks['channel_max'][s],axis = 0)
+        res['channel_min'][:,i] = np.min(chunks['channel_min'][s],axis = 0)
         res['channel_peak_to_peak'][:,i] = res['channel_max'][:,i]-res['channel_min'][:,i]
+    res['chunks'] = chunks
     return res
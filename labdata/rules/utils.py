@@ -1,5 +1,7 @@
 from ..utils import *
 from ..s3 import copy_to_s3
+from ..checksums import compute_checksums, compute_checksums_for_files, get_secondary_checksum_algorithms, compute_chunked_checksums
+from ..bundles import select_files_to_bundle, create_file_bundles
 
 # has utilities needed by other rules
 
@@ -46,13 +48,15 @@ def _checksum_files(filepath, local_path):
     '''
     # construct the path:
     src = Path(local_path)/filepath
-    hash = compute_md5_hash(src)  # computes the hash
+    secondary = get_secondary_checksum_algorithms()
+    checksums = compute_checksums(src, algorithms = ['md5'] + secondary)  # computes the hashes
     srcstat = src.stat()
     file_size = srcstat.st_size
     return dict(src_path = filepath,
-                src_md5 = hash,
+                src_md5 = checksums['md5'],
                 src_size = file_size,
-                src_datetime = datetime.fromtimestamp(srcstat.st_ctime))
+                src_datetime = datetime.fromtimestamp(srcstat.st_ctime),
+                **{f'src_{a}':checksums[a] for a in secondary})
 
 class UploadRule():
     def __init__(self,job_id):
@@ -77,6 +81,9 @@ Can submit job on slurm, some of these can be long or take resources.
         self.dst_paths = None
         self.local_path = prefs['local_paths'][0]
         self.dataset_key = None # will get written on upload, use in _post_upload
+        self.bundle_small_files = True # pack small files in bundles if enabled in prefs['bundles']
+        self.bundled_paths = None
+        self.uploaded_paths = dict() # files the rule already uploaded (e.g. streamed while compressing) and their manifests
         
     def apply(self):
         # parse inputs
@@ -106,10 +113,15 @@ Can submit job on slurm, some of these can be long or take resources.
         
         # this should not fail because we have to keep track of errors, should update the table
         src = [Path(self.local_path) / p for p in self.src_paths.src_path.values] 
-        if not compare_md5s(src,self.src_paths.src_md5.values):
+        # the secondary checksums are computed when reading the files for the md5 comparison
+        secondary = get_secondary_checksum_algorithms()
+        checksums = compute_checksums_for_files(src, algorithms = ['md5'] + secondary)
+        if not all([c['md5'] == m for c,m in zip(checksums,self.src_paths.src_md5.values)]):
             print('CHECKSUM FAILED for {0}'.format(Path(self.src_paths.src_path.iloc[0]).parent))
             self.set_job_status(job_status = 'FAILED',job_log = 'MD5 CHECKSUM failed; check file transfer.')
             return # exit.
+        for a in secondary:
+            self.src_paths[f'src_{a}'] = [c[a] for c in checksums]
         try:
             paths = self._apply_rule() # can use the src_paths
         except Exception as err:
@@ -134,10 +146,11 @@ Can submit job on slurm, some of these can be long or take resources.
                                    job_log = job_log))
             print(f'Check job_id {self.job_id} : {job_status}')
 
-    def _handle_processed_and_src_paths(self, processed_files,new_files):
+    def _handle_processed_and_src_paths(self, processed_files,new_files, checksums = None):
         '''
         Put the files in the proper place and compute checksums for new files.
         Call this from the apply method.
+        checksums (optional) are the results of _checksum_files for the new files (if already computed).
         '''
         n_jobs = DEFAULT_N_JOBS
         self.processed_paths = []
@@ -148,38 +161,114 @@ Can submit job on slurm, some of these can be long or take resources.
             self.src_paths.reset_index(drop=True,inplace = True)
         self.processed_paths = pd.DataFrame(self.processed_paths).reset_index(drop=True)        
 
-        res = Parallel(n_jobs = n_jobs)(delayed(_checksum_files)(
-            path,
-            local_path = self.local_path) for path in new_files)
+        if checksums is None:
+            res = Parallel(n_jobs = n_jobs)(delayed(_checksum_files)(
+                path,
+                local_path = self.local_path) for path in new_files)
+        else:
+            res = [dict(r) for r in checksums]
         for r in res:
             r['job_id'] = self.job_id
         self.src_paths = pd.concat([self.src_paths,pd.DataFrame(res)], ignore_index=True)
 
+    def _compute_manifests(self):
+        '''
+        Computes the per-part checksums for large files (prefs['checksums']['manifest_min_size']).
+        '''
+        min_size = None
+        if 'checksums' in prefs.keys():
+            min_size = prefs['checksums'].get('manifest_min_size',None)
+        manifests = []
+        if min_size is None:
+            return manifests
+        for i,f in self.src_paths.iterrows():
+            if f.src_size >= min_size:
+                if f.src_path in self.uploaded_paths.keys():
+                    m = self.uploaded_paths[f.src_path]  # computed during the upload (the file may not be local)
+                    if m is None:
+                        continue
+                else:
+                    m = compute_chunked_checksums(Path(self.local_path) / f.src_path)
+                manifests.append(dict(file_path = f.src_path,
+                                      storage = self.upload_storage,
+                                      manifest_algorithm = m['algorithm'],
+                                      part_size = m['part_size'],
+                                      n_parts = m['n_parts'],
+                                      part_checksums = m['part_checksums'],
+                                      manifest_checksum = m['manifest_checksum']))
+        return manifests
+
+    def _bundle_files(self):
+        '''
+        Packs the small files in bundles (see labdata.bundles and prefs['bundles']).
+        The bundles replace the small files in src_paths, the small files go to bundled_paths.
+        '''
+        self.bundled_paths = None
+        if not self.bundle_small_files:
+            return
+        selection = select_files_to_bundle(self.src_paths.src_path.values, self.src_paths.src_size.values)
+        if not np.sum(selection):
+            return
+        bundled = self.src_paths[selection].reset_index(drop = True)
+        bundles = create_file_bundles(bundled.src_path.values, self.local_path)
+        members = []
+        for b in bundles:
+            for m in b['members']:
+                members.append(dict(src_path = m['file_path'],
+                                    bundle_path = b['bundle_path'],
+                                    member_offset = m['member_offset']))
+        self.bundled_paths = pd.merge(bundled, pd.DataFrame(members), on = 'src_path')
+        res = [_checksum_files(b['bundle_path'], local_path = self.local_path) for b in bundles]
+        for r in res:
+            r['job_id'] = self.job_id
+        self.src_paths = pd.concat([self.src_paths[~selection], pd.DataFrame(res)], ignore_index = True)
+        print(f'Packed {len(self.bundled_paths)} files in {len(bundles)} bundles.')
+
     def _post_upload(self):
         return
     
     def _upload(self):
         # this reads the attributes and uploads
         # It also puts the files in the Tables
-        
+        self._bundle_files()
         # destination in the bucket is actually the path
-        dst = [k for k in self.src_paths.src_path.values]
+        dst = [k for k in self.src_paths.src_path.values if not k in self.uploaded_paths.keys()]
         # source is the place where data are
-        src = [Path(self.local_path) / p for p in self.src_paths.src_path.values] # same as md5
+        src = [Path(self.local_path) / p for p in dst] # same as md5
         # s3 copy in parallel hashes were compared before so no need to do it now.
         copy_to_s3(src,dst,md5_checksum=None,storage_name=self.upload_storage)
-        from ..schema import UploadJob, File, dj, ProcessedFile, Dataset
+        manifests = self._compute_manifests()
+        from ..schema import UploadJob, File, FileChecksum, FileManifest, BundledFile, dj, ProcessedFile, Dataset
         with dj.conn().transaction:  # make it all update at the same time
             # insert to Files so we know where to get the data
             ins = []
+            checksums = []
             for i,f in self.src_paths.iterrows():
                 ins.append(dict(file_path = f.src_path,
                                 storage = self.upload_storage,
                                 file_datetime = f.src_datetime,
                                 file_size = f.src_size,
                                 file_md5 = f.src_md5))
-
+                for a in get_secondary_checksum_algorithms():
+                    if f'src_{a}' in f.keys() and not pd.isnull(f[f'src_{a}']):
+                        checksums.append(dict(file_path = f.src_path,
+                                              storage = self.upload_storage,
+                                              checksum_algorithm = a,
+                                              checksum = f[f'src_{a}']))
             File.insert(ins)
+            if len(checksums):
+                FileChecksum.insert(checksums)
+            if len(manifests):
+                FileManifest.insert(manifests)
+            if not self.bundled_paths is None:
+                BundledFile.insert([dict(file_path = f.src_path,
+                                         storage = self.upload_storage,
+                                         bundle_path = f.bundle_path,
+                                         bundle_storage = self.upload_storage,
+                                         member_offset = f.member_offset,
+                                         file_datetime = f.src_datetime,
+                                         file_size = f.src_size,
+                                         file_md5 = f.src_md5) for i,f in self.bundled_paths.iterrows()])
             # Add to dataset?
             job = self.jobquery.fetch(as_dict=True)[0]
             # check if it has a dataset
@@ -190,6 +279,7 @@ Can submit job on slurm, some of these can be long or take resources.
                                   dataset_name = job['dataset_name'],
                                   file_path = p['file_path'],
                                   storage = self.upload_storage)
+                # bundles are in DataFiles (it references File), the compute tasks get their files (see FileStager)
                 Dataset.DataFiles.insert(ins)
                 self.dataset_key = dict(subject_name = job['subject_name'],
                                         session_name = job['session_name'],
@@ -205,6 +295,10 @@ Can submit job on slurm, some of these can be long or take resources.
                 ProcessedFile.insert(ins)
             (UploadJob & dict(job_id = self.job_id)).delete(safemode = False)
             # completed
+        if not self.bundled_paths is None:
+            # the bundled files are still in the local path, no need to keep the bundles
+            for b in np.unique(self.bundled_paths.bundle_path.values):
+                (Path(self.local_path)/b).unlink(missing_ok = True)
         
     def _apply_rule(self):
         # this rule does nothing, so the src_paths are going to be empty,
@@ -1,14 +1,23 @@
 from .utils import *
 from minio import Minio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # put files to S3
 # download files from S3
 # move objects to old tier.
 
 __all__ = ['validate_storage',
+           'get_s3_client',
            'copyfile_to_s3',
            'copyfile_from_s3',
            'copy_to_s3',
            'copy_from_s3',
+           'multipart_upload_to_s3',
+           'multipart_download_from_s3',
+           'S3StreamingUpload',
+           'BandwidthLimiter',
+           'TransferScheduler',
+           's3_get_object_range',
            's3_delete_file']
 
 def validate_storage(storage):
@@ -49,6 +58,827 @@ def validate_storage(storage):
     return storage
 
 
+DEFAULT_S3_MAX_CONNECTIONS = 32  # connections kept open per client (storage['max_connections'] overrides)
+DEFAULT_S3_PART_SIZE = 64*1024*1024   # multipart part size (storage['part_size'] overrides)
+DEFAULT_S3_PART_CONCURRENCY = 4       # parts transfered at the same time for each object (storage['part_concurrency'])
+S3_TRANSFER_JOURNAL_FOLDER = LABDATA_FILE.parent/'transfers'  # to resume interrupted transfers
+
+_s3_clients = dict()
+_s3_clients_lock = threading.Lock()
+
+def get_s3_client(storage):
+    '''
+    client = get_s3_client(storage)
+
+    Returns a Minio client for a storage; the client is created once per process and re-used 
+    (Minio clients are thread safe). The urllib3 connection pool is sized so that all transfer 
+    threads can keep their connections open (storage['max_connections'], default 32).
+
+    Joao Couto - labdata 2024
+    '''
+    # the process id is in the key because connections can not be shared with forked processes
+    key = (os.getpid(), storage['endpoint'], storage['access_key'], storage.get('secure', True))
+    with _s3_clients_lock:
+        if not key in _s3_clients.keys():
+            import urllib3
+            import certifi
+            max_connections = storage.get('max_connections', DEFAULT_S3_MAX_CONNECTIONS)
+            http_client = urllib3.PoolManager(
+                timeout = urllib3.Timeout(connect = 300, read = 300),
+                maxsize = max_connections,
+                block = True,  # wait for a connection instead of opening (and discarding) new ones
+                cert_reqs = 'CERT_REQUIRED',
+                ca_certs = os.environ.get('SSL_CERT_FILE') or certifi.where(),
+                retries = urllib3.Retry(total = 5,
+                                        backoff_factor = 0.2,
+                                        status_forcelist = [500, 502, 503, 504]))
+            _s3_clients[key] = Minio(endpoint = storage['endpoint'],
+                                     access_key = storage['access_key'],
+                                     secret_key = storage['secret_key'],
+                                     secure = storage.get('secure', True),
+                                     http_client = http_client)
+        return _s3_clients[key]
+
+def _get_part_settings(storage, part_size = None, part_concurrency = None):
+    if part_size is None:
+        part_size = storage.get('part_size', DEFAULT_S3_PART_SIZE)
+    if part_concurrency is None:
+        part_concurrency = storage.get('part_concurrency', DEFAULT_S3_PART_CONCURRENCY)
+    # S3 parts have to be at least 5MB (except the last)
+    return max(int(part_size), 5*1024*1024), max(int(part_concurrency), 1)
+
+class _TransferJournal():
+    def __init__(self, *key):
+        '''
+        Keeps track of the completed parts of a multipart transfer in a json file 
+        (in ~/labdata/transfers) so interrupted transfers continue from the last completed part.
+        '''
+        name = hashlib.md5('|'.join([str(k) for k in key]).encode()).hexdigest()
+        self.filename = S3_TRANSFER_JOURNAL_FOLDER/f'{name}.json'
+        self.lock = threading.Lock()
+        self.data = None
+        
+    def load(self, **expected):
+        '''Loads the journal if it exists and matches the expected values (otherwise returns None)'''
+        if not self.filename.exists():
+            return None
+        try:
+            with open(self.filename,'r') as fd:
+                data = json.load(fd)
+        except Exception:
+            return None
+        for k in expected.keys():
+            if not data.get(k) == expected[k]:
+                return None
+        self.data = data
+        return data
+
+    def start(self, **values):
+        self.data = dict(values, parts = dict())
+        self.save()
+
+    def add_part(self, part_number, **values):
+        with self.lock:
+            self.data['parts'][str(part_number)] = values
+            self.save()
+
+    def save(self):
+        self.filename.parent.mkdir(parents = True, exist_ok = True)
+        tmp = self.filename.with_suffix(f'.{threading.get_ident()}.tmp')
+        with open(tmp,'w') as fd:
+            json.dump(self.data, fd)
+        os.replace(tmp, self.filename)  # atomic so the journal is never half written
+        
+    def remove(self):
+        if self.filename.exists():
+            self.filename.unlink()
+
+def _md5_to_base64(hexdigest):
+    import base64
+    return base64.b64encode(bytes.fromhex(hexdigest)).decode()
+
+class BandwidthLimiter():
+    def __init__(self, max_bandwidth = None):
+        '''
+        Limits the bandwidth used by all threads that share this object.
+        max_bandwidth is in MB/s (None for no limit).
+
+        Each transfer reserves a time slot proportional to its size and waits for the slot to start.
+        '''
+        self.max_bandwidth = max_bandwidth
+        self.rate = None if not max_bandwidth else float(max_bandwidth)*1024**2
+        self.lock = threading.Lock()
+        self.next_slot = None
+
+    def acquire(self, nbytes):
+        if self.rate is None or nbytes <= 0:
+            return
+        from time import perf_counter, sleep
+        with self.lock:
+            now = perf_counter()
+            start = now if self.next_slot is None else max(self.next_slot, now)
+            self.next_slot = start + nbytes/self.rate
+        if start > now:
+            sleep(start - now)
+
+class _ThrottledReader():
+    def __init__(self, fd, limiter = None, on_progress = None):
+        '''
+        File-like object that enforces a bandwidth limit, reports progress and computes the md5 while reading.
+        '''
+        self.fd = fd
+        self.limiter = limiter
+        self.on_progress = on_progress
+        self.md5 = hashlib.md5()
+    def read(self, size = -1):
+        data = self.fd.read(size)
+        if not self.limiter is None:
+            self.limiter.acquire(len(data))
+        self.md5.update(data)
+        if not self.on_progress is None:
+            self.on_progress(len(data))
+        return data
+
+class _MultipartUpload():
+    def __init__(self, source_file, destination_file, storage,
+                 part_size = None, resume = True, limiter = None, on_progress = None):
+        '''
+        Multipart upload of a file to S3 that can be resumed (see multipart_upload_to_s3).
+
+        upload = _MultipartUpload(source_file, destination_file, storage)
+        for part_number in upload.start():
+            upload.upload_part(part_number)  # parts can be uploaded from multiple threads
+        res = upload.complete()
+
+        '''
+        self.client = get_s3_client(storage)
+        self.bucket = storage['bucket']
+        self.part_size,_ = _get_part_settings(storage, part_size)
+        self.source_file = Path(source_file).resolve()
+        self.destination_file = destination_file
+        self.resume = resume
+        self.limiter = limiter
+        self.on_progress = on_progress
+        self.stat = self.source_file.stat()
+        self.file_size = self.stat.st_size
+        self.n_parts = max(int(np.ceil(self.file_size/self.part_size)),1)
+        self.journal = _TransferJournal('upload', storage['endpoint'], self.bucket,
+                                        destination_file, self.source_file)
+        self.upload_id = None
+
+    def start(self):
+        '''
+        Creates (or resumes) the upload; returns the part numbers that still have to be uploaded.
+        '''
+        expected = dict(file_size = self.file_size,
+                        file_mtime = self.stat.st_mtime_ns,
+                        part_size = self.part_size)
+        journal = self.journal
+        if self.resume and not journal.load(**expected) is None:
+            self.upload_id = journal.data['upload_id']
+            try: # check that the upload still exists and has the parts
+                uploaded = self._list_uploaded_parts()
+                for k in list(journal.data['parts'].keys()):
+                    if not uploaded.get(k) == journal.data['parts'][k]['etag']:
+                        journal.data['parts'].pop(k)
+                print(f"Resuming upload of {self.source_file.name} ({len(journal.data['parts'])}/{self.n_parts} parts)")
+            except Exception:
+                self.upload_id = None
+        if self.upload_id is None:
+            journal.remove()
+            self.upload_id = self.client._create_multipart_upload(self.bucket, self.destination_file,
+                                                                  {'Content-Type':'application/octet-stream'})
+            journal.start(upload_id = self.upload_id, **expected)
+        done = [p for p in range(1, self.n_parts + 1) if str(p) in journal.data['parts'].keys()]
+        if not self.on_progress is None:
+            self.on_progress(int(np.sum([self._part_length(p) for p in done])))
+        return [p for p in range(1, self.n_parts + 1) if not p in done]
+
+    def _part_length(self, part_number):
+        return min(self.part_size, self.file_size - (part_number - 1)*self.part_size)
+
+    def _list_uploaded_parts(self):
+        # the parts are listed in pages (at most 1000 parts per request)
+        uploaded, marker = dict(), None
+        while True:
+            res = self.client._list_parts(self.bucket, self.destination_file, self.upload_id,
+                                          max_parts = 1000, part_number_marker = marker)
+            uploaded.update({str(p.part_number):p.etag.strip('"') for p in res.parts})
+            if not res.is_truncated or res.next_part_number_marker is None:
+                return uploaded
+            marker = str(res.next_part_number_marker)
+        
+    def upload_part(self, part_number):
+        offset = (part_number - 1)*self.part_size
+        with open(self.source_file,'rb') as fd:
+            data = os.pread(fd.fileno(), self._part_length(part_number), offset)
+        md5 = hashlib.md5(data).hexdigest()
+        if not self.limiter is None:
+            self.limiter.acquire(len(data))
+        etag = self.client._upload_part(self.bucket, self.destination_file, data,
+                                        {'Content-MD5':_md5_to_base64(md5)},
+                                        self.upload_id, part_number)
+        if not etag.strip('"') == md5:
+            raise OSError(f'Part {part_number} of {self.source_file} checksum {md5} does not match the ETag {etag}.')
+        self.journal.add_part(part_number, etag = etag.strip('"'), md5 = md5)
+        if not self.on_progress is None:
+            self.on_progress(len(data))
+    transfer_part = upload_part
+
+    def complete(self):
+        from minio.datatypes import Part
+        from .checksums import combine_part_checksums, get_checksum_cache
+        parts = [self.journal.data['parts'][str(p)] for p in range(1, self.n_parts + 1)]
+        res = self.client._complete_multipart_upload(self.bucket, self.destination_file, self.upload_id,
+                                                     [Part(p, parts[p-1]['etag']) for p in range(1, self.n_parts + 1)])
+        manifest_checksum = combine_part_checksums([p['md5'] for p in parts])
+        if not res.etag is None and not res.etag.strip('"') == manifest_checksum:
+            raise OSError(f'Upload of {self.source_file} ETag {res.etag} does not match the parts {manifest_checksum}.')
+        self.journal.remove()
+        # the per-part checksums are the same as a manifest (labdata.checksums.compute_chunked_checksums)
+        cache = get_checksum_cache()
+        if not cache is None:
+            try:
+                cache.put(self.source_file, f'md5-parts-{self.part_size}',
+                          json.dumps(dict(algorithm = 'md5',
+                                          part_size = self.part_size,
+                                          file_size = self.file_size,
+                                          n_parts = self.n_parts,
+                                          part_checksums = [p['md5'] for p in parts],
+                                          manifest_checksum = manifest_checksum)),
+                          stat = self.stat)
+            except Exception as err:
+                print(f'Checksum cache error: {err}')
+        return res
+
+class S3StreamingUpload():
+    def __init__(self, destination_file, storage,
+                 part_size = None, part_concurrency = None, limiter = None,
+                 checksum_algorithms = ['md5']):
+        '''
+        File-like object that uploads what is written to it as the parts of a multipart upload,
+        so data can be sent while they are produced (e.g. compressed) without writing a local file.
+
+        with S3StreamingUpload('subject/session/dataset/file.cbin', storage) as stream:
+            for chunk in chunks:
+                stream.write(chunk)         # a part is sent (in a thread) each time part_size bytes are written
+        stream.result                       # size, checksums and manifest of the uploaded object
+
+        destination_file: object name in the bucket (the storage folder is added)
+        part_size: size of each part (default storage['part_size'] or 64MB)
+        part_concurrency: parts uploaded at the same time (write waits when all are busy, so memory is bounded)
+        checksum_algorithms: checksums of the whole stream (see labdata.checksums)
+
+        The md5 of each part is compared with the ETag (like multipart_upload_to_s3); streams can not be resumed,
+        the upload is aborted if there is an error.
+
+        Joao Couto - labdata 2024
+        '''
+        from .checksums import get_hasher
+        storage = validate_storage(storage)
+        self.client = get_s3_client(storage)
+        self.bucket = storage['bucket']
+        self.destination_file = _object_name(storage, destination_file)
+        self.part_size, part_concurrency = _get_part_settings(storage, part_size, part_concurrency)
+        self.limiter = limiter
+        self.hashers = {a:get_hasher(a) for a in checksum_algorithms}
+        self.buffer = bytearray()
+        self.size = 0
+        self.parts = []
+        self.pool = ThreadPoolExecutor(max_workers = part_concurrency)
+        self.slots = threading.BoundedSemaphore(part_concurrency)
+        self.upload_id = self.client._create_multipart_upload(self.bucket, self.destination_file,
+                                                              {'Content-Type':'application/octet-stream'})
+        self.result = None
+
+    def _upload_part(self, part_number, data):
+        try:
+            md5 = hashlib.md5(data).hexdigest()
+            if not self.limiter is None:
+                self.limiter.acquire(len(data))
+            etag = self.client._upload_part(self.bucket, self.destination_file, data,
+                                            {'Content-MD5':_md5_to_base64(md5)},
+                                            self.upload_id, part_number)
+            if not etag.strip('"') == md5:
+                raise OSError(f'Part {part_number} of {self.destination_file} checksum {md5} does not match the ETag {etag}.')
+            return etag.strip('"'), md5
+        finally:
+            self.slots.release()
+
+    def _send(self, data):
+        self.slots.acquire()  # waits for a free slot
+        self.parts.append(self.pool.submit(self._upload_part, len(self.parts) + 1, bytes(data)))
+        
+    def write(self, data):
+        for h in self.hashers.values():
+            h.update(data)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._send(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        '''
+        Sends the last part and completes the upload. Returns dict(size, checksums, manifest, etag).
+        '''
+        from minio.datatypes import Part
+        from .checksums import combine_part_checksums
+        if not self.result is None:
+            return self.result
+        if len(self.buffer) or not len(self.parts):
+            self._send(self.buffer)
+            self.buffer = bytearray()
+        try:
+            parts = [p.result() for p in self.parts]
+        except Exception:
+            self.abort()
+            raise
+        self.pool.shutdown()
+        res = self.client._complete_multipart_upload(self.bucket, self.destination_file, self.upload_id,
+                                                     [Part(i + 1, p[0]) for i,p in enumerate(parts)])
+        manifest_checksum = combine_part_checksums([p[1] for p in parts])
+        if not res.etag is None and not res.etag.strip('"') == manifest_checksum:
+            raise OSError(f'Upload of {self.destination_file} ETag {res.etag} does not match the parts {manifest_checksum}.')
+        self.result = dict(size = self.size,
+                           checksums = {a:h.hexdigest() for a,h in self.hashers.items()},
+                           manifest = dict(algorithm = 'md5',
+                                           part_size = self.part_size,
+                                           file_size = self.size,
+                                           n_parts = len(parts),
+                                           part_checksums = [p[1] for p in parts],
+                                           manifest_checksum = manifest_checksum),
+                           etag = res.etag)
+        return self.result
+
+    def abort(self):
+        self.pool.shutdown(cancel_futures = True)
+        try:
+            self.client._abort_multipart_upload(self.bucket, self.destination_file, self.upload_id)
+        except Exception as err:
+            print(f'Could not abort the upload of {self.destination_file}: {err}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class _MultipartDownload():
+    def __init__(self, source_file, destination_file, storage,
+                 part_size = None, resume = True, limiter = None, on_progress = None, stat = None,
+                 md5_checksum = None):
+        '''
+        Download of an object from S3 in parts (ranged requests) that can be resumed (see multipart_download_from_s3).
+        md5_checksum (optional) is the expected md5 of the file (e.g. File.file_md5).
+
+        download = _MultipartDownload(source_file, destination_file, storage)
+        for part_number in download.start():
+            download.download_part(part_number)  # parts can be downloaded from multiple threads
+        download.complete()
+        '''
+        self.client = get_s3_client(storage)
+        self.bucket = storage['bucket']
+        self.part_size,_ = _get_part_settings(storage, part_size)
+        self.source_file = source_file
+        self.destination_file = Path(destination_file).resolve()
+        self.tmpfile = self.destination_file.with_name(self.destination_file.name + '.part')
+        self.resume = resume
+        self.limiter = limiter
+        self.on_progress = on_progress
+        if stat is None:
+            stat = self.client.stat_object(self.bucket, source_file)
+        self.stat = stat
+        self.file_size = stat.size
+        self.etag = stat.etag.strip('"')
+        self.md5_checksum = md5_checksum
+        self.n_parts = max(int(np.ceil(self.file_size/self.part_size)),1)
+        self.journal = _TransferJournal('download', storage['endpoint'], self.bucket,
+                                        source_file, self.destination_file)
+
+    def start(self):
+        '''
+        Prepares (or resumes) the download; returns the part numbers that still have to be downloaded.
+        '''
+        journal = self.journal
+        expected = dict(file_size = self.file_size, etag = self.etag, part_size = self.part_size)
+        self.destination_file.parent.mkdir(parents = True, exist_ok = True)
+        if not (self.resume and self.tmpfile.exists() and not journal.load(**expected) is None):
+            journal.start(**expected)
+            with open(self.tmpfile,'wb') as fd:
+                fd.truncate(self.file_size)
+        else:
+            print(f"Resuming download of {self.destination_file.name} ({len(journal.data['parts'])}/{self.n_parts} parts)")
+        done = [p for p in range(1, self.n_parts + 1) if str(p) in journal.data['parts'].keys()]
+        if not self.on_progress is None:
+            self.on_progress(int(np.sum([self._part_length(p) for p in done])))
+        if self.file_size == 0:
+            return []
+        return [p for p in range(1, self.n_parts + 1) if not p in done]
+
+    def _part_length(self, part_number):
+        return min(self.part_size, self.file_size - (part_number - 1)*self.part_size)
+
+    def download_part(self, part_number):
+        offset = (part_number - 1)*self.part_size
+        length = self._part_length(part_number)
+        if not self.limiter is None:
+            self.limiter.acquire(length)
+        response = self.client.get_object(self.bucket, self.source_file, offset = offset, length = length)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        if not len(data) == length:
+            raise OSError(f'Part {part_number} of {self.source_file} has {len(data)} bytes, expected {length}.')
+        fd = os.open(self.tmpfile, os.O_WRONLY)
+        try:
+            written = 0
+            while written < length:
+                written += os.pwrite(fd, data[written:], offset + written)
+            os.fsync(fd)  # before the journal says it is done
+        finally:
+            os.close(fd)
+        self.journal.add_part(part_number, md5 = hashlib.md5(data).hexdigest())
+        if not self.on_progress is None:
+            self.on_progress(length)
+    transfer_part = download_part
+
+    def _uploaded_part_size(self, n_parts):
+        # part size of the upload of a multipart object (the size of part 1), None if it can not be derived
+        if n_parts == 1:
+            return max(self.file_size, 1)
+        try:
+            part_size = int(self.client.stat_object(self.bucket, self.source_file,
+                                                    extra_query_params = {'partNumber':'1'}).size)
+        except Exception as err:
+            print(f'Could not get the part size of {self.source_file}: {err}')
+            return None
+        if part_size <= 0 or not int(np.ceil(self.file_size/part_size)) == n_parts:
+            return None
+        return part_size
+
+    def complete(self):
+        from .checksums import combine_part_checksums, compute_md5_hash, compute_chunked_checksums
+        verified = False
+        if '-' in self.etag:
+            # multipart object, the ETag depends on the part size of the upload
+            part_size = self._uploaded_part_size(int(self.etag.split('-')[1]))
+            if not part_size is None:
+                if part_size == self.part_size:
+                    part_md5 = [self.journal.data['parts'][str(p)]['md5'] for p in range(1, self.n_parts + 1)]
+                else: # hash the file again with the parts of the upload
+                    part_md5 = compute_chunked_checksums(self.tmpfile, part_size = part_size,
+                                                         algorithm = 'md5', use_cache = False)['part_checksums']
+                if not combine_part_checksums(part_md5) == self.etag:
+                    raise OSError(f'Download of {self.source_file} does not match the ETag {self.etag}; the parts in {self.tmpfile} are corrupted.')
+                verified = True
+        elif len(self.etag) == 32:
+            if not compute_md5_hash(self.tmpfile) == self.etag:
+                raise OSError(f'Download of {self.source_file} does not match the ETag {self.etag}; the parts in {self.tmpfile} are corrupted.')
+            verified = True
+        if not self.md5_checksum is None and not (verified and self.md5_checksum == self.etag):
+            if not compute_md5_hash(self.tmpfile) == self.md5_checksum:
+                raise OSError(f'Download of {self.source_file} does not match the checksum {self.md5_checksum}.')
+            verified = True
+        if not verified:
+            print(f'Could not verify the download of {self.source_file} (ETag {self.etag}): the part size of the upload is unknown and no md5_checksum was given.', flush = True)
+        os.replace(self.tmpfile, self.destination_file)
+        self.journal.remove()
+        return self.stat
+
+def multipart_upload_to_s3(source_file,
+                           destination_file,
+                           storage,
+                           part_size = None,
+                           part_concurrency = None,
+                           resume = True):
+    '''
+    Uploads a file to S3 in parts, multiple parts of the file are sent at the same time.
+
+    res = multipart_upload_to_s3(source_file, destination_file, storage, part_size = 128*1024**2)
+
+    source_file: local file path
+    destination_file: object name in the bucket (the storage folder is not added here)
+    part_size: size of each part (default storage['part_size'] or 64MB)
+    part_concurrency: parts to upload at the same time (default storage['part_concurrency'] or 4)
+    resume: continue an interrupted upload of the same (unchanged) file
+
+    The md5 of each part is sent (Content-MD5) and compared with the ETag returned by S3, 
+    the ETag of the object is compared with the md5 of the part checksums.
+    The completed parts are written to a journal in ~/labdata/transfers.
+
+    Joao Couto - labdata 2024
+    '''
+    part_size, part_concurrency = _get_part_settings(storage, part_size, part_concurrency)
+    upload = _MultipartUpload(source_file, destination_file, storage,
+                              part_size = part_size, resume = resume)
+    todo = upload.start()
+    with ThreadPoolExecutor(max_workers = part_concurrency) as pool:
+        list(pool.map(upload.upload_part, todo))
+    return upload.complete()
+
+def multipart_download_from_s3(source_file,
+                               destination_file,
+                               storage,
+                               part_size = None,
+                               part_concurrency = None,
+                               resume = True):
+    '''
+    Downloads an object from S3 using ranged requests, multiple parts are downloaded at the same time.
+
+    multipart_download_from_s3(source_file, destination_file, storage)
+
+    source_file: object name in the bucket (the storage folder is not added here)
+    destination_file: local file path
+    part_size: size of each part (default storage['part_size'] or 64MB)
+    part_concurrency: parts to download at the same time (default storage['part_concurrency'] or 4)
+    resume: continue an interrupted download of the same object (the data are in destination_file.part)
+
+    The size of each part is verified and the ETag is compared with the checksums of the file;
+    for multipart objects the part size of the upload is taken from the object (the size of part 1),
+    if it can not be derived a warning is printed (see md5_checksum of _MultipartDownload).
+
+    Joao Couto - labdata 2024
+    '''
+    part_size, part_concurrency = _get_part_settings(storage, part_size, part_concurrency)
+    download = _MultipartDownload(source_file, destination_file, storage,
+                                  part_size = part_size, resume = resume)
+    todo = download.start()
+    with ThreadPoolExecutor(max_workers = part_concurrency) as pool:
+        list(pool.map(download.download_part, todo))
+    return download.complete()
+
+def _object_name(storage, path):
+    path = str(path)
+    if 'folder' in storage.keys():
+        if len(storage['folder']):
+            return storage['folder'] + '/' + path
+    return path
+
+class TransferScheduler():
+    def __init__(self, storage,
+                 n_jobs = DEFAULT_N_JOBS,
+                 max_bandwidth = None,
+                 part_size = None,
+                 max_files_per_batch = 64,
+                 progress = True,
+                 on_progress = None):
+        '''
+        Schedules transfers to and from S3 on a pool of threads.
+
+        scheduler = TransferScheduler(storage, n_jobs = 8, max_bandwidth = 50)
+        res = scheduler.upload(source_files, destination_files)
+        print(scheduler.metrics())
+
+        - transfers are ordered by size (largest first)
+        - objects larger than the part size are split into parts (multipart, resumable)
+          and the parts are distributed across threads
+        - small objects are packed in batches of about one part size, so threads
+          are not scheduled for each small file
+        - all transfers share a bandwidth budget (max_bandwidth in MB/s, default storage['max_bandwidth'])
+        - progress is displayed with tqdm and metrics() returns the throughput
+
+        storage: the storage dictionary
+        n_jobs: number of concurrent transfers (connections)
+        part_size: size of the parts (default storage['part_size'] or 64MB)
+        on_progress: function called with (bytes_transferred, total_bytes)
+
+        Joao Couto - labdata 2024
+        '''
+        self.storage = storage
+        self.client = get_s3_client(storage)
+        self.n_jobs = n_jobs
+        self.part_size,_ = _get_part_settings(storage, part_size)
+        if max_bandwidth is None:
+            max_bandwidth = storage.get('max_bandwidth', None)
+        self.limiter = BandwidthLimiter(max_bandwidth)
+        self.max_files_per_batch = max_files_per_batch
+        self.progress = progress
+        self.on_progress = on_progress
+        self.lock = threading.Lock()
+        self._reset(0, 0)
+
+    def _reset(self, total_bytes, n_files):
+        from time import perf_counter
+        self.total_bytes = total_bytes
+        self.transferred_bytes = 0
+        self.n_files = n_files
+        self.completed_files = 0
+        self.failed = dict()
+        self.tstart = perf_counter()
+        self.tstop = None
+        self.pbar = None
+
+    def _update(self, nbytes):
+        with self.lock:
+            self.transferred_bytes += nbytes
+            if not self.pbar is None:
+                self.pbar.update(nbytes)
+        if not self.on_progress is None:
+            self.on_progress(self.transferred_bytes, self.total_bytes)
+
+    def _file_done(self):
+        with self.lock:
+            self.completed_files += 1
+
+    def metrics(self):
+        '''
+        Returns the number of bytes and files transferred, the elapsed time and the throughput (MB/s)
+        '''
+        from time import perf_counter
+        elapsed = (self.tstop if not self.tstop is None else perf_counter()) - self.tstart
+        return dict(total_bytes = self.total_bytes,
+                    transferred_bytes = self.transferred_bytes,
+                    n_files = self.n_files,
+                    completed_files = self.completed_files,
+                    failed_files = len(self.failed),
+                    elapsed = elapsed,
+                    throughput = (self.transferred_bytes/1024**2)/elapsed if elapsed > 0 else 0)
+
+    def _run(self, files, sizes, make_multipart, transfer_small, desc):
+        '''
+        files is a list of (src, dst) and sizes the size of each file.
+        make_multipart(i) returns a multipart transfer for large files,
+        transfer_small(i) transfers a small file and returns the result.
+        '''
+        from tqdm import tqdm
+        from time import perf_counter
+        self._reset(int(np.sum(sizes)) if len(sizes) else 0, len(files))
+        results = [None]*len(files)
+        order = np.argsort(sizes, kind = 'stable')[::-1]  # largest first
+        large = [i for i in order if sizes[i] > self.part_size]
+        small = [i for i in order if sizes[i] <= self.part_size]
+        # pack small files in batches of about part_size
+        batches, batch, batch_size = [], [], 0
+        for i in small:
+            if len(batch) and (batch_size + sizes[i] > self.part_size or
+                               len(batch) >= self.max_files_per_batch):
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(i)
+            batch_size += sizes[i]
+        if len(batch):
+            batches.append(batch)
+
+        def _small_batch(batch):
+            for i in batch:
+                try:
+                    results[i] = transfer_small(i)
+                    self._file_done()
+                except Exception as err:
+                    self.failed[i] = err
+        remaining = dict()
+        def _complete(i, transfer):
+            try:
+                results[i] = transfer.complete()
+                self._file_done()
+            except Exception as err:
+                self.failed[i] = err
+        def _part(i, transfer, part_number):
+            if i in self.failed.keys():
+                return  # another part failed; the completed parts are in the journal
+            try:
+                transfer.transfer_part(part_number)
+            except Exception as err:
+                self.failed[i] = err
+                return
+            with self.lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                _complete(i, transfer)
+
+        if self.progress:
+            self.pbar = tqdm(total = self.total_bytes, unit = 'B', unit_scale = True, desc = desc)
+        try:
+            with ThreadPoolExecutor(max_workers = self.n_jobs) as pool:
+                futures = []
+                for i in large:
+                    try:
+                        transfer = make_multipart(i)
+                        todo = transfer.start()
+                    except Exception as err:
+                        self.failed[i] = err
+                        continue
+                    remaining[i] = len(todo)
+                    if not len(todo):
+                        futures.append(pool.submit(_complete, i, transfer))
+                    for part_number in todo:
+                        futures.append(pool.submit(_part, i, transfer, part_number))
+                for batch in batches:
+                    futures.append(pool.submit(_small_batch, batch))
+                for f in futures:
+                    f.result()
+        finally:
+            self.tstop = perf_counter()
+            if not self.pbar is None:
+                self.pbar.close()
+                self.pbar = None
+        if len(self.failed):
+            msg = '\n'.join([f'{files[i][0]}: {self.failed[i]}' for i in self.failed.keys()])
+            raise OSError(f'Failed to transfer {len(self.failed)} files (completed parts can be resumed):\n{msg}')
+        return results
+
+    def upload(self, source_files, destination_files, md5_checksum = None):
+        '''
+        Uploads files to S3; destination_files are the paths in the bucket (the storage folder is added).
+        md5_checksum (optional) is compared with the local files before the upload.
+        Returns the upload result for each file.
+        '''
+        bucket = self.storage['bucket']
+        files = [(Path(src), _object_name(self.storage, dst)) for src,dst in zip(source_files, destination_files)]
+        sizes = [src.stat().st_size for src,dst in files]
+        if not md5_checksum is None:
+            for (src,dst),md5 in zip(files,md5_checksum):
+                if not md5 is None and not md5 == compute_md5_hash(src):
+                    raise OSError(f'Checksum {md5} does not match {src}.')
+        def _multipart(i):
+            return _MultipartUpload(files[i][0], files[i][1], self.storage,
+                                    part_size = self.part_size,
+                                    limiter = self.limiter,
+                                    on_progress = self._update)
+        def _small(i):
+            src, dst = files[i]
+            with open(src,'rb') as fd:
+                reader = _ThrottledReader(fd, self.limiter, self._update)
+                res = self.client.put_object(bucket, dst, reader, length = sizes[i])
+            etag = res.etag.strip('"') if not res.etag is None else ''
+            if len(etag) == 32 and not etag == reader.md5.hexdigest():
+                raise OSError(f'Upload of {src} ETag {etag} does not match the md5 {reader.md5.hexdigest()}.')
+            return res
+        return self._run(files, sizes, _multipart, _small, desc = 'Uploading')
+
+    def _object_stats(self, objects):
+        '''
+        Gets the size and ETag of the objects listing the folders (one request per folder instead of per object).
+        '''
+        bucket = self.storage['bucket']
+        stats = dict()
+        folders = np.unique([str(Path(o).parent) for o in objects])
+        for folder in folders:
+            prefix = '' if folder == '.' else folder + '/'
+            for obj in self.client.list_objects(bucket, prefix = prefix, recursive = False):
+                if not obj.is_dir:
+                    stats[obj.object_name] = obj
+        for o in objects:
+            if not o in stats.keys():
+                stats[o] = self.client.stat_object(bucket, o)  # raises if the object does not exist
+        return [stats[o] for o in objects]
+
+    def download(self, source_files, destination_files, md5_checksum = None):
+        '''
+        Downloads files from S3; source_files are the paths in the bucket (the storage folder is added).
+        md5_checksum (optional) are the expected md5 of the files (e.g. File.file_md5),
+        small files are checked while downloading.
+        Returns the object stat for each file.
+        '''
+        bucket = self.storage['bucket']
+        files = [(_object_name(self.storage, src), Path(dst)) for src,dst in zip(source_files, destination_files)]
+        objects = self._object_stats([src for src,dst in files])
+        sizes = [int(o.size) for o in objects]
+        if md5_checksum is None:
+            md5_checksum = [None]*len(files)
+        def _multipart(i):
+            return _MultipartDownload(files[i][0], files[i][1], self.storage,
+                                      part_size = self.part_size,
+                                      limiter = self.limiter,
+                                      on_progress = self._update,
+                                      stat = objects[i],
+                                      md5_checksum = md5_checksum[i])
+        def _small(i):
+            src, dst = files[i]
+            dst.parent.mkdir(parents = True, exist_ok = True)
+            tmpfile = dst.with_name(dst.name + '.part')
+            md5 = hashlib.md5()
+            response = self.client.get_object(bucket, src)
+            try:
+                with open(tmpfile,'wb') as fd:
+                    for data in response.stream(1024*1024):
+                        self.limiter.acquire(len(data))
+                        md5.update(data)
+                        fd.write(data)
+                        self._update(len(data))
+            finally:
+                response.close()
+                response.release_conn()
+            etag = objects[i].etag.strip('"')
+            if len(etag) == 32 and not etag == md5.hexdigest():
+                raise OSError(f'Download of {src} does not match the ETag {etag}.')
+            if not md5_checksum[i] is None and not md5_checksum[i] == md5.hexdigest():
+                raise OSError(f'Download of {src} does not match the checksum {md5_checksum[i]}.')
+            os.replace(tmpfile, dst)
+            return objects[i]
+        return self._run(files, sizes, _multipart, _small, desc = 'Downloading')
+
 def copyfile_to_s3(source_file,
                    destination_file,
                    storage,
@@ -59,9 +889,7 @@ def copyfile_to_s3(source_file,
     Joao Couto - 2024
     '''
     
-    client = Minio(endpoint = storage['endpoint'],
-                   access_key = storage['access_key'],
-                   secret_key = storage['secret_key'])
+    client = get_s3_client(storage)
 
     if 'folder' in storage.keys():
         if len(storage['folder']):
@@ -70,6 +898,12 @@ def copyfile_to_s3(source_file,
     if not md5_checksum is None:
         if not md5_checksum == compute_md5_hash(source_file):
             raise OSError(f'Checksum {md5_checksum} does not match {source_file}.')
+    part_size, part_concurrency = _get_part_settings(storage)
+    if Path(source_file).stat().st_size > part_size:
+        # large files are sent in parts, in parallel and can be resumed
+        return multipart_upload_to_s3(source_file, destination_file, storage,
+                                      part_size = part_size,
+                                      part_concurrency = part_concurrency)
     res = client.fput_object(
         storage['bucket'], destination_file, source_file)
     return res
@@ -78,10 +912,12 @@ def copy_to_s3(source_files, destination_files,
                storage = None,
                storage_name = None,
                md5_checksum = None,
-               n_jobs = DEFAULT_N_JOBS):
+               n_jobs = DEFAULT_N_JOBS,
+               max_bandwidth = None):
     '''
     Copy S3 and do a checksum comparisson.
-    Copy occurs in parallel for multiple files.
+    Copy occurs in parallel for multiple files (see TransferScheduler);
+    max_bandwidth (MB/s) limits the bandwidth used by all transfers.
 
     Joao Couto - 2024
     '''
@@ -99,14 +935,11 @@ def copy_to_s3(source_files, destination_files,
     # Check if the source and the destination are the correct sizes
     assert len(source_files) == len(destination_files),ValueError('source and destination are the wrong size')
     
-    if md5_checksum is None:
-        md5_checksum = [None]*len(source_files)
-        
-    res = Parallel(n_jobs = n_jobs)(delayed(copyfile_to_s3)(src,
-                                                            dst,
-                                                            storage = storage,
-                                                            md5_checksum = md5)
-                                    for src,dst,md5 in zip(source_files,destination_files,md5_checksum))
+    # threads share the same client (and connections); large files are split in parts
+    scheduler = TransferScheduler(storage, n_jobs = n_jobs, max_bandwidth = max_bandwidth)
+    res = scheduler.upload(source_files, destination_files, md5_checksum = md5_checksum)
+    m = scheduler.metrics()
+    print(f"Uploaded {m['completed_files']} files ({m['transferred_bytes']/1024**3:.2f} GB) in {m['elapsed']:.1f}s [{m['throughput']:.1f} MB/s]")
     return res
 
 def copyfile_from_s3(source_file,
@@ -114,19 +947,23 @@ def copyfile_from_s3(source_file,
                      storage,
                      md5_checksum = None):
     '''
-    Copy a single file to S3 and do a checksum comparisson.
+    Copy a single file from S3.
+    Objects larger than the part size are downloaded in parallel parts (and can be resumed).
 
     Joao Couto - 2024
     '''
     
-    client = Minio(endpoint = storage['endpoint'],
-                   access_key = storage['access_key'],
-                   secret_key = storage['secret_key'])
+    client = get_s3_client(storage)
 
     if 'folder' in storage.keys():
-        if len(storage['folder']):
-            destination_file = storage['folder'] + '/' + destination_file
-
+        if len(storage['folder']): # the folder is in the bucket, not in the local path
+            source_file = storage['folder'] + '/' + source_file
+    part_size, part_concurrency = _get_part_settings(storage)
+    stat = client.stat_object(storage['bucket'], source_file)
+    if stat.size > part_size:
+        return multipart_download_from_s3(source_file, destination_file, storage,
+                                          part_size = part_size,
+                                          part_concurrency = part_concurrency)
     res = client.fget_object(
         storage['bucket'], source_file, destination_file)
     return res
@@ -134,10 +971,14 @@ def copyfile_from_s3(source_file,
 def copy_from_s3(source_files, destination_files,
                  storage = None,
                  storage_name = None,
-                 n_jobs = DEFAULT_N_JOBS):
+                 n_jobs = DEFAULT_N_JOBS,
+                 max_bandwidth = None,
+                 md5_checksum = None):
     '''
     Copy from S3.
-    Copy occurs in parallel for multiple files.
+    Copy occurs in parallel for multiple files (see TransferScheduler);
+    max_bandwidth (MB/s) limits the bandwidth used by all transfers.
+    md5_checksum (optional) are compared with the downloaded files.
 
     Joao Couto - 2024
     '''
@@ -155,12 +996,31 @@ def copy_from_s3(source_files, destination_files,
     # Check if the source and the destination are the correct sizes
     assert len(source_files) == len(destination_files),ValueError('source and destination are the wrong size')
     
-    res = Parallel(n_jobs = n_jobs)(delayed(copyfile_from_s3)(src,
-                                                              dst,
-                                                              storage = storage)
-                                    for src,dst in zip(source_files,destination_files))
+    scheduler = TransferScheduler(storage, n_jobs = n_jobs, max_bandwidth = max_bandwidth)
+    res = scheduler.download(source_files, destination_files, md5_checksum = md5_checksum)
+    m = scheduler.metrics()
+    print(f"Downloaded {m['completed_files']} files ({m['transferred_bytes']/1024**3:.2f} GB) in {m['elapsed']:.1f}s [{m['throughput']:.1f} MB/s]")
     return res
 
+def s3_get_object_range(filepath, storage, offset = 0, length = 0):
+    '''
+    Reads a byte range of an object (range request); length = 0 reads to the end.
+    The storage folder is added to the path.
+    Returns bytes.
+
+    Joao Couto - 2024
+    '''
+    client = get_s3_client(storage)
+    response = client.get_object(storage['bucket'], _object_name(storage, filepath),
+                                 offset = offset, length = length)
+    try:
+        data = response.read()
+    finally:
+        response.close()
+        response.release_conn()
+    if length > 0 and not len(data) == length:
+        raise OSError(f'Read {len(data)} bytes from {filepath} (expected {length}).')
+    return data
 
 def s3_delete_file(filepath,storage, remove_versions = False):
     '''
@@ -172,9 +1032,7 @@ def s3_delete_file(filepath,storage, remove_versions = False):
     Joao Couto - 2024
     '''
     
-    client = Minio(endpoint = storage['endpoint'],
-                   access_key = storage['access_key'],
-                   secret_key = storage['secret_key'])
+    client = get_s3_client(storage)
 
     if remove_versions:
         objects = client.list_objects(storage['bucket'], prefix=filepath,include_version=True)
@@ -157,10 +157,42 @@ class EphysRecordingNoiseStats(dj.Computed):
     channel_min = NULL                : longblob
     channel_peak_to_peak = NULL       : longblob
     channel_mad = NULL                : longblob  # median absolute deviation
+    chunk_duration = NULL             : float     # duration of the chunks (s)
     '''
-    duration = 30                     # duration of the stretch to sample (takes it from the start and the end of the file)
+    duration = 30                     # duration of the stretch to summarize (from the start and the end of the file)
+    chunk_duration = 1                # the statistics are computed in chunks of this duration (s) over the entire file
+    chunk_interval = None             # distance between chunks (s), None uses all chunks
+
+    class Chunk(dj.Part):
+        definition = '''
+        -> master
+        chunk_num                     : int       # chunk number
+        ---
+        chunk_start                   : float     # start of the chunk (s)
+        channel_median                : longblob  # float32 arrays (nchannels)
+        channel_max                   : longblob
+        channel_min                   : longblob
+        channel_peak_to_peak          : longblob
+        channel_mad                   : longblob  # median absolute deviation
+        '''
+
+    @classmethod
+    def migrate(cls):
+        '''
+        Adds the chunk_duration column to tables created before the statistics were computed in chunks
+        (the Chunk part table is created when the schema is loaded). Same as the SQL:
+
+            ALTER TABLE `<database.name>`.`__ephys_recording_noise_stats`
+                ADD `chunk_duration` float DEFAULT NULL COMMENT "duration of the chunks (s)";
+
+        EphysRecordingNoiseStats.migrate()
+        '''
+        if not 'chunk_duration' in cls().heading.names:
+            cls().alter(prompt = False)
 
     def make(self,key):
+        if not 'chunk_duration' in self.heading.names:
+            raise ValueError('EphysRecordingNoiseStats has no chunk_duration column, run EphysRecordingNoiseStats.migrate()')
         files = pd.DataFrame((EphysRecording.ProbeFile() & key).fetch())
         assert len(files), ValueError(f'No files for dataset {key}')
         # search for the recording files (this is set for compressed files now)
@@ -177,8 +209,34 @@ class EphysRecordingNoiseStats(dj.Computed):
                                                       duration = self.duration,
                                                       channel_indices = config.channel_idx,
                                                       sampling_rate = config.sampling_rate,
-                                                      gain = config.probe_gain)        
-        self.insert1(dict(key,**noisestats),ignore_extra_fields = True)
+                                                      gain = config.probe_gain,
+                                                      chunk_duration = self.chunk_duration,
+                                                      chunk_interval = self.chunk_interval)
+        chunks = noisestats.pop('chunks')
+        self.insert1(dict(key,**noisestats, chunk_duration = self.chunk_duration))
+        from .utils import bulk_insert
+        bulk_insert(self.Chunk, [dict(key,
+                                      chunk_num = i,
+                                      chunk_start = float(chunks['chunk_start'][i]),
+                                      **{k:chunks[k][i] for k in ['channel_median','channel_max','channel_min',
+                                                                  'channel_peak_to_peak','channel_mad']})
+                                 for i in range(len(chunks['chunk_start']))])
+
+    def get_chunks(self, key = None):
+        '''
+        Returns the per chunk statistics as a dictionary of (nchunks x nchannels) arrays, to look at drift and artifacts.
+
+        stats = (EphysRecordingNoiseStats() & key).get_chunks()
+        plt.plot(stats['chunk_start'], stats['channel_mad'])
+        '''
+        query = self.Chunk() & self
+        if not key is None:
+            query = query & key
+        res = query.fetch(order_by = 'chunk_num', as_dict = True)
+        stats = dict(chunk_start = np.array([r['chunk_start'] for r in res]))
+        for k in ['channel_median','channel_max','channel_min','channel_peak_to_peak','channel_mad']:
+            stats[k] = np.stack([r[k] for r in res]) if len(res) else np.zeros((0,0), dtype = np.float32)
+        return stats
 
     
 @dataschema
@@ -241,6 +299,46 @@ class SpikeSorting(dj.Manual):
         waveform_median   :  longblob         # average waveform (gain corrected in microvolt - float32)
         '''
 
+    # all spike times of a sorting in one compressed array (faster than fetching every Unit)
+    class SpikeTrains(dj.Part):
+        definition = '''
+        -> master
+        ---
+        n_spikes                 : bigint       # number of spikes
+        spike_times              : longblob     # delta encoded spike times (samples), see labdata.schema.utils.encode_spike_trains
+        spike_units              : longblob     # index of each spike in unit_ids (compressed)
+        unit_ids                 : longblob     # the cluster id of each unit
+        times_dtype = "uint32"   : varchar(8)   # dtype of the spike time differences
+        units_dtype = "uint16"   : varchar(8)   # dtype of the unit indices
+        '''
+
+    def get_spike_trains(self, t_start = None, t_stop = None, unit_ids = None):
+        '''
+        Returns the spikes of one sorting as a SpikeTrains object (see labdata.schema.utils).
+
+        trains = (SpikeSorting() & key).get_spike_trains(t_start = 0, t_stop = 30000*60)
+        trains[unit_id]   # spike times of a unit (samples)
+
+        Uses SpikeSorting.SpikeTrains (one fetch), sortings without it are read from SpikeSorting.Unit.
+        '''
+        from .utils import decode_spike_trains, SpikeTrains
+        key = self.fetch1('KEY')
+        encoded = (SpikeSorting.SpikeTrains() & key).fetch(as_dict = True)
+        if len(encoded):
+            trains = decode_spike_trains(encoded[0])
+        else:
+            ids, times = (SpikeSorting.Unit() & key).fetch('unit_id','spike_times')
+            times = [np.asarray(t).flatten() for t in times]
+            units = np.concatenate([np.full(len(t), i, dtype = np.uint32) for i,t in enumerate(times)])
+            times = np.concatenate(times) if len(times) else np.array([], dtype = np.uint64)
+            order = np.argsort(times, kind = 'stable')
+            trains = SpikeTrains(times[order], units[order], ids)
+        if not unit_ids is None:
+            trains = trains.select(unit_ids)
+        if not t_start is None or not t_stop is None:
+            trains = trains.window(t_start, t_stop)
+        return trains
+
 @dataschema
 class UnitMetrics(dj.Computed):
    # Compute the metrics from the each unit,
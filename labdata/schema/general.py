@@ -66,7 +66,69 @@ class File(dj.Manual):
 '''.format('\n'.join(files_not_deleted))))
                     
 
-@dataschema 
+# Checksums other than md5 (that is in File); e.g. faster algorithms used to verify large files.
+@dataschema
+class FileChecksum(dj.Manual):
+    definition = '''
+    -> File
+    checksum_algorithm        : varchar(16)   # algorithm name in labdata.checksums (e.g. xxh3_128, blake2b)
+    ---
+    checksum                  : varchar(128)  # hexdigest
+    '''
+
+# Per-part checksums of large files (to verify parts of files or resume transfers)
+@dataschema
+class FileManifest(dj.Manual):
+    definition = '''
+    -> File
+    ---
+    manifest_algorithm        : varchar(16)   # checksum algorithm of the parts
+    part_size                 : bigint        # size of each part in bytes
+    n_parts                   : int           # number of parts
+    part_checksums            : longblob      # list with the hexdigest of each part
+    manifest_checksum         : varchar(140)  # checksum of the part checksums (same as the S3 ETag for md5)
+    '''
+    def to_manifest(self):
+        '''
+        Returns the manifest dictionary (as in labdata.checksums.compute_chunked_checksums)
+        '''
+        m = (self*File()).fetch1()
+        return dict(algorithm = m['manifest_algorithm'],
+                    part_size = int(m['part_size']),
+                    file_size = int(m['file_size']),
+                    n_parts = int(m['n_parts']),
+                    part_checksums = list(m['part_checksums']),
+                    manifest_checksum = m['manifest_checksum'])
+
+# Small files that were uploaded packed in a bundle (a tar object in File); see labdata.bundles
+@dataschema
+class BundledFile(dj.Manual):
+    definition = '''
+    file_path                 : varchar(300)  # Path to the file (as if it was not bundled)
+    storage = "ucla_data"     : varchar(12)   # storage name
+    ---
+    -> File.proj(bundle_path = 'file_path', bundle_storage = 'storage')
+    member_offset             : bigint        # offset of the file data in the bundle (bytes)
+    file_datetime             : datetime      # date created
+    file_size                 : double        # using double because int64 does not exist
+    file_md5 = NULL           : varchar(32)   # md5 checksum
+    '''
+    def read(self, verify = True):
+        '''
+        Reads one bundled file (uses a range request if the file is not in the local paths).
+        '''
+        from ..bundles import read_bundled_file
+        key = self.fetch1('KEY')
+        return read_bundled_file(key['file_path'], storage = key['storage'], verify = verify)
+
+    def get(self, local_path = None, overwrite = False):
+        '''
+        Downloads the bundled files to the local path, returns the local paths.
+        '''
+        from ..bundles import get_bundled_files
+        return get_bundled_files(self.fetch('file_path'), local_path = local_path, overwrite = overwrite)
+
+@dataschema
 class AnalysisFile(dj.Manual):
     definition = '''
     file_path                 : varchar(300)  # Path to the file
@@ -284,6 +346,49 @@ class DatasetEvents(dj.Imported):
         '''
 
 # Upload queue, so that experimental computers are not transfering data 
+def _consecutive_auto_increment(conn):
+    '''
+    Multi-row inserts get consecutive auto_increment values unless InnoDB uses
+    the "interleaved" lock mode (innodb_autoinc_lock_mode = 2).
+    '''
+    try:
+        mode = conn.query('SELECT @@innodb_autoinc_lock_mode').fetchone()[0]
+    except Exception:
+        return False
+    return int(mode) in [0, 1]
+
+def _create_jobs(table, part, jobs, assigned_files, ignore_extra_fields = True):
+    '''
+    Inserts jobs (without job_id) in a table with an auto_increment job_id and the files in the part table.
+    The ids are read with LAST_INSERT_ID (per connection) so concurrent submitters do not collide.
+    All jobs are inserted in one statement when the ids are consecutive, otherwise one statement per job.
+    The files of all jobs are inserted in one statement.
+    Returns the job ids.
+    '''
+    from contextlib import nullcontext
+    if not len(jobs) == len(assigned_files):
+        raise ValueError('Specify the assigned files for each job.')
+    if not len(jobs):
+        return []
+    jobs = [{k:v for k,v in job.items() if not k == 'job_id'} for job in jobs]
+    conn = dj.conn()
+    with (nullcontext() if conn.in_transaction else conn.transaction):
+        if len(jobs) > 1 and _consecutive_auto_increment(conn):
+            table.insert(jobs, ignore_extra_fields = ignore_extra_fields)
+            first = conn.query('SELECT LAST_INSERT_ID()').fetchone()[0]
+            job_ids = [int(first) + i for i in range(len(jobs))]
+        else:
+            job_ids = []
+            for job in jobs:
+                table.insert1(job, ignore_extra_fields = ignore_extra_fields)
+                job_ids.append(int(conn.query('SELECT LAST_INSERT_ID()').fetchone()[0]))
+        files = []
+        for job_id, fs in zip(job_ids, assigned_files):
+            files.extend([dict(f, job_id = job_id) for f in fs])
+        if len(files):
+            part.insert(files, ignore_extra_fields = ignore_extra_fields)
+    return job_ids
+
 @dataschema
 class UploadJob(dj.Manual):
     definition = '''
@@ -309,6 +414,19 @@ class UploadJob(dj.Manual):
         src_md5 = NULL         : varchar(32)       # md5 checksum
         '''
 
+    @classmethod
+    def create_jobs(cls, jobs, assigned_files):
+        '''
+        Inserts upload jobs and their files; the job_id is assigned by the database (auto_increment).
+
+        job_ids = UploadJob.create_jobs([dict(job_status = 'ON SERVER', upload_storage = 'ucla_data', **dataset)],
+                                        [[dict(src_path = ..., src_datetime = ..., src_size = ..., src_md5 = ...)]])
+
+        assigned_files is a list (one per job) of lists of AssignedFiles entries (without the job_id).
+        Returns the job ids.
+        '''
+        return _create_jobs(cls, cls.AssignedFiles, jobs, assigned_files)
+
 # Jobs to perform computations, like spike sorting or segmentation
 @dataschema
 class ComputeTask(dj.Manual):
@@ -331,4 +449,14 @@ class ComputeTask(dj.Manual):
         -> master
         -> File
         '''
+
+    @classmethod
+    def create_tasks(cls, tasks, assigned_files):
+        '''
+        Inserts compute tasks and their files; the job_id is assigned by the database (auto_increment).
+
+        assigned_files is a list (one per task) of lists of dict(file_path, storage).
+        Returns the job ids.
+        '''
+        return _create_jobs(cls, cls.AssignedFiles, tasks, assigned_files)
     
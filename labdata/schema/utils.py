@@ -1,7 +1,11 @@
 from ..utils import *
 # some functions used in the schema imports
 
-__all__ = ['read_events_from_btss_riglog']
+__all__ = ['read_events_from_btss_riglog',
+           'bulk_insert',
+           'encode_spike_trains',
+           'decode_spike_trains',
+           'SpikeTrains']
 
 def read_events_from_btss_riglog(logfile):
     '''
@@ -76,3 +80,202 @@ def read_events_from_btss_riglog(logfile):
                                   event_timestamps = time,  # in seconds
                                   event_values = to_parse[k]))
     return datasetevents
+
+
+def _estimate_row_size(row):
+    '''
+    Upper bound of the size of a row in an insert statement (blobs are escaped, so count them twice).
+    '''
+    size = 64
+    for v in row.values():
+        if isinstance(v, np.ndarray):
+            size += 2*v.nbytes + 64
+        elif isinstance(v, (bytes, str)):
+            size += 2*len(v) + 8
+        elif isinstance(v, (list, tuple, dict)):
+            size += 2*len(pickle.dumps(v)) + 64
+        else:
+            size += 32
+    return size
+
+def bulk_insert(table, rows,
+                max_packet_bytes = None,
+                max_rows = 1000,
+                progress = False,
+                **kwargs):
+    '''
+    Inserts rows in multi-row inserts that fit in the max_allowed_packet of the server.
+
+    stats = bulk_insert(SpikeSorting.Unit, units, skip_duplicates = True)
+
+    All batches are inserted in one transaction (or in the transaction that is already open),
+    so either all rows are inserted or none.
+
+    max_packet_bytes: size of each insert (default is half of the server max_allowed_packet)
+    max_rows: max number of rows per insert
+    kwargs are passed to insert (e.g. skip_duplicates, ignore_extra_fields)
+
+    Returns a dictionary with the number of rows and batches, the duration and rows per second.
+
+    Joao Couto - labdata 2024
+    '''
+    import datajoint as dj
+    from time import perf_counter
+    from contextlib import nullcontext
+    conn = dj.conn()
+    if max_packet_bytes is None:
+        max_packet_bytes = int(conn.query('SELECT @@max_allowed_packet').fetchone()[0])//2
+    # split the rows in batches
+    batches, batch, batch_size = [], [], 0
+    for row in rows:
+        size = _estimate_row_size(row)
+        if len(batch) and (batch_size + size > max_packet_bytes or len(batch) >= max_rows):
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(row)
+        batch_size += size
+    if len(batch):
+        batches.append(batch)
+    if progress:
+        from tqdm import tqdm
+        batches = tqdm(batches, desc = f'Inserting {table.__name__ if hasattr(table,"__name__") else table}')
+    tstart = perf_counter()
+    nrows = 0
+    with (nullcontext() if conn.in_transaction else conn.transaction):
+        for batch in batches:
+            table.insert(batch, **kwargs)
+            nrows += len(batch)
+    duration = perf_counter() - tstart
+    return dict(rows = nrows,
+                batches = len(batches),
+                duration = duration,
+                rows_per_second = nrows/duration if duration > 0 else np.nan)
+
+def _shuffle_compress(values):
+    '''
+    Byte shuffle and zlib compress an array (small integers compress much better after the shuffle).
+    '''
+    import zlib
+    values = np.ascontiguousarray(values)
+    shuffled = values.view(np.uint8).reshape(-1, values.dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(shuffled).tobytes(), 6)
+
+def _decompress_unshuffle(data, dtype, count):
+    import zlib
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(data), dtype = np.uint8).reshape(dtype.itemsize, count)
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(count)
+
+def encode_spike_trains(spike_times, spike_clusters, unit_ids = None):
+    '''
+    Encodes the spikes of a sorting in two compressed arrays (to insert in SpikeSorting.SpikeTrains).
+
+    spike_times: spike times in samples (all units)
+    spike_clusters: the unit of each spike
+    unit_ids: the units to keep (default all)
+
+    The spikes are sorted in time, the times are delta encoded (uint32 unless there are gaps > 2**32 samples),
+    the units are stored as the index in unit_ids; both are byte shuffled and zlib compressed.
+
+    Returns a dictionary with spike_times, spike_units, unit_ids, n_spikes, times_dtype and units_dtype.
+    '''
+    spike_times = np.asarray(spike_times).flatten().astype(np.int64)
+    spike_clusters = np.asarray(spike_clusters).flatten()
+    if unit_ids is None:
+        unit_ids = np.unique(spike_clusters)
+    unit_ids = np.asarray(unit_ids).flatten().astype(np.int64)
+    # index of each spike in unit_ids
+    sorted_ids = np.argsort(unit_ids)
+    idx = np.searchsorted(unit_ids[sorted_ids], spike_clusters)
+    idx = np.clip(idx, 0, max(len(unit_ids) - 1, 0))
+    keep = unit_ids[sorted_ids][idx] == spike_clusters if len(unit_ids) else np.zeros(len(spike_clusters), dtype = bool)
+    spike_units = sorted_ids[idx[keep]]
+    spike_times = spike_times[keep]
+    order = np.argsort(spike_times, kind = 'stable')
+    spike_times = spike_times[order]
+    spike_units = spike_units[order]
+    deltas = np.diff(spike_times, prepend = 0)
+    times_dtype = np.uint32 if (not len(deltas) or deltas.max() < 2**32) else np.uint64
+    units_dtype = np.uint16 if len(unit_ids) < 2**16 else np.uint32
+    return dict(spike_times = _shuffle_compress(deltas.astype(times_dtype)),
+                spike_units = _shuffle_compress(spike_units.astype(units_dtype)),
+                unit_ids = unit_ids,
+                n_spikes = len(spike_times),
+                times_dtype = np.dtype(times_dtype).name,
+                units_dtype = np.dtype(units_dtype).name)
+
+def decode_spike_trains(encoded):
+    '''
+    Decodes the arrays of encode_spike_trains (or a row of SpikeSorting.SpikeTrains).
+    Returns a SpikeTrains object.
+    '''
+    n = int(encoded['n_spikes'])
+    spike_times = np.cumsum(_decompress_unshuffle(encoded['spike_times'], encoded['times_dtype'], n),
+                            dtype = np.uint64)
+    spike_units = _decompress_unshuffle(encoded['spike_units'], encoded['units_dtype'], n)
+    return SpikeTrains(spike_times, spike_units, encoded['unit_ids'])
+
+class SpikeTrains():
+    def __init__(self, spike_times, spike_units, unit_ids):
+        '''
+        Spikes of a sorting, sorted in time.
+
+        trains = (SpikeSorting() & key).get_spike_trains()
+        trains[unit_id]                      # spike times of a unit (view)
+        trains.window(t_start, t_stop)       # spikes in a time window (samples)
+        trains.to_dict()                     # dictionary unit_id: spike_times
+
+        spike_times: spike times in samples (sorted)
+        spike_units: index in unit_ids of each spike
+        '''
+        self.spike_times = np.asarray(spike_times)
+        self.spike_units = np.asarray(spike_units)
+        self.unit_ids = np.asarray(unit_ids)
+        self._index = {int(u):i for i,u in enumerate(self.unit_ids)}
+        self._grouped = None
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def __iter__(self):
+        return iter([int(u) for u in self.unit_ids])
+
+    def keys(self):
+        return [int(u) for u in self.unit_ids]
+
+    def _group(self):
+        if self._grouped is None:
+            from ..compute.ephys import sort_spikes_by_unit
+            order, ids, starts, stops = sort_spikes_by_unit(self.spike_units,
+                                                            unit_ids = np.arange(len(self.unit_ids)))
+            self._grouped = (self.spike_times[order], starts, stops)
+        return self._grouped
+
+    def __getitem__(self, unit_id):
+        i = self._index[int(unit_id)]
+        times, starts, stops = self._group()
+        return times[starts[i]:stops[i]]
+
+    def window(self, t_start = None, t_stop = None):
+        '''
+        Spikes between t_start and t_stop (samples, t_stop not included).
+        '''
+        i0 = 0 if t_start is None else np.searchsorted(self.spike_times, t_start, side = 'left')
+        i1 = len(self.spike_times) if t_stop is None else np.searchsorted(self.spike_times, t_stop, side = 'left')
+        return SpikeTrains(self.spike_times[i0:i1], self.spike_units[i0:i1], self.unit_ids)
+
+    def select(self, unit_ids):
+        '''
+        Spikes of some units.
+        '''
+        idx = np.array([self._index[int(u)] for u in np.atleast_1d(unit_ids)], dtype = np.int64)
+        keep = np.isin(self.spike_units, idx)
+        remap = np.zeros(len(self.unit_ids), dtype = np.int64)
+        remap[idx] = np.arange(len(idx))
+        return SpikeTrains(self.spike_times[keep], remap[self.spike_units[keep]], self.unit_ids[idx])
+
+    def to_dict(self):
+        return {u:self[u] for u in self.keys()}
+
+    def __repr__(self):
+        return f'SpikeTrains({len(self.unit_ids)} units, {len(self.spike_times)} spikes)'
@@ -63,6 +63,9 @@ default_labdata_preferences = dict(local_paths = [str(Path.home()/'data')],
                                            local = str(Path.home()/Path('labdata')/'containers'),
                                            storage = 'analysis'), # place to store on s3
                                        analysis = analysis,
+                                       waveforms_layout = 'units', # or 'ragged' (one array for all units in waveforms.hdf5)
+                                       prefetch_next_task = False, # download the files of the next task while computing
+                                       scratch_cache_size = 500*1024**3, # bytes of downloaded files kept in the scratch_path
                                        default_target = 'slurm'),
                                    storage = dict(ucla_data = dict(protocol = 's3',
                                                                    endpoint = 's3.amazonaws.com:9000',
@@ -85,13 +88,25 @@ default_labdata_preferences = dict(local_paths = [str(Path.home()/'data')],
                                                         Path('labdata')/'plugins'), # this can be removed?
                                    submit_defaults = None,
                                    run_defaults = {'delete-cache':False},
+                                   checksums = dict(chunk_size = 16*1024*1024,  # read size when computing checksums
+                                                    secondary = [],             # other algorithms to store in FileChecksum (e.g. 'xxh3_128')
+                                                    cache = True,               # keep computed checksums in ~/labdata/checksum_cache.sqlite
+                                                    cache_max_entries = 200000,
+                                                    manifest_part_size = 64*1024*1024, # part size of the per-part checksums (FileManifest)
+                                                    manifest_min_size = None),         # compute a FileManifest for files larger than this on upload
+                                   bundles = dict(max_file_size = None,        # pack files smaller than this (bytes) in bundles on upload (None disables)
+                                                  max_bundle_size = 1024**3,   # max size of each bundle
+                                                  min_files = 100),            # only bundle datasets with at least this many small files
                                    upload_path = None,           # this is the path to the local computer that writes to s3
                                    upload_storage = None,        # which storage to upload to
                                    upload_rules = dict(ephys = dict(
                                        rule = '*.ap.bin',                 # path format that triggers the rule
                                        pre = ['compress_ephys_dataset'],  # functions to execute before
                                        post = ['ingest_ephys_session'],   # function to execute after
-                                       use_queue = 'slurm')))             # whether to use a queue and if so which one
+                                       use_queue = 'slurm',               # whether to use a queue and if so which one
+                                       compression_check = 'chunks',      # verify the compression: 'chunks', 'sample', 'full' or None
+                                       compression_check_fraction = 0.1,  # fraction of chunks checked with 'sample'
+                                       stream_upload = False)))           # upload while compressing (keeps only the raw .ap.bin)
 
 def get_labdata_preferences(prefpath = None):
     ''' Reads the user parameters from the home directory.
@@ -160,15 +175,13 @@ def parse_filepath_parts(path,
 ##########################################################
 ##########################################################
 
-def compute_md5_hash(fname):
+def compute_md5_hash(fname, chunk_size = None):
     '''
     Computes the md5 hash that can be used to check file integrity
+    (see labdata.checksums for other algorithms)
     '''
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    from .checksums import compute_file_checksum
+    return compute_file_checksum(fname, algorithm = 'md5', chunk_size = chunk_size)
 
 
 def compute_md5s(filepaths,n_jobs = DEFAULT_N_JOBS):
@@ -249,14 +262,114 @@ def extrapolate_time_from_clock(master_clock,master_events, slave_events):
     return interp1d(master_events, master_clock, fill_value='extrapolate')(slave_events)
 
 
-def save_dict_to_h5(filename,dictionary,compression = 'gzip', compression_opts = 1, compression_size_threshold = 1000):
+H5_CHUNK_BYTES = 1024*1024  # target size of hdf5 chunks (1MB, the size of the default chunk cache)
+
+def _h5_compression_filter(compression, compression_opts = None, shuffle = True):
+    '''
+    Returns the keyword arguments of h5py create_dataset for a codec.
+
+    compression can be gzip, lzf or (if hdf5plugin is installed) blosc, blosc_lz4, blosc_zstd, zstd and lz4.
+    For blosc the shuffle is done by blosc.
+    '''
+    if compression is None:
+        return dict()
+    if compression == 'gzip':
+        return dict(compression = 'gzip',
+                    compression_opts = 1 if compression_opts is None else compression_opts,
+                    shuffle = shuffle)
+    if compression == 'lzf':
+        return dict(compression = 'lzf', shuffle = shuffle)
+    try:
+        import hdf5plugin # optional, registers the blosc and zstd filters (pip install hdf5plugin)
+    except ImportError:
+        raise ValueError(f'Compression {compression} requires hdf5plugin (pip install hdf5plugin); use gzip or lzf.')
+    level = 5 if compression_opts is None else compression_opts
+    if compression.startswith('blosc'):
+        cname = 'lz4' if compression == 'blosc' else compression.split('_')[-1]
+        return dict(**hdf5plugin.Blosc(cname = cname, clevel = level,
+                                        shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    if compression == 'zstd':
+        return dict(**hdf5plugin.Zstd(clevel = level), shuffle = shuffle)
+    if compression == 'lz4':
+        return dict(**hdf5plugin.LZ4(), shuffle = shuffle)
+    raise ValueError(f'Unknown compression {compression}.')
+
+def _h5_chunk_shape(val, chunks = True, chunk_bytes = H5_CHUNK_BYTES):
+    '''
+    Chunk shape of a dataset:
+       True: let h5py guess
+       'rows': chunks of whole rows (all but the first dimension are in the chunk) of about chunk_bytes,
+               e.g. waveforms (spikes x samples x channels) are read by spike without decompressing other rows.
+       tuple: the chunk shape
+       function: called with the array, returns one of the above
+    '''
+    if callable(chunks):
+        chunks = chunks(val)
+    if isinstance(chunks, str):
+        if not chunks == 'rows':
+            raise ValueError(f'Unknown chunk layout {chunks}.')
+        val = np.asarray(val)
+        if val.ndim == 0:
+            return None
+        row_bytes = max(int(np.prod(val.shape[1:]))*val.dtype.itemsize, 1)
+        nrows = int(np.clip(chunk_bytes//row_bytes, 1, max(val.shape[0], 1)))
+        return (nrows,) + tuple(val.shape[1:])
+    return chunks
+
+def _shuffle_and_deflate(data, level):
+    '''
+    Same as the hdf5 shuffle and deflate filters (zlib releases the GIL so this runs in threads).
+    '''
+    import zlib
+    data = np.ascontiguousarray(data)
+    if data.dtype.itemsize > 1:
+        data = data.view(np.uint8).reshape(-1, data.dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(data).tobytes(), level)
+
+def _write_precompressed(f, key, val, chunks, level, shuffle = True, n_jobs = DEFAULT_N_JOBS):
+    '''
+    Writes a dataset compressed with gzip; the chunks are shuffled and compressed in threads
+    and written with write_direct_chunk (the file is readable with the standard gzip filter).
+    '''
+    import itertools
+    from concurrent.futures import ThreadPoolExecutor
+    dset = f.create_dataset(str(key), shape = val.shape, dtype = val.dtype, chunks = chunks,
+                            compression = 'gzip', compression_opts = level, shuffle = shuffle)
+    chunks = dset.chunks
+    grid = [range(0, s, c) for s,c in zip(val.shape, chunks)]
+    def _compress(offset):
+        data = val[tuple(slice(o, o + c) for o,c in zip(offset, chunks))]
+        if not data.shape == chunks:  # the chunks at the edges are stored complete
+            padded = np.zeros(chunks, dtype = val.dtype)
+            padded[tuple(slice(0, s) for s in data.shape)] = data
+            data = padded
+        if shuffle:
+            return offset, _shuffle_and_deflate(data, level)
+        import zlib
+        return offset, zlib.compress(np.ascontiguousarray(data).tobytes(), level)
+    offsets = itertools.product(*grid)
+    batch_size = n_jobs*16  # compressed chunks held in memory at once
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        while True:
+            batch = list(itertools.islice(offsets, batch_size))
+            if not len(batch):
+                break
+            for offset, data in pool.map(_compress, batch):
+                dset.id.write_direct_chunk(offset, data)
+    return dset
+
+def save_dict_to_h5(filename,dictionary,compression = 'gzip', compression_opts = 1, compression_size_threshold = 1000,
+                    chunks = True, shuffle = True, n_jobs = None):
     '''
     Save a dictionary as a compressed hdf5 dataset.
     filename: path to the file (IMPORTANT: this WILL overwrite without checks.)
     dictionary: the dictionary to save
 
     If the size of the data are larger than compression_size_threshold it will save with compression.
-    default compression is gzip, can also use lzf
+    default compression is gzip, can also use lzf or (with hdf5plugin) blosc, blosc_zstd, zstd and lz4
+    compression_opts: the compression level
+    chunks: True (h5py guesses), 'rows' (chunks of whole rows, e.g. whole waveforms), a shape or a function
+    n_jobs: compress the gzip chunks in parallel threads (the file is the same as with the gzip filter)
 
     Joao Couto - 2023
     '''
@@ -265,12 +378,16 @@ def save_dict_to_h5(filename,dictionary,compression = 'gzip', compression_opts =
                       compression_size_threshold = compression_size_threshold):
         # compress if big enough.
                 
-        if np.size(val)>compression_size_threshold:
-            extras = dict(compression = compression,
-                          chunks = True, 
-                          shuffle = True)
-            if compression == 'gzip':
-                extras['compression_opts'] = compression_opts
+        if np.size(val)>compression_size_threshold and not compression is None:
+            val = np.asarray(val)
+            chunk_shape = _h5_chunk_shape(val, chunks)
+            if (compression == 'gzip' and not n_jobs is None and n_jobs > 1
+                and val.dtype.kind in 'biuf' and val.ndim > 0):
+                _write_precompressed(f, key, val, chunk_shape, level = compression_opts,
+                                     shuffle = shuffle, n_jobs = n_jobs)
+                return
+            extras = dict(chunks = chunk_shape,
+                          **_h5_compression_filter(compression, compression_opts, shuffle))
         else:
             extras = dict()
         f.create_dataset(str(key),data = val, **extras)
@@ -293,15 +410,80 @@ def save_dict_to_h5(filename,dictionary,compression = 'gzip', compression_opts =
         for k,v in tqdm(zip(keys,values),total = len(keys),desc = f"Saving to hdf5 {filename.name}"):
             _save_dataset(f = f,key = k,val = v) 
 
-def load_dict_from_h5(filename):
+def benchmark_h5_compression(dictionary = None,
+                             codecs = [dict(compression = 'gzip', compression_opts = 1),
+                                       dict(compression = 'gzip', compression_opts = 1, n_jobs = DEFAULT_N_JOBS),
+                                       dict(compression = 'gzip', compression_opts = 1, chunks = 'rows',
+                                            n_jobs = DEFAULT_N_JOBS),
+                                       dict(compression = 'lzf'),
+                                       dict(compression = 'blosc_lz4'),
+                                       dict(compression = 'blosc_zstd'),
+                                       dict(compression = None)],
+                             folder = None):
+    '''
+    Measures the write time, file size and read time of save_dict_to_h5 for different codecs.
+
+    res = benchmark_h5_compression()                # synthetic waveforms (like waveforms.hdf5)
+    res = benchmark_h5_compression(featurestosave)  # test a dictionary
+
+    Codecs that are not available (e.g. blosc without hdf5plugin) are skipped.
+    Returns a pandas DataFrame.
+
+    Joao Couto - labdata 2024
+    '''
+    from time import perf_counter
+    if dictionary is None:
+        # 200 units with 1000 waveforms of 90 samples and 384 channels (int16, with noise)
+        rng = np.random.default_rng(0)
+        template = (np.sin(np.linspace(0, 3*np.pi, 90))[:,None]*rng.normal(0, 50, 384)[None,:])
+        dictionary = {str(u):dict(waveforms = (template[None] + rng.normal(0, 10, (1000,90,384))).astype(np.int16),
+                                  indices = np.sort(rng.integers(0, 30000*3600, 1000)))
+                      for u in range(200)}
+    if folder is None:
+        folder = prefs['scratch_path']
+    folder = Path(folder)
+    folder.mkdir(parents = True, exist_ok = True)
+    filename = folder/'labdata_h5_benchmark.hdf5'
+    nbytes = np.sum([np.asarray(v).nbytes if not type(v) is dict else
+                     np.sum([np.asarray(o).nbytes for o in v.values()]) for v in dictionary.values()])
+    res = []
+    for codec in codecs:
+        try:
+            tstart = perf_counter()
+            save_dict_to_h5(filename, dictionary, **codec)
+            write_time = perf_counter() - tstart
+        except ValueError as err:
+            print(err)
+            continue
+        tstart = perf_counter()
+        load_dict_from_h5(filename)
+        read_time = perf_counter() - tstart
+        res.append(dict(compression = codec.get('compression'),
+                        compression_opts = codec.get('compression_opts'),
+                        chunks = str(codec.get('chunks', True)),
+                        n_jobs = codec.get('n_jobs'),
+                        write_time = write_time,
+                        read_time = read_time,
+                        file_size = filename.stat().st_size,
+                        ratio = nbytes/filename.stat().st_size,
+                        write_throughput = (nbytes/1024**2)/write_time))
+    filename.unlink(missing_ok = True)
+    return pd.DataFrame(res)
+
+def load_dict_from_h5(filename, lazy = False, cache_size = 1024**3):
     ''' 
     Loads a dictionary from hdf5 file.
     
     This is also in spks.
 
+    lazy = True returns a LazyH5Dict that reads the datasets only when accessed
+    (cache_size is the memory budget in bytes to keep recently read arrays).
+
     Joao Couto - spks 2023
 
     '''
+    if lazy:
+        return LazyH5Dict(filename, cache_size = cache_size)
     data = {}
     import h5py
     with h5py.File(filename,'r') as f:
@@ -319,3 +501,264 @@ def load_dict_from_h5(filename):
                         ko = int(o)
                     data[no][ko] = f[k][o][()]
     return data
+
+class _H5ArrayCache():
+    '''
+    Least recently used cache of arrays read from a file, limited by the number of bytes.
+    '''
+    def __init__(self, max_bytes = 1024**3):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.data = OrderedDict()
+
+    def get(self, key):
+        if key in self.data.keys():
+            self.data.move_to_end(key)
+            return self.data[key]
+        return None
+
+    def put(self, key, value):
+        nbytes = getattr(value, 'nbytes', 0)
+        if self.max_bytes is None or nbytes > self.max_bytes:
+            return  # does not fit
+        if key in self.data.keys():
+            self.nbytes -= getattr(self.data.pop(key), 'nbytes', 0)
+        self.data[key] = value
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            k, v = self.data.popitem(last = False)
+            self.nbytes -= getattr(v, 'nbytes', 0)
+
+    def clear(self):
+        self.data.clear()
+        self.nbytes = 0
+
+class LazyH5Dict():
+    def __init__(self, filename, cache_size = 1024**3, group = None, cache = None):
+        '''
+        Dictionary-like access to an hdf5 file that only reads what is requested.
+
+        data = load_dict_from_h5('features.hdf5', lazy = True)
+        data.keys()                                     # does not read the datasets
+        templates = data['templates']                   # reads one dataset (cached)
+        part = data.read('template_features', slice(0, 1000))  # reads part of a dataset
+        data.attrs('templates')                         # attributes of a dataset
+        unit = data[10]                                 # groups return a LazyH5Dict
+
+        Keys that start with a digit are returned as int (like load_dict_from_h5).
+        Arrays are kept in a least recently used cache of cache_size bytes (None disables it).
+        The file is opened once, use close() or a with statement.
+
+        Joao Couto - labdata 2024
+        '''
+        import h5py
+        self.filename = Path(filename)
+        if group is None:
+            self.file = h5py.File(self.filename, 'r')
+            self.group = self.file
+            self.cache = _H5ArrayCache(cache_size)
+            self._owner = True
+        else:
+            self.file = group.file
+            self.group = group
+            self.cache = cache
+            self._owner = False
+
+    @staticmethod
+    def _parse_key(k):
+        return int(k) if k[0].isdigit() else k
+
+    def _node(self, key):
+        key = str(key)
+        if not key in self.group.keys():
+            raise KeyError(key)
+        return self.group[key]
+
+    def keys(self):
+        return [self._parse_key(k) for k in self.group.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.group.keys())
+
+    def __contains__(self, key):
+        return str(key) in self.group.keys()
+
+    def is_group(self, key):
+        return not hasattr(self._node(key), 'dims')
+
+    def dataset(self, key):
+        '''
+        Returns the h5py dataset (to slice it or check shape and dtype without reading).
+        '''
+        return self._node(key)
+
+    def shape(self, key):
+        return self._node(key).shape
+
+    def attrs(self, key = None):
+        '''
+        Attributes of a dataset or group (of the file if key is None) as a dictionary.
+        '''
+        node = self.group if key is None else self._node(key)
+        return {k:v for k,v in node.attrs.items()}
+
+    def read(self, key, idx = None):
+        '''
+        Reads a dataset; idx (optional) reads only part of it (e.g. slice(0,100) or (slice(None), 0)).
+        Complete datasets are cached, parts are not.
+        '''
+        node = self._node(key)
+        if not idx is None:
+            return node[idx]
+        cached = None if self.cache is None else self.cache.get(node.name)
+        if cached is None:
+            cached = node[()]
+            if not self.cache is None:
+                self.cache.put(node.name, cached)
+        return cached
+
+    def __getitem__(self, key):
+        if self.is_group(key):
+            return LazyH5Dict(self.filename, group = self._node(key), cache = self.cache)
+        return self.read(key)
+
+    def items(self):
+        for k in self.keys():
+            yield k, self[k]
+
+    def values(self):
+        for k in self.keys():
+            yield self[k]
+
+    def to_dict(self):
+        '''
+        Reads everything (like load_dict_from_h5).
+        '''
+        return {k:(v.to_dict() if isinstance(v, LazyH5Dict) else v) for k,v in self.items()}
+
+    def close(self):
+        if self._owner:
+            self.cache.clear()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __repr__(self):
+        return f'LazyH5Dict({self.filename.name}:{self.group.name}, keys = {self.keys()})'
+
+def units_to_ragged(units, unit_ids = None):
+    '''
+    Concatenates per-unit arrays in one array per key (ragged layout).
+
+    ragged = units_to_ragged({unit_id: dict(waveforms = w, indices = i), ...})
+    save_dict_to_h5(filename, ragged)
+
+    Returns a dictionary with the concatenated arrays (e.g. waveforms and indices),
+    unit_ids and offsets: the rows of unit_ids[i] are offsets[i]:offsets[i+1].
+    Use load_ragged_h5 to read the units lazily.
+    '''
+    if unit_ids is None:
+        unit_ids = list(units.keys())
+    keys = list(units[unit_ids[0]].keys()) if len(unit_ids) else []
+    counts = np.array([len(units[u][keys[0]]) for u in unit_ids], dtype = np.int64)
+    ragged = {k:np.concatenate([np.asarray(units[u][k]) for u in unit_ids]) for k in keys}
+    ragged['unit_ids'] = np.array([int(u) for u in unit_ids], dtype = np.int64)
+    ragged['offsets'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return ragged
+
+class RaggedH5():
+    def __init__(self, filename):
+        '''
+        Reads an hdf5 file with the ragged layout (see units_to_ragged) without loading the data.
+
+        with load_ragged_h5('waveforms.hdf5') as units:
+            waves = units[unit_id]['waveforms']         # reads only the rows of the unit
+            first = units.get(unit_id, 'waveforms', slice(0,10))
+
+        The file is opened once; datasets are only read when a unit is accessed.
+
+        Joao Couto - labdata 2024
+        '''
+        import h5py
+        self.filename = Path(filename)
+        self.file = h5py.File(self.filename, 'r')
+        if not 'offsets' in self.file.keys() or not 'unit_ids' in self.file.keys():
+            self.file.close()
+            raise ValueError(f'{self.filename} does not have the ragged layout (offsets and unit_ids).')
+        self.offsets = self.file['offsets'][()]
+        self.unit_ids = self.file['unit_ids'][()]
+        self._index = {int(u):i for i,u in enumerate(self.unit_ids)}
+        # datasets with one row per element
+        self.data_keys = [k for k in self.file.keys()
+                          if not k in ['offsets','unit_ids'] and hasattr(self.file[k],'shape')
+                          and len(self.file[k].shape) and self.file[k].shape[0] == self.offsets[-1]]
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def __iter__(self):
+        return iter([int(u) for u in self.unit_ids])
+
+    def __contains__(self, unit_id):
+        return int(unit_id) in self._index.keys()
+
+    def keys(self):
+        return [int(u) for u in self.unit_ids]
+
+    def rows(self, unit_id):
+        '''
+        Returns the slice of the rows of a unit.
+        '''
+        i = self._index[int(unit_id)]
+        return slice(int(self.offsets[i]), int(self.offsets[i+1]))
+
+    def get(self, unit_id, key = 'waveforms', idx = None):
+        '''
+        Reads one key of a unit; idx (optional) selects rows of the unit (slice or sorted indices).
+        '''
+        rows = self.rows(unit_id)
+        if idx is None:
+            return self.file[key][rows]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(rows.stop - rows.start)
+            return self.file[key][rows.start + start:rows.start + stop:step]
+        return self.file[key][rows.start + np.asarray(idx)]
+
+    def __getitem__(self, unit_id):
+        return {k:self.get(unit_id, k) for k in self.data_keys}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def load_ragged_h5(filename):
+    '''
+    Opens an hdf5 file with the ragged layout (see units_to_ragged and RaggedH5).
+    Data are read per unit when accessed.
+    '''
+    return RaggedH5(filename)
@@ -0,0 +1,29 @@
+import sys
+import importlib.util
+from pathlib import Path
+import numpy as np
+import pytest
+
+@pytest.fixture(scope = 'session')
+def schema_utils():
+    '''
+    labdata.schema.utils without importing the labdata.schema package (that connects to the database).
+    '''
+    import labdata
+    name = 'labdata.schema.utils'
+    if not name in sys.modules.keys():
+        spec = importlib.util.spec_from_file_location(name, Path(labdata.__file__).parent/'schema'/'utils.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name]
+
+@pytest.fixture
+def sorting():
+    # synthetic sorting: spike times (samples), clusters and amplitudes
+    rng = np.random.default_rng(0)
+    n_spikes = 20000
+    spike_times = np.sort(rng.integers(0, 30000*60, size = n_spikes)).astype(np.uint64)
+    spike_clusters = rng.choice([0, 1, 3, 7, 12], size = n_spikes).astype(np.int32)
+    spike_amplitudes = rng.random(n_spikes, dtype = np.float32)
+    return spike_times, spike_clusters, spike_amplitudes
@@ -0,0 +1,47 @@
+import os
+import hashlib
+import numpy as np
+import pytest
+from labdata.checksums import (compute_checksums, compute_chunked_checksums,
+                               verify_chunked_checksums, combine_part_checksums)
+
+PART_SIZE = 1024*1024
+
+@pytest.fixture
+def datafile(tmp_path):
+    filename = tmp_path/'data.bin'
+    filename.write_bytes(os.urandom(5*PART_SIZE + 1234))
+    return filename
+
+def test_compute_checksums(datafile):
+    data = datafile.read_bytes()
+    res = compute_checksums(datafile, algorithms = ['md5', 'sha256'], chunk_size = 100000, use_cache = False)
+    assert res['md5'] == hashlib.md5(data).hexdigest()
+    assert res['sha256'] == hashlib.sha256(data).hexdigest()
+
+def test_chunked_checksums_match_parts(datafile):
+    data = datafile.read_bytes()
+    manifest = compute_chunked_checksums(datafile, part_size = PART_SIZE, n_threads = 3, use_cache = False)
+    parts = [data[i:i + PART_SIZE] for i in range(0, len(data), PART_SIZE)]
+    assert manifest['n_parts'] == len(parts) == 6
+    assert manifest['part_checksums'] == [hashlib.md5(p).hexdigest() for p in parts]
+    # same as the ETag of an S3 multipart upload with this part size
+    etag = hashlib.md5(b''.join([hashlib.md5(p).digest() for p in parts])).hexdigest()
+    assert manifest['manifest_checksum'] == f'{etag}-6'
+    assert combine_part_checksums(manifest['part_checksums']) == manifest['manifest_checksum']
+
+def test_verify_chunked_checksums(datafile):
+    manifest = compute_chunked_checksums(datafile, part_size = PART_SIZE, use_cache = False)
+    assert verify_chunked_checksums(datafile, manifest) == []
+    with open(datafile, 'r+b') as fd:
+        fd.seek(3*PART_SIZE + 10)
+        fd.write(b'corrupted')
+    assert verify_chunked_checksums(datafile, manifest) == [3]
+    assert verify_chunked_checksums(datafile, manifest, parts = [0, 1]) == []
+
+def test_verify_chunked_checksums_size(datafile):
+    manifest = compute_chunked_checksums(datafile, part_size = PART_SIZE, use_cache = False)
+    with open(datafile, 'ab') as fd:
+        fd.write(b'0')
+    with pytest.raises(OSError):
+        verify_chunked_checksums(datafile, manifest)
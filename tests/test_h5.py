@@ -0,0 +1,46 @@
+import numpy as np
+from labdata.utils import units_to_ragged, load_ragged_h5, save_dict_to_h5, load_dict_from_h5
+
+def _units(n_units = 6):
+    rng = np.random.default_rng(3)
+    units = dict()
+    for u in range(n_units):
+        n = int(rng.integers(0, 50)) if u else 0  # a unit without waveforms
+        units[u*3] = dict(waveforms = rng.integers(-100, 100, size = (n, 90, 8)).astype(np.int16),
+                          indices = np.sort(rng.integers(0, 10**6, size = n)).astype(np.int64))
+    return units
+
+def test_ragged_round_trip(tmp_path):
+    units = _units()
+    ragged = units_to_ragged(units)
+    assert np.array_equal(ragged['unit_ids'], list(units.keys()))
+    assert ragged['offsets'][-1] == np.sum([len(u['indices']) for u in units.values()])
+    filename = tmp_path/'waveforms.hdf5'
+    save_dict_to_h5(filename, ragged, chunks = 'rows', n_jobs = 2)
+    with load_ragged_h5(filename) as loaded:
+        for u, unit in units.items():
+            assert np.array_equal(loaded[u]['waveforms'], unit['waveforms'])
+            assert np.array_equal(loaded[u]['indices'], unit['indices'])
+        u = [u for u in units.keys() if len(units[u]['indices']) >= 5][0]
+        assert np.array_equal(loaded.get(u, 'waveforms', slice(0, 5)), units[u]['waveforms'][:5])
+
+def test_save_dict_parallel_gzip_matches(tmp_path):
+    # the chunks compressed in threads read back the same as the h5py gzip filter
+    units = {str(k):v for k,v in _units().items()}
+    for n_jobs in [None, 4]:
+        filename = tmp_path/f'units_{n_jobs}.hdf5'
+        save_dict_to_h5(filename, units, chunks = 'rows', n_jobs = n_jobs)
+        loaded = load_dict_from_h5(filename)
+        for k, unit in units.items():
+            for key in unit.keys():
+                assert np.array_equal(loaded[int(k)][key], unit[key])
+
+def test_lazy_load_matches(tmp_path):
+    data = dict(a = np.arange(10000, dtype = np.float32).reshape(100, 100),
+                b = dict(c = np.arange(5)))
+    filename = tmp_path/'data.hdf5'
+    save_dict_to_h5(filename, data)
+    loaded = load_dict_from_h5(filename)
+    lazy = load_dict_from_h5(filename, lazy = True)
+    assert np.array_equal(lazy['a'], loaded['a'])
+    assert np.array_equal(lazy['b']['c'], data['b']['c'])
@@ -0,0 +1,66 @@
+import numpy as np
+from labdata.compute.ephys import group_spikes_by_unit, sort_spikes_by_unit
+
+def test_group_spikes_by_unit_matches_where(sorting):
+    spike_times, spike_clusters, spike_amplitudes = sorting
+    unit_ids, units = group_spikes_by_unit(spike_clusters,
+                                           dict(spike_times = spike_times,
+                                                spike_amplitudes = spike_amplitudes))
+    assert np.array_equal(unit_ids, np.unique(spike_clusters))
+    for u, unit in zip(unit_ids, units):
+        # as it was done in prepare_results (one np.where per unit)
+        idx = np.where(spike_clusters == u)[0]
+        assert np.array_equal(unit['spike_times'], spike_times[idx])
+        assert np.array_equal(unit['spike_amplitudes'], spike_amplitudes[idx])
+
+def test_group_spikes_by_unit_empty_units(sorting):
+    spike_times, spike_clusters, _ = sorting
+    unit_ids, units = group_spikes_by_unit(spike_clusters, dict(spike_times = spike_times),
+                                           unit_ids = [0, 2, 12, 100])
+    assert np.array_equal(unit_ids, [0, 2, 12, 100])
+    assert len(units[1]['spike_times']) == 0
+    assert len(units[3]['spike_times']) == 0
+    assert np.array_equal(units[2]['spike_times'], spike_times[spike_clusters == 12])
+
+def test_sort_spikes_by_unit_is_stable(sorting):
+    _, spike_clusters, _ = sorting
+    order, unit_ids, starts, stops = sort_spikes_by_unit(spike_clusters)
+    for u, start, stop in zip(unit_ids, starts, stops):
+        assert np.array_equal(order[start:stop], np.where(spike_clusters == u)[0])
+
+def test_encode_decode_spike_trains(schema_utils, sorting):
+    spike_times, spike_clusters, _ = sorting
+    encoded = schema_utils.encode_spike_trains(spike_times, spike_clusters)
+    trains = schema_utils.decode_spike_trains(encoded)
+    assert encoded['n_spikes'] == len(spike_times)
+    assert np.array_equal(trains.spike_times, spike_times)
+    assert trains.keys() == [0, 1, 3, 7, 12]
+    for u in trains.keys():
+        assert np.array_equal(trains[u], spike_times[spike_clusters == u])
+
+def test_encode_spike_trains_selected_units(schema_utils, sorting):
+    spike_times, spike_clusters, _ = sorting
+    trains = schema_utils.decode_spike_trains(
+        schema_utils.encode_spike_trains(spike_times, spike_clusters, unit_ids = [12, 1]))
+    assert trains.keys() == [12, 1]
+    assert len(trains.spike_times) == np.sum(np.isin(spike_clusters, [1, 12]))
+    assert np.array_equal(trains[1], spike_times[spike_clusters == 1])
+
+def test_encode_spike_trains_large_gaps(schema_utils):
+    # deltas larger than uint32
+    spike_times = np.array([5, 2**33, 2**33 + 10, 2**34], dtype = np.uint64)
+    spike_clusters = np.array([1, 2, 1, 2])
+    encoded = schema_utils.encode_spike_trains(spike_times, spike_clusters)
+    assert encoded['times_dtype'] == 'uint64'
+    trains = schema_utils.decode_spike_trains(encoded)
+    assert np.array_equal(trains[2], spike_times[spike_clusters == 2])
+
+def test_spike_trains_window_and_select(schema_utils, sorting):
+    spike_times, spike_clusters, _ = sorting
+    trains = schema_utils.decode_spike_trains(schema_utils.encode_spike_trains(spike_times, spike_clusters))
+    window = trains.window(30000*10, 30000*20)
+    keep = (spike_times >= 30000*10) & (spike_times < 30000*20)
+    assert np.array_equal(window[3], spike_times[keep & (spike_clusters == 3)])
+    selected = trains.select([7, 0])
+    assert selected.keys() == [7, 0]
+    assert np.array_equal(selected[7], spike_times[spike_clusters == 7])
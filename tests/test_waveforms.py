@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from labdata.compute.ephys import get_waveforms_from_binary, get_spike_waveforms
+
+NCHANNELS = 16
+NSAMPLES = 20000
+
+@pytest.fixture
+def binary_file(tmp_path):
+    rng = np.random.default_rng(1)
+    data = rng.integers(-2000, 2000, size = (NSAMPLES, NCHANNELS)).astype(np.int16)
+    filename = tmp_path/'filtered_recording.bin'
+    data.tofile(filename)
+    return filename, data
+
+def _units(seed = 2, n_units = 5, wpre = 45, wpost = 45):
+    rng = np.random.default_rng(seed)
+    return [np.sort(rng.integers(wpre, NSAMPLES - wpost, size = rng.integers(1, 200)))
+            for i in range(n_units)]
+
+def test_waveforms_match_baseline(binary_file):
+    filename, data = binary_file
+    indices = _units()
+    # small blocks so the spikes are split in many reads
+    waves = get_waveforms_from_binary(filename, NCHANNELS, indices, n_jobs = 2, block_size = 64*1024)
+    for w, idx in zip(waves, indices):
+        assert np.array_equal(w, get_spike_waveforms(data, idx))
+
+def test_waveforms_channels(binary_file):
+    filename, data = binary_file
+    indices = _units()
+    channels = [np.arange(i, i + 4) for i in range(len(indices))]
+    waves = get_waveforms_from_binary(filename, NCHANNELS, indices, channels = channels)
+    for w, idx, ch in zip(waves, indices, channels):
+        assert np.array_equal(w, get_spike_waveforms(data, idx)[:, :, ch])
+
+def test_waveforms_units_without_spikes(binary_file):
+    filename, data = binary_file
+    waves = get_waveforms_from_binary(filename, NCHANNELS, [[], [100, 200]])
+    assert waves[0] is None
+    assert waves[1].shape == (2, 90, NCHANNELS)
+
+def test_waveforms_edges_are_zero_padded(binary_file):
+    # windows that go outside the file are padded with zeros (get_spike_waveforms raises IndexError)
+    filename, data = binary_file
+    wpre, wpost = 45, 45
+    waves = get_waveforms_from_binary(filename, NCHANNELS, [[10, NSAMPLES - 5]], wpre = wpre, wpost = wpost)[0]
+    assert np.all(waves[0, :wpre - 10] == 0)
+    assert np.array_equal(waves[0, wpre - 10:], data[:10 + wpost])
+    assert np.array_equal(waves[1, :wpre + 5], data[NSAMPLES - 5 - wpre:])
+    assert np.all(waves[1, wpre + 5:] == 0)